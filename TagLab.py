@@ -39,18 +39,11 @@ from PyQt5.QtWidgets import QApplication, QWidget, QFileDialog, QDialog, QMenuBa
 # PYTORCH
 try:
     import torch
-    from torch.nn.functional import upsample
 except Exception as e:
     print("Incompatible version between pytorch, cuda and python.\n" +
           "Knowing working version combinations are\n: Cuda 10.0, pytorch 1.0.0, python 3.6.8" + str(e))
    # exit()
 
-from collections import OrderedDict
-
-# DEEP EXTREME
-import models.deeplab_resnet as resnet
-from models.dataloaders import helpers as helpers
-
 import models.training as training
 
 
@@ -69,17 +62,22 @@ from source.QtTYNWidget import QtTYNWidget
 from source.QtComparePanel import QtComparePanel
 from source.Blob import Blob
 from source.Annotation import Annotation
+from source import BinaryProject
+from source.Autosave import AutosaveJournal
+from source.MapImage import MapImage, MapPyramid
+from source.MapLoader import MapLoader
 from source.MapClassifier import MapClassifier
+from source.ClassifierWorker import ClassifierWorker
+from source.DeepExtremeModel import DeepExtremeModel
+from source.DeepExtremeWorker import DeepExtremeWorker
 #from source.MapClassifierScores import MapClassifier
 from source import utils
 
 # LOGGING
 import logging
 
-# configure the logger
-now = datetime.datetime.now()
-LOG_FILENAME = "tool" + now.strftime("%Y-%m-%d-%H-%M") + ".log"
-logging.basicConfig(level=logging.DEBUG, filemode='w', filename=LOG_FILENAME, format = '%(asctime)s %(levelname)-8s %(message)s')
+# the logger is configured when the application starts (see below), not when this module is imported
+# (e.g. by the processes of the classification and blob extraction pools)
 logfile = logging.getLogger("tool-logger")
 
 
@@ -361,6 +359,9 @@ class TagLab(QWidget):
         self.img_thumb_map = None
         self.img_overlay = QImage(16, 16, QImage.Format_RGB32)
 
+        # the map is loaded in background
+        self.map_loader = None
+
         # EVENTS
         self.labels_widget.visibilityChanged.connect(self.updateVisibility)
 
@@ -421,8 +422,18 @@ class TagLab(QWidget):
         self.extreme_pick_style = {'width': self.CROSS_LINE_WIDTH, 'color': Qt.red,  'size': 6}
 
         # NETWORKS
-        self.deepextreme_net = None
+
+        # the DeepExtreme network is loaded (in background) the first time the tool is activated
+        self.deepextreme_model = DeepExtremeModel(parent=self)
+        self.deepextreme_model.modelLoaded.connect(self.deepExtremeLoaded)
+
+        # queued 4-click segmentations (see queueDeepExtreme())
+        self.deepextreme_worker = None
+        self.deepextreme_pending = 0
+
         self.corals_classifier = None
+        self.classifier_worker = None
+        self.classifier_progress_bar = None
 
         # a dirty trick to adjust all the size..
         self.showMinimized()
@@ -432,6 +443,7 @@ class TagLab(QWidget):
 
         # autosave timer
         self.timer = None
+        self.autosave_journal = None
 
         self.move()
 
@@ -466,13 +478,56 @@ class TagLab(QWidget):
 
         self.timer = QTimer(self)
         self.timer.timeout.connect(self.autosave)
-        #self.timer.start(1800000)  # save every 3 minute
-        self.timer.start(600000)  # save every 3 minute
+        # only the changes are saved, so the autosave is cheap and can be frequent
+        self.timer.start(60000)  # save every minute
+
+    def resetAutosave(self, base_filename, keep_changes=False):
+        """
+        Restart the autosave journal of the current project. The changes saved in the journal refer to the
+        given project file; if it is None all the blobs not yet autosaved are considered as changed.
+        """
+
+        if self.autosave_journal is not None and self.autosave_journal.project_name != self.project_name:
+            self.autosave_journal.stop()
+            self.autosave_journal = None
+
+        if self.autosave_journal is None:
+            self.autosave_journal = AutosaveJournal(self.project_name)
+
+        if base_filename is not None:
+            self.annotations.clearChanges()
+
+        self.autosave_journal.reset(base_filename, self.projectInfo(), keep_changes)
+
+        if self.timer is None:
+            self.activateAutosave()
 
     @pyqtSlot()
     def autosave(self):
-        filename, file_extension = os.path.splitext(self.project_name)
-        self.save(filename + "_autosave.json")
+
+        # nothing to autosave while no project is open
+        if self.project_name == "NONE":
+            return
+
+        if self.autosave_journal is None or self.autosave_journal.project_name != self.project_name:
+            self.resetAutosave(None)
+
+        # the blobs are converted here, they are written by the thread of the journal
+        records = self.annotations.takeChanges()
+        if len(records) > 0:
+            self.autosave_journal.append(records, self.projectInfo())
+
+    def stopAutosave(self):
+
+        if self.timer is not None:
+            self.timer.stop()
+            self.timer.deleteLater()
+            self.timer = None
+
+        if self.autosave_journal is not None:
+            self.autosave()
+            self.autosave_journal.stop()
+            self.autosave_journal = None
 
     # call by pressing right button
     def openContextMenu(self, position):
@@ -647,6 +702,10 @@ class TagLab(QWidget):
         #aboutAct.setStatusTip("About")
         aboutAct.triggered.connect(self.about)
 
+        self.deepExtremeQueueAct = QAction("Queue 4-click Segmentations", self)
+        self.deepExtremeQueueAct.setCheckable(True)
+        self.deepExtremeQueueAct.setStatusTip("Segment the corals in background, while the points of the next corals are picked")
+
         menubar = QMenuBar()
         menubar.setAutoFillBackground(True)
 
@@ -711,6 +770,9 @@ class TagLab(QWidget):
         editmenu.addAction(self.refineActionDilate)
         editmenu.addAction(self.refineActionErode)
 
+        editmenu.addSeparator()
+        editmenu.addAction(self.deepExtremeQueueAct)
+
         helpmenu = menubar.addMenu("&Help")
         helpmenu.setStyleSheet(styleMenu)
         helpmenu.addAction(helpAct)
@@ -775,7 +837,8 @@ class TagLab(QWidget):
             elif self.tool_used == "DEEPEXTREME":
                 self.resetPickPoints()
             elif self.tool_used == "AUTOCLASS":
-                self.corals_classifier.stopProcessing()
+                if self.classifier_worker is not None:
+                    self.classifier_worker.stop()
 
             self.tool_used = self.tool_orig
 
@@ -951,6 +1014,9 @@ class TagLab(QWidget):
 
             elif self.tool_used == "SPLITBLOB" and self.pick_points_number > 1 and len(self.selected_blobs) == 1:
 
+                if self.mapIsLoading():
+                    return
+
                 selected_blob = self.selected_blobs[0]
                 points = self.pick_points
                 created_blobs = self.annotations.splitBlob(self.img_map,selected_blob, points)
@@ -1026,6 +1092,9 @@ class TagLab(QWidget):
     @pyqtSlot(float, float)
     def updateMainView(self, x, y):
 
+        if self.img_map is None:
+            return
+
         zf = self.viewerplus.zoom_factor
 
         xmap = float(self.img_map.width()) * x
@@ -1072,6 +1141,13 @@ class TagLab(QWidget):
 
     def resetAll(self):
 
+        self.stopMapLoading()
+        self.stopClassification()
+        self.stopDeepExtremeQueue()
+
+        # the changes not yet autosaved are written to the journal of the project being closed
+        self.stopAutosave()
+
         if self.img_map is not None:
             del self.img_map
             self.img_map = None
@@ -1323,11 +1399,6 @@ class TagLab(QWidget):
         self.resetTools()
         self.resetSelection()
 
-        if self.deepextreme_net is None:
-            self.resetNetworks()
-            self.infoWidget.setInfoMessage("Loading deepextreme network..")
-            self.loadingDeepExtremeNetwork()
-
         self.btnDeepExtreme.setChecked(True)
         self.tool_used = self.tool_orig = "DEEPEXTREME"
 
@@ -1336,9 +1407,25 @@ class TagLab(QWidget):
         self.viewerplus.disablePan()
         self.viewerplus.enableZoom()
 
-        self.infoWidget.setInfoMessage("4-click tool is active")
+        if self.deepextreme_model.isLoaded():
+            self.infoWidget.setInfoMessage("4-click tool is active")
+        else:
+            self.infoWidget.setInfoMessage("4-click tool is active (loading deepextreme network..)")
+            self.deepextreme_model.load()
+
         logfile.info("[TOOL][DEEPEXTREME] Tool activated")
 
+    @pyqtSlot(bool)
+    def deepExtremeLoaded(self, loaded):
+
+        if loaded:
+            logfile.info("[TOOL][DEEPEXTREME] Network loaded")
+            if self.tool_used == "DEEPEXTREME":
+                self.infoWidget.setInfoMessage("4-click tool is active")
+        else:
+            logfile.info("[TOOL][DEEPEXTREME] Network not loaded: " + str(self.deepextreme_model.error))
+            self.infoWidget.setWarningMessage("The deepextreme network cannot be loaded.")
+
 
     def addToSelectedList(self, blob):
         """
@@ -1359,6 +1446,25 @@ class TagLab(QWidget):
         self.viewerplus.scene.invalidate()
 
 
+    def addManyToSelectedList(self, blobs):
+        """
+        Add the given blobs to the list of selected blobs. The scene is updated only once.
+        """
+
+        already_selected = set(id(blob) for blob in self.selected_blobs)
+
+        for blob in blobs:
+            if id(blob) not in already_selected:
+                self.selected_blobs.append(blob)
+                already_selected.add(id(blob))
+
+            if blob.qpath_gitem is not None:
+                blob.qpath_gitem.setPen(self.border_selected_pen)
+
+        logfile.info("[SELECTION] {:d} blobs have been selected.".format(len(blobs)))
+
+        self.viewerplus.scene.invalidate()
+
     def removeFromSelectedList(self, blob):
         try:
             #safer if iterting over selected_blobs and calling this function.
@@ -1378,6 +1484,7 @@ class TagLab(QWidget):
 
             for blob in self.selected_blobs:
                 blob.note = self.editNote.toPlainText()
+                self.annotations.markChanged(blob)
 
     def updatePanelInfo(self, blob):
 
@@ -1706,6 +1813,9 @@ class TagLab(QWidget):
         if self.refine_grow != 0 and self.refine_original_mask is None:
             return
 
+        if self.mapIsLoading():
+            return
+
 
         # padding mask to allow moving boundary
         padding = 35
@@ -1731,8 +1841,7 @@ class TagLab(QWidget):
             bbox[2] += 2*padding; #width
             bbox[3] += 2*padding; #height
 
-            img = utils.cropQImage(self.img_map, bbox)
-            img = utils.qimageToNumpyArray(img)
+            img = utils.cropToRGB(self.img_map, bbox)
 
             #try:
             #    from coraline.Coraline import segment
@@ -1818,6 +1927,7 @@ class TagLab(QWidget):
         self.undo_operation['class'].append((blob, blob.class_name))
         self.undo_operation['newclass'].append((blob,class_name))
         blob.class_name = class_name
+        self.annotations.markChanged(blob)
 
         if class_name == "Empty":
             blob.class_color = [255, 255, 255]
@@ -1870,6 +1980,7 @@ class TagLab(QWidget):
 
         for (blob, class_name) in operation['class']:
             blob.class_name = class_name
+            self.annotations.markChanged(blob)
             brush = self.classBrushFromName(blob)
             blob.qpath_gitem.setBrush(brush)
 
@@ -1896,6 +2007,7 @@ class TagLab(QWidget):
 
         for (blob, class_name) in operation['newclass']:
             blob.class_name = class_name
+            self.annotations.markChanged(blob)
             brush = self.classBrushFromName(blob)
             blob.qpath_gitem.setBrush(brush)
 
@@ -2034,7 +2146,7 @@ class TagLab(QWidget):
                 xpos = self.viewerplus.clicked_x
                 ypos = self.viewerplus.clicked_y
 
-                if self.crackWidget is None:
+                if self.crackWidget is None and not self.mapIsLoading():
 
                     #copy blob, for undo reasons.
                     blob = selected_blob.copy()
@@ -2094,7 +2206,10 @@ class TagLab(QWidget):
 
                 # APPLY DEEP EXTREME
                 if self.pick_points_number == 4:
-                    self.segmentWithDeepExtreme()
+                    if self.deepExtremeQueueAct.isChecked():
+                        self.queueDeepExtreme()
+                    else:
+                        self.segmentWithDeepExtreme()
                     self.resetPickPoints()
 
             else:
@@ -2160,16 +2275,25 @@ class TagLab(QWidget):
         sx = self.dragSelectionStart[0]
         sy = self.dragSelectionStart[1]
         self.resetSelection()
-        for blob in self.annotations.seg_blobs:
-            visible = self.labels_widget.isClassVisible(blob.class_name)
-            if not visible:
-                continue
-            box = blob.bbox
 
-            if sx > box[1] or sy > box[0] or x < box[1] + box[2] or y < box[0] + box[3]:
-                continue
-            self.addToSelectedList(blob)
-        return
+        # the rectangle can be dragged in any direction
+        left = min(sx, x)
+        top = min(sy, y)
+        width = abs(x - sx)
+        height = abs(y - sy)
+
+        # the visibility of each class is checked only once
+        visibility = {}
+        blobs = []
+        for blob in self.annotations.blobsInsideRect(top, left, width, height):
+            visible = visibility.get(blob.class_name)
+            if visible is None:
+                visible = self.labels_widget.isClassVisible(blob.class_name)
+                visibility[blob.class_name] = visible
+            if visible:
+                blobs.append(blob)
+
+        self.addManyToSelectedList(blobs)
 
 
 
@@ -2283,51 +2407,91 @@ class TagLab(QWidget):
             self.loadMap()
 
     def loadMap(self):
+        """
+        Start the loading of the map in background. The map is displayed progressively, from the coarsest
+        level of its pyramid to the full resolution; meanwhile the annotations can be drawn and inspected.
+        """
 
-        # retrieve image size
-        image_reader = QImageReader(self.map_image_filename)
-        sizeOfImage = image_reader.size()
-        height = sizeOfImage.height()
-        width = sizeOfImage.width()
+        self.stopMapLoading()
+        self.stopDeepExtremeQueue()
 
-        if width > 32767 or height > 32767:
+        self.img_map = None
+        self.img_thumb_map = None
 
-            self.infoWidget.setInfoMessage("Map is too big (!)")
+        self.infoWidget.setInfoMessage("Map is loading..")
 
-            msgBox = QMessageBox()
-            msgBox.setWindowTitle(self.TAGLAB_VERSION)
-            msgBox.setText("This map exceeds the image dimension handled by TagLab (the maximum size is 32767 x 32767).")
-            msgBox.exec()
+        # only the header of the map is read here, so the scene can be prepared before the decoding
+        size = QImageReader(self.map_image_filename).size()
 
-        else:
+        # the map is stored out-of-core, so its size is not limited by the maximum size of a QImage;
+        # its pyramid is cached next to the map file, so only the first load decodes the map
+        self.map_loader = MapLoader(self.map_image_filename, self.MAP_VIEWER_SIZE, parent=self)
+        self.map_loader.thumbnailLoaded.connect(self.mapThumbnailLoaded)
+        self.map_loader.mapLoaded.connect(self.mapLoaded)
 
-            QApplication.setOverrideCursor(Qt.WaitCursor)
+        if size.isValid():
+            self.viewerplus.setImageSize(size.width(), size.height())
+            self.map_loader.levelLoaded.connect(self.viewerplus.setImageLevel)
 
-            # load map and set it
-            self.infoWidget.setInfoMessage("Map is loading..")
+        self.map_loader.start()
 
-            self.img_map = QImage(self.map_image_filename)
+    def stopMapLoading(self):
 
-            if self.img_map.isNull():
-                msgBox = QMessageBox()
-                msgBox.setText("Could not load or find the image: " + self.map_image_filename)
-                msgBox.exec()
-                return
+        if self.map_loader is not None:
+            self.map_loader.stop()
+            self.map_loader.deleteLater()
+            self.map_loader = None
+
+    def mapIsLoading(self):
+        """
+        Returns True (and warns the user) if the map is still being loaded in background.
+        """
 
-            self.img_thumb_map = self.img_map.scaled(self.MAP_VIEWER_SIZE, self.MAP_VIEWER_SIZE, Qt.KeepAspectRatio, Qt.SmoothTransformation)
-            self.viewerplus.setImage(self.img_map)
-            self.mapviewer.setImage(self.img_thumb_map)
-            self.viewerplus.viewUpdated.connect(self.updateMapViewer)
-            self.mapviewer.setOpacity(0.5)
+        if self.img_map is None and self.map_loader is not None:
+            self.infoWidget.setWarningMessage("The map is still loading, please wait.")
+            return True
 
-            QApplication.restoreOverrideCursor()
+        return False
+
+    @pyqtSlot(QImage)
+    def mapThumbnailLoaded(self, thumbnail):
+
+        self.img_thumb_map = thumbnail
+        self.mapviewer.setImage(self.img_thumb_map)
+        self.mapviewer.setOpacity(0.5)
+
+    @pyqtSlot(object)
+    def mapLoaded(self, pyramid):
 
-            self.infoWidget.setInfoMessage("The map has been successfully loading.")
+        self.map_loader.deleteLater()
+        self.map_loader = None
+
+        if pyramid is None:
+            msgBox = QMessageBox()
+            msgBox.setText("Could not load or find the image: " + self.map_image_filename)
+            msgBox.exec()
+            return
+
+        self.img_map = pyramid.level(0)
+        self.img_thumb_map = pyramid.thumbnail
+
+        # the current zoom is kept if the scene has been already prepared for the map
+        if self.viewerplus.imgwidth == self.img_map.width() and self.viewerplus.imgheight == self.img_map.height():
+            self.viewerplus.updateImage(self.img_map, levels=pyramid.levels)
+        else:
+            self.viewerplus.setImage(self.img_map, levels=pyramid.levels)
+
+        self.mapviewer.setImage(self.img_thumb_map)
+        self.viewerplus.viewUpdated.connect(self.updateMapViewer)
+        self.mapviewer.setOpacity(0.5)
+        self.updateMapViewer()
+
+        self.infoWidget.setInfoMessage("The map has been successfully loading.")
 
     @pyqtSlot()
     def openProject(self):
 
-        filters = "ANNOTATION PROJECT (*.json)"
+        filters = "ANNOTATION PROJECT (*.json *.tlb)"
 
         filename, _ = QFileDialog.getOpenFileName(self, "Open a project", self.taglab_dir, filters)
 
@@ -2351,7 +2515,7 @@ class TagLab(QWidget):
     @pyqtSlot()
     def saveAsProject(self):
 
-        filters = "ANNOTATION PROJECT (*.json)"
+        filters = "ANNOTATION PROJECT (*.json) ;; BINARY ANNOTATION PROJECT (*.tlb)"
         filename, _ = QFileDialog.getSaveFileName(self, "Save the project", self.taglab_dir, filters)
 
         if filename:
@@ -2366,7 +2530,7 @@ class TagLab(QWidget):
         Opens a previously saved project and append the annotations to the current ones.
         """
 
-        filters = "ANNOTATION PROJECT (*.json)"
+        filters = "ANNOTATION PROJECT (*.json *.tlb)"
         filename, _ = QFileDialog.getOpenFileName(self, "Open a project", self.taglab_dir, filters)
         if filename:
             self.append(filename, append_to_current=True)
@@ -2377,7 +2541,7 @@ class TagLab(QWidget):
         Opens a previously saved project and put the annotations into a different layer for comparison purposes.
         """
 
-        filters = "ANNOTATION PROJECT (*.json)"
+        filters = "ANNOTATION PROJECT (*.json *.tlb)"
         filename, _ = QFileDialog.getOpenFileName(self, "Open a project", self.taglab_dir, filters)
         if filename:
             self.append(filename, append_to_current=False)
@@ -2430,6 +2594,9 @@ class TagLab(QWidget):
         Import a label map
         """
 
+        if self.mapIsLoading():
+            return
+
         filters = "Image (*.png *.jpg)"
         filename, _ = QFileDialog.getOpenFileName(self, "Input Map File", "", filters)
         if not filename:
@@ -2458,6 +2625,9 @@ class TagLab(QWidget):
     @pyqtSlot()
     def exportAnnAsMap(self):
 
+        if self.mapIsLoading():
+            return
+
         filters = "PNG (*.png) ;; All Files (*)"
         filename, _ = QFileDialog.getSaveFileName(self, "Output file", "", filters)
 
@@ -2487,6 +2657,9 @@ class TagLab(QWidget):
     @pyqtSlot()
     def exportAnnAsTrainingDataset(self):
 
+        if self.mapIsLoading():
+            return
+
         folderName = QFileDialog.getExistingDirectory(self, "Choose Export Folder", "")
         if folderName:
             self.annotations.export_new_dataset(self.img_map, tile_size=1026, step=513, output_folder=folderName)
@@ -2635,12 +2808,12 @@ class TagLab(QWidget):
 
         QApplication.setOverrideCursor(Qt.WaitCursor)
 
-        f = open(filename, "r")
         try:
-            loaded_dict = json.load(f)
-        except json.JSONDecodeError as e:
+            (loaded_dict, blobs) = BinaryProject.loadProject(filename)
+        except ValueError as e:
+            QApplication.restoreOverrideCursor()
             msgBox = QMessageBox()
-            msgBox.setText("The json project contains an error:\n {0}\n\nPlease contact us.".format(str(e)))
+            msgBox.setText("The project contains an error:\n {0}\n\nPlease contact us.".format(str(e)))
             msgBox.exec()
             return
 
@@ -2657,13 +2830,11 @@ class TagLab(QWidget):
         self.map_acquisition_date = loaded_dict["Acquisition Date"]
         self.map_px_to_mm_factor = float(loaded_dict["Map Scale"])
 
-        f.close()
-
-        for blob_dict in loaded_dict["Segmentation Data"]:
+        # old projects can contain blobs with the same id
+        renumbered = self.annotations.renumberBlobs(blobs)
 
-            blob = Blob(None, 0, 0, 0)
-            blob.fromDict(blob_dict)
-            self.annotations.seg_blobs.append(blob)
+        for blob in blobs:
+            self.annotations.addBlob(blob)
 
         QApplication.restoreOverrideCursor()
 
@@ -2674,8 +2845,8 @@ class TagLab(QWidget):
         for blob in self.annotations.seg_blobs:
             self.drawBlob(blob)
 
-        if self.timer is None:
-            self.activateAutosave()
+        # the changes are journaled with respect to the loaded file (unless the ids have been changed)
+        self.resetAutosave(None if renumbered else filename, keep_changes=True)
 
         self.infoWidget.setInfoMessage("The given project has been successfully open.")
 
@@ -2691,37 +2862,29 @@ class TagLab(QWidget):
 
         QApplication.setOverrideCursor(Qt.WaitCursor)
 
-        f = open(filename, "r")
         try:
-            loaded_dict = json.load(f)
-        except json.JSONDecodeError as e:
+            (loaded_dict, blobs) = BinaryProject.loadProject(filename)
+        except ValueError as e:
+            QApplication.restoreOverrideCursor()
             msgBox = QMessageBox()
-            msgBox.setText("The json project contains an error:\n {0}\n\nPlease contact us.".format(str(e)))
+            msgBox.setText("The project contains an error:\n {0}\n\nPlease contact us.".format(str(e)))
             msgBox.exec()
             return
 
-        f.close()
-
         if append_to_current:
 
-            for blob_dict in loaded_dict["Segmentation Data"]:
-                blob = Blob(None, 0, 0, 0)
-                blob.fromDict(blob_dict)
-                self.annotations.seg_blobs.append(blob)
+            self.annotations.renumberBlobs(blobs)
+
+            for blob in blobs:
+                self.annotations.addBlob(blob)
                 self.drawBlob(blob)
         else:
 
             self.compare_panel.addProject(filename)
 
-            blob_list = []
-            for blob_dict in loaded_dict["Segmentation Data"]:
-                blob = Blob(None, 0, 0, 0)
-                blob.fromDict(blob_dict)
-                blob_list.append(blob)
-
-            self.annotations.prev_blobs.append(blob_list)
+            self.annotations.prev_blobs.append(blobs)
 
-            for blob in blob_list:
+            for blob in blobs:
                 self.drawBlob(blob, prev=True)
 
         QApplication.restoreOverrideCursor()
@@ -2729,37 +2892,38 @@ class TagLab(QWidget):
         self.infoWidget.setInfoMessage("The annotations of the given project has been successfully loaded.")
 
 
-    def save(self, filename):
+    def projectInfo(self):
         """
-        Save the current project.
+        The information of the project saved together with the blobs.
         """
 
-        QApplication.setOverrideCursor(Qt.WaitCursor)
-
-        dict_to_save = {}
+        dict_info = {}
 
         # update project name
         dir = QDir(self.taglab_dir)
 
-        dict_to_save["Map File"] = dir.relativeFilePath(self.map_image_filename)
-        dict_to_save["Acquisition Date"] = self.map_acquisition_date
-        dict_to_save["Map Scale"] = self.map_px_to_mm_factor
-        dict_to_save["Segmentation Data"] = [] # a list of blobs, each blob is a dictionary
+        dict_info["Map File"] = dir.relativeFilePath(self.map_image_filename)
+        dict_info["Acquisition Date"] = self.map_acquisition_date
+        dict_info["Map Scale"] = self.map_px_to_mm_factor
 
-        for blob in self.annotations.seg_blobs:
-            dict = blob.toDict()
-            dict_to_save["Segmentation Data"].append(dict)
+        return dict_info
 
-        str = json.dumps(dict_to_save)
+    def save(self, filename):
+        """
+        Save the current project.
+        """
+
+        QApplication.setOverrideCursor(Qt.WaitCursor)
 
-        f = open(filename, "w")
-        f.write(str)
-        f.close()
+        dict_to_save = self.projectInfo()
+
+        # the blobs are saved in the JSON format or in the binary one (.tlb), according to the extension
+        BinaryProject.saveProject(filename, dict_to_save, self.annotations.seg_blobs)
 
         QApplication.restoreOverrideCursor()
 
-        if self.timer is None:
-            self.activateAutosave()
+        # the autosave restarts from the saved project
+        self.resetAutosave(filename)
 
         self.infoWidget.setInfoMessage("Current project has been successfully saved.")
 
@@ -2769,20 +2933,18 @@ class TagLab(QWidget):
 
     def resetNetworks(self):
 
-        torch.cuda.empty_cache()
-
-        if self.deepextreme_net is not None:
-            del self.deepextreme_net
-            self.deepextreme_net = None
+        # the DeepExtreme network stays in memory (see DeepExtremeModel)
 
         if self.corals_classifier is not None:
             del self.corals_classifier
             self.corals_classifier = None
 
+        torch.cuda.empty_cache()
+
     @pyqtSlot()
     def selectClassifier(self):
 
-        if self.available_classifiers == "None":
+        if self.available_classifiers == "None" or self.mapIsLoading() or self.classificationIsRunning():
             self.btnAutoClassification.setChecked(False)
         else:
             self.classifierWidget = QtClassifierWidget(self.available_classifiers, parent=self)
@@ -2799,6 +2961,10 @@ class TagLab(QWidget):
 
             classifier_selected = self.classifierWidget.selected()
 
+            roi = self.classificationROI(self.classifierWidget.area())
+            if roi is False:
+                return
+
             # free GPU memory
             self.resetNetworks()
 
@@ -2808,216 +2974,254 @@ class TagLab(QWidget):
 
             self.tool_used = "AUTOCLASS"
 
-            progress_bar = QtProgressBarCustom(parent=self)
-            progress_bar.setWindowFlags(Qt.ToolTip | Qt.CustomizeWindowHint)
-            progress_bar.setWindowModality(Qt.NonModal)
+            self.classifier_progress_bar = QtProgressBarCustom(parent=self)
+            self.classifier_progress_bar.setWindowFlags(Qt.ToolTip | Qt.CustomizeWindowHint)
+            self.classifier_progress_bar.setWindowModality(Qt.NonModal)
             pos = self.viewerplus.pos()
-            progress_bar.move(pos.x()+15, pos.y()+30)
-            progress_bar.show()
+            self.classifier_progress_bar.move(pos.x()+15, pos.y()+30)
+            self.classifier_progress_bar.show()
 
             # setup the desired classifier
 
             self.infoWidget.setInfoMessage("Setup automatic classification..")
 
-            progress_bar.hidePerc()
-            progress_bar.setMessage("Setup automatic classification..")
+            self.classifier_progress_bar.hidePerc()
+            self.classifier_progress_bar.setMessage("Setup automatic classification..")
             QApplication.processEvents()
 
             message = "[AUTOCLASS] Automatic classification STARTS.. (classifier: )" + classifier_selected['Classifier Name']
             logfile.info(message)
 
-            progress_bar.showPerc()
             self.corals_classifier = MapClassifier(classifier_selected, self.labels)
-            self.corals_classifier.updateProgress.connect(progress_bar.setProgress)
-
-            # rescaling the map to fit the target scale of the network
-
-            progress_bar.hidePerc()
-            progress_bar.setMessage("Map rescaling..")
-            QApplication.processEvents()
+            self.corals_classifier.updateProgress.connect(self.classifier_progress_bar.setProgress)
 
             target_scale_factor = classifier_selected['Scale']
             scale_factor = target_scale_factor / self.map_px_to_mm_factor
 
-            w = self.img_map.width() * scale_factor
-            h = self.img_map.height() * scale_factor
+            # runs the classifier in background
+            self.infoWidget.setInfoMessage("Automatic classification is running..")
 
-            input_img_map = self.img_map.scaled(w, h, Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+            self.classifier_worker = ClassifierWorker(self.corals_classifier, self.img_map, scale_factor,
+                                                      self.annotations, roi=roi,
+                                                      map_filename=self.map_image_filename, parent=self)
+            self.classifier_worker.statusChanged.connect(self.classificationStatus)
+            self.classifier_worker.classificationDone.connect(self.classificationDone)
+            self.classifier_worker.start()
 
-            progress_bar.showPerc()
-            progress_bar.setMessage("Classification: ")
-            progress_bar.setProgress(0.0)
-            QApplication.processEvents()
+    def classificationROI(self, area):
+        """
+        The region of interest of the classification (a polygon in map coordinates), None for the whole map
+        and False if the area is not valid.
+        """
 
-            # runs the classifier
-            self.infoWidget.setInfoMessage("Automatic classification is running..")
+        if area == "Visible area":
+            topleft = self.viewerplus.mapToScene(QPoint(0, 0))
+            bottomright = self.viewerplus.mapToScene(self.viewerplus.viewport().rect().bottomRight())
 
-            self.corals_classifier.run(input_img_map, 768, 512, 128)
+            left = max(0.0, topleft.x())
+            top = max(0.0, topleft.y())
+            right = min(float(self.img_map.width()), bottomright.x())
+            bottom = min(float(self.img_map.height()), bottomright.y())
 
-            if self.corals_classifier.flagStopProcessing is False:
+            if right <= left or bottom <= top:
+                self.infoWidget.setWarningMessage("The map is not visible.")
+                return False
 
-                # import generated label map
-                progress_bar.hidePerc()
-                progress_bar.setMessage("Finalizing classification results..")
-                QApplication.processEvents()
+            return np.array([[left, top], [right, top], [right, bottom], [left, bottom]])
 
-                filename = os.path.join("temp", "labelmap.png")
-                created_blobs = self.annotations.import_label_map(filename, self.img_map)
-                for blob in created_blobs:
-                    self.addBlob(blob, selected=False)
+        elif area == "Selected region":
+            if len(self.selected_blobs) != 1:
+                self.infoWidget.setWarningMessage("Select one region to classify the area inside it.")
+                return False
 
-                logfile.info("[AUTOCLASS] Automatic classification ENDS.")
+            return self.selected_blobs[0].contour.copy()
 
-                # free GPU memory
-                self.resetNetworks()
+        return None
 
-                if self.corals_classifier:
-                    del self.corals_classifier
-                    self.corals_classifier = None
+    @pyqtSlot(str, bool)
+    def classificationStatus(self, message, show_perc):
 
-                if progress_bar:
-                    progress_bar.close()
-                    del progress_bar
+        if self.classifier_progress_bar is None:
+            return
 
-                # save and close
-                msgBox = QMessageBox()
-                msgBox.setWindowTitle(self.TAGLAB_VERSION)
-                msgBox.setText(
-                    "Automatic classification is finished. TagLab will be close. Please, click ok and save the project.")
-                msgBox.exec()
+        if show_perc:
+            self.classifier_progress_bar.showPerc()
+            self.classifier_progress_bar.setProgress(0.0)
+        else:
+            self.classifier_progress_bar.hidePerc()
 
-                self.saveAsProject()
+        self.classifier_progress_bar.setMessage(message)
 
-                QApplication.quit()
+    @pyqtSlot(object)
+    def classificationDone(self, created_blobs):
 
-            else:
+        if created_blobs is not None:
+
+            # the new blobs replace the ones inside the classified region
+            roi = self.classifier_worker.roi
+            if roi is not None:
+                for blob in self.annotations.blobsInsidePolygon(roi):
+                    self.removeBlob(blob)
+
+            self.annotations.assignIds(created_blobs)
+            for blob in created_blobs:
+                self.addBlob(blob, selected=False)
 
-                logfile.info("[AUTOCLASS] Automatic classification STOP by the users.")
+            self.saveUndo()
+
+            message = "[AUTOCLASS] Automatic classification ENDS ({:.2f} tiles/sec).".format(self.corals_classifier.tiles_per_second)
+            logfile.info(message)
+            self.infoWidget.setInfoMessage("Automatic classification is finished (" + str(len(created_blobs)) + " regions created).")
 
-                # free GPU memory
-                self.resetNetworks()
+        elif self.classifier_worker.error is not None:
 
-                if self.corals_classifier:
-                    del self.corals_classifier
-                    self.corals_classifier = None
+            logfile.info("[AUTOCLASS] Automatic classification FAILED: " + self.classifier_worker.error)
+            self.infoWidget.setWarningMessage("Automatic classification failed: " + self.classifier_worker.error)
 
-                if progress_bar:
-                    progress_bar.close()
-                    del progress_bar
+        else:
+
+            logfile.info("[AUTOCLASS] Automatic classification STOP by the users.")
+            self.infoWidget.setInfoMessage("Automatic classification has been stopped.")
 
-                import gc
-                gc.collect()
+        self.stopClassification()
 
-                self.move()
+        import gc
+        gc.collect()
 
-    def loadingDeepExtremeNetwork(self):
+        if self.tool_used == "AUTOCLASS":
+            self.move()
 
-        # Initialization
-        modelName = 'dextr_corals'
+    def stopClassification(self, wait=True):
+        """
+        Stop the automatic classification (if any) and free the classifier. The blobs of a stopped
+        classification are discarded.
+        """
 
-        #  Create the network and load the weights
-        self.deepextreme_net = resnet.resnet101(1, nInputChannels=4, classifier='psp')
+        if self.classifier_worker is not None:
+            self.classifier_worker.classificationDone.disconnect(self.classificationDone)
+            self.classifier_worker.stop(wait=wait)
+            self.classifier_worker.deleteLater()
+            self.classifier_worker = None
 
-        models_dir = "models/"
+        if self.classifier_progress_bar is not None:
+            self.classifier_progress_bar.close()
+            self.classifier_progress_bar.deleteLater()
+            self.classifier_progress_bar = None
 
-        # dictionary layers' names - weights
-        state_dict_checkpoint = torch.load(os.path.join(models_dir, modelName + '.pth'),
-                                           map_location=lambda storage, loc: storage)
+        # free GPU memory
+        self.resetNetworks()
 
-        # Remove the prefix .module from the model when it is trained using DataParallel
-        if 'module.' in list(state_dict_checkpoint.keys())[0]:
-            new_state_dict = OrderedDict()
-            for k, v in state_dict_checkpoint.items():
-                name = k[7:]  # remove `module.` from multi-gpu training
-                new_state_dict[name] = v
-        else:
-            new_state_dict = state_dict_checkpoint
+    def classificationIsRunning(self):
+        """
+        Returns True (and warns the user) if the automatic classification is running.
+        """
 
-        self.deepextreme_net.load_state_dict(new_state_dict)
-        self.deepextreme_net.eval()
-        if not torch.cuda.is_available():
-            print("CUDA NOT AVAILABLE!")
+        if self.classifier_worker is not None:
+            self.infoWidget.setWarningMessage("The automatic classification is running, please wait (ESC to stop it).")
+            return True
+
+        return False
 
     def segmentWithDeepExtreme(self):
 
+        if self.mapIsLoading():
+            return
+
         QApplication.setOverrideCursor(Qt.WaitCursor)
 
         self.infoWidget.setInfoMessage("Segmentation is ongoing..")
 
         logfile.info("[TOOL][DEEPEXTREME] Segmentation begins..")
 
-        pad = 50
-        thres = 0.8
-        gpu_id = 0
-        device = torch.device("cuda:" + str(gpu_id) if torch.cuda.is_available() else "cpu")
-        self.deepextreme_net.to(device)
-
         extreme_points_to_use = np.asarray(self.pick_points).astype(int)
-        pad_extreme = 100
-        left_map_pos = extreme_points_to_use[:, 0].min() - pad_extreme
-        top_map_pos = extreme_points_to_use[:, 1].min() - pad_extreme
 
-        width_extreme_points = extreme_points_to_use[:, 0].max() - extreme_points_to_use[:, 0].min()
-        height_extreme_points = extreme_points_to_use[:, 1].max() - extreme_points_to_use[:, 1].min()
-        area_extreme_points = width_extreme_points * height_extreme_points
+        # Run a forward pass (it waits for the network if it is still loading)
+        try:
+            (inputs, context) = self.deepextreme_model.prepareInput(self.img_map, extreme_points_to_use)
+            outputs = self.deepextreme_model.predict(inputs)
+            (segm_mask, left_map_pos, top_map_pos, area_extreme_points) = self.deepextreme_model.segmentationMask(outputs[0], context)
+        except Exception as e:
+            logfile.info("[TOOL][DEEPEXTREME] Segmentation failed: " + str(e))
+            self.infoWidget.setWarningMessage("DeepExtreme segmentation failed: " + str(e))
+            QApplication.restoreOverrideCursor()
+            return
+
+        blobs = self.annotations.blobsFromMask(segm_mask, left_map_pos, top_map_pos, area_extreme_points)
+
+        for blob in blobs:
+            blob.deep_extreme_points = extreme_points_to_use
+
+        self.resetSelection()
+        for blob in blobs:
+            self.addBlob(blob, selected=True)
+            self.logBlobInfo(blob, "[TOOL][DEEPEXTREME][BLOB-CREATED]")
+        self.saveUndo()
 
-        (img, extreme_points_new) = utils.prepareForDeepExtreme(self.img_map, extreme_points_to_use, pad_extreme)
+        self.infoWidget.setInfoMessage("Segmentation done.")
 
-        with torch.no_grad():
+        logfile.info("[TOOL][DEEPEXTREME] Segmentation ends.")
 
-            extreme_points_ori = extreme_points_new.astype(int)
+        QApplication.restoreOverrideCursor()
 
-            #  Crop image to the bounding box from the extreme points and resize
-            bbox = helpers.get_bbox(img, points=extreme_points_ori, pad=pad, zero_pad=True)
-            crop_image = helpers.crop_from_bbox(img, bbox, zero_pad=True)
-            resize_image = helpers.fixed_resize(crop_image, (512, 512)).astype(np.float32)
+    def queueDeepExtreme(self):
+        """
+        Queue the segmentation of the picked points; it is computed in background (see DeepExtremeWorker)
+        and the blobs are added when it is ready.
+        """
 
-            #  Generate extreme point heat map normalized to image values
-            extreme_points = extreme_points_ori - [np.min(extreme_points_ori[:, 0]),
-                                                   np.min(extreme_points_ori[:, 1])] + [pad, pad]
+        if self.mapIsLoading():
+            return
 
-            # remap the input points inside the 512 x 512 cropped box
-            extreme_points = (512 * extreme_points * [1 / crop_image.shape[1], 1 / crop_image.shape[0]]).astype(
-                np.int)
+        if self.deepextreme_worker is None:
+            self.deepextreme_worker = DeepExtremeWorker(self.deepextreme_model, self.img_map, parent=self)
+            self.deepextreme_worker.segmentationDone.connect(self.deepExtremeDone)
+            self.deepextreme_worker.segmentationFailed.connect(self.deepExtremeFailed)
 
-            # create the heatmap
-            extreme_heatmap = helpers.make_gt(resize_image, extreme_points, sigma=10)
-            extreme_heatmap = helpers.cstm_normalize(extreme_heatmap, 255)
+        self.deepextreme_worker.addPoints(np.asarray(self.pick_points).astype(int))
+        self.deepextreme_pending += 1
 
-            #  Concatenate inputs and convert to tensor
-            input_dextr = np.concatenate((resize_image, extreme_heatmap[:, :, np.newaxis]), axis=2)
-            inputs = torch.from_numpy(input_dextr.transpose((2, 0, 1))[np.newaxis, ...])
+        self.infoWidget.setInfoMessage("Segmentation queued ({:d} pending).".format(self.deepextreme_pending))
+        logfile.info("[TOOL][DEEPEXTREME] Segmentation queued.")
 
-            # Run a forward pass
-            inputs = inputs.to(device)
-            outputs = self.deepextreme_net.forward(inputs)
-            outputs = upsample(outputs, size=(512, 512), mode='bilinear', align_corners=True)
-            outputs = outputs.to(torch.device('cpu'))
+    @pyqtSlot(object)
+    def deepExtremeDone(self, result):
 
-            pred = np.transpose(outputs.data.numpy()[0, ...], (1, 2, 0))
-            pred = 1 / (1 + np.exp(-pred))
-            pred = np.squeeze(pred)
-            result = helpers.crop2fullmask(pred, bbox, im_size=img.shape[:2], zero_pad=True, relax=pad) > thres
+        (extreme_points, segm_mask, left_map_pos, top_map_pos, area_extreme_points) = result
 
+        self.deepextreme_pending -= 1
 
-            segm_mask = result.astype(int)
+        blobs = self.annotations.blobsFromMask(segm_mask, left_map_pos, top_map_pos, area_extreme_points)
 
-            blobs = self.annotations.blobsFromMask(segm_mask, left_map_pos, top_map_pos, area_extreme_points)
+        for blob in blobs:
+            blob.deep_extreme_points = extreme_points
+            self.addBlob(blob, selected=False)
+            self.logBlobInfo(blob, "[TOOL][DEEPEXTREME][BLOB-CREATED]")
+        self.saveUndo()
 
-            for blob in blobs:
-                blob.deep_extreme_points = extreme_points_to_use
+        self.infoWidget.setInfoMessage("Segmentation done ({:d} pending).".format(self.deepextreme_pending))
+        logfile.info("[TOOL][DEEPEXTREME] Queued segmentation ends.")
 
-            self.resetSelection()
-            for blob in blobs:
-                self.addBlob(blob, selected=True)
-                self.logBlobInfo(blob, "[TOOL][DEEPEXTREME][BLOB-CREATED]")
-            self.saveUndo()
+    @pyqtSlot(str, int)
+    def deepExtremeFailed(self, message, discarded):
 
-            self.infoWidget.setInfoMessage("Segmentation done.")
+        self.deepextreme_pending -= discarded
 
-        logfile.info("[TOOL][DEEPEXTREME] Segmentation ends.")
+        logfile.info("[TOOL][DEEPEXTREME] Segmentation failed: " + message)
+        self.infoWidget.setWarningMessage("DeepExtreme segmentation failed: " + message)
 
-        QApplication.restoreOverrideCursor()
+    def stopDeepExtremeQueue(self):
+        """
+        Stop the queued segmentations (if any); the pending ones are discarded.
+        """
+
+        if self.deepextreme_worker is not None:
+            self.deepextreme_worker.segmentationDone.disconnect(self.deepExtremeDone)
+            self.deepextreme_worker.segmentationFailed.disconnect(self.deepExtremeFailed)
+            self.deepextreme_worker.stop()
+            self.deepextreme_worker.deleteLater()
+            self.deepextreme_worker = None
+
+        self.deepextreme_pending = 0
 
     def automaticSegmentation(self):
 
@@ -3026,6 +3230,11 @@ class TagLab(QWidget):
 
 if __name__ == '__main__':
 
+    # configure the logger
+    now = datetime.datetime.now()
+    LOG_FILENAME = "tool" + now.strftime("%Y-%m-%d-%H-%M") + ".log"
+    logging.basicConfig(level=logging.DEBUG, filemode='w', filename=LOG_FILENAME, format = '%(asctime)s %(levelname)-8s %(message)s')
+
     # Create the QApplication.
     app = QApplication(sys.argv)
 
@@ -3057,6 +3266,16 @@ if __name__ == '__main__':
     # Create the inspection tool
     tool = TagLab()
 
+    # the loading of the map and the classification must be stopped before the threads are destroyed
+    app.aboutToQuit.connect(tool.stopMapLoading)
+    app.aboutToQuit.connect(tool.stopClassification)
+    app.aboutToQuit.connect(tool.stopDeepExtremeQueue)
+    app.aboutToQuit.connect(tool.deepextreme_model.wait)
+    app.aboutToQuit.connect(MapClassifier.releaseNetworks)
+
+    # the changes not yet autosaved are written to the journal
+    app.aboutToQuit.connect(tool.stopAutosave)
+
     # Show the viewer and run the application.
     tool.show()
     sys.exit(app.exec_())
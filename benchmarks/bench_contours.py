@@ -0,0 +1,105 @@
+# TagLab
+# A semi-automatic segmentation tool
+#
+# Copyright(C) 2019
+# Visual Computing Lab
+# ISTI - Italian National Research Council
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License (http://www.gnu.org/licenses/gpl.txt)
+# for more details.
+
+""" Micro-benchmark of the contour extraction of the blobs (Blob.createContourFromMask()).
+
+It compares the current implementation (OpenCV) with the previous one (two scikit-image find_contours
+passes and per-point coordinate loops) on blobs of increasing size.
+
+Usage: python -m benchmarks.bench_contours
+"""
+
+import time
+import numpy as np
+from scipy import ndimage as ndi
+from skimage import measure
+
+from source.Blob import Blob
+
+
+def previousContours(mask, bbox):
+    """
+    The previous implementation of Blob.createContourFromMask() (outer contour and holes).
+    """
+
+    PADDED_SIZE = 4
+    img_padded = np.pad(mask, PADDED_SIZE, mode="constant")
+
+    contours = measure.find_contours(img_padded, 0.6)
+    inner_contours = measure.find_contours(img_padded, 0.4)
+
+    longest = max(range(len(contours)), key=lambda i: contours[i].shape[0])
+    inner_longest = max(range(len(inner_contours)), key=lambda i: inner_contours[i].shape[0])
+
+    contour = np.array(contours[longest])
+    holes = [np.array(c) for i, c in enumerate(inner_contours) if i != inner_longest and c.shape[0] > 20]
+
+    for c in [contour] + holes:
+        for i in range(c.shape[0]):
+            ycoor = c[i, 0]
+            xcoor = c[i, 1]
+            c[i, 0] = xcoor - PADDED_SIZE + bbox[1]
+            c[i, 1] = ycoor - PADDED_SIZE + bbox[0]
+
+    return (contour, holes)
+
+
+def coralMask(size, seed=0):
+    """
+    A blob-like mask (irregular border, some holes) of size x size pixels.
+    """
+
+    rng = np.random.default_rng(seed)
+    noise = ndi.gaussian_filter(rng.random((size, size)), size / 40.0)
+
+    y, x = np.mgrid[0:size, 0:size]
+    disk = ((x - size / 2.0) ** 2 + (y - size / 2.0) ** 2) < (size * 0.45) ** 2
+
+    mask = disk & (noise > np.percentile(noise, 10))
+    labels = measure.label(mask, connectivity=1)
+    largest = np.argmax(np.bincount(labels.ravel())[1:]) + 1
+
+    return (labels == largest).astype(int)
+
+
+def timeit(function, repetitions):
+
+    start = time.perf_counter()
+    for i in range(repetitions):
+        function()
+    return (time.perf_counter() - start) / repetitions
+
+
+if __name__ == "__main__":
+
+    blob = Blob(None, 0, 0, 0)
+
+    print("{:>6} {:>10} {:>12} {:>12} {:>8}".format("size", "holes", "previous", "current", "speedup"))
+
+    for size in [128, 512, 1024, 2048, 4096]:
+
+        mask = coralMask(size)
+        bbox = [0, 0, size, size]
+        repetitions = max(1, 2048 // size)
+
+        t_previous = timeit(lambda: previousContours(mask, bbox), repetitions)
+        t_current = timeit(lambda: blob.createContourFromMask(mask, bbox), repetitions)
+
+        print("{:>6} {:>10} {:>10.1f}ms {:>10.1f}ms {:>7.1f}x".format(size, len(blob.inner_contours),
+              t_previous * 1000.0, t_current * 1000.0, t_previous / t_current))
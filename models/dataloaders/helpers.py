@@ -68,6 +68,27 @@ def crop2fullmask(crop_mask, bbox, im=None, im_size=None, zero_pad=False, relax=
     return result
 
 
+def crop2localmask(crop_mask, bbox, im_size, relax=0, interpolation=cv2.INTER_CUBIC):
+    """
+    Same as crop2fullmask(crop_mask, bbox, im_size=im_size, zero_pad=True, relax=relax), but the mask is
+    returned only over the area it can cover (the bbox reduced by relax, inside the image), together with
+    the (x, y) position of this area in the image, instead of a mask of the size of the image.
+    """
+    x_min = max(bbox[0] + relax, 0)
+    y_min = max(bbox[1] + relax, 0)
+    x_max = min(bbox[2] - relax, im_size[1] - 1)
+    y_max = min(bbox[3] - relax, im_size[0] - 1)
+
+    if x_max < x_min or y_max < y_min:
+        return np.zeros((0, 0), dtype=crop_mask.dtype), (0, 0)
+
+    crop_mask = cv2.resize(crop_mask, (bbox[2] - bbox[0] + 1, bbox[3] - bbox[1] + 1), interpolation=interpolation)
+
+    local_mask = crop_mask[y_min - bbox[1]:y_max - bbox[1] + 1, x_min - bbox[0]:x_max - bbox[0] + 1]
+
+    return local_mask, (x_min, y_min)
+
+
 def overlay_mask(im, ma, colors=None, alpha=0.5):
     assert np.max(im) <= 1.0
     if colors is None:
@@ -302,6 +323,24 @@ def make_gt(img, labels, sigma=10, one_mask_per_point=False):
     return gt
 
 
+def make_heatmap(size, points, sigma=10):
+    """ Same as make_gt(img, points, sigma) for an image of the given size, but in float32 and faster:
+    the gaussians are separable, so each one is the outer product of two 1D gaussians.
+    """
+    h, w = size
+    coeff = np.float32(-4 * np.log(2) / sigma ** 2)
+
+    x = np.arange(0, w, 1, dtype=np.float32)
+    y = np.arange(0, h, 1, dtype=np.float32)
+
+    heatmap = np.zeros((h, w), dtype=np.float32)
+    for (x0, y0) in np.asarray(points).reshape(-1, 2):
+        gaussian = np.outer(np.exp(coeff * (y - y0) ** 2), np.exp(coeff * (x - x0) ** 2))
+        np.maximum(heatmap, gaussian, out=heatmap)
+
+    return heatmap
+
+
 def cstm_normalize(im, max_value):
     """
     Normalize image to range 0 - max_value
@@ -39,6 +39,9 @@ from scipy import ndimage as ndi
 from skimage.morphology import watershed, flood
 from skimage.filters import gaussian
 from source.Blob import Blob
+from source.BlobIndex import BlobIndex
+from source.BlobExtractor import BlobExtractor, ColorIndexMap
+from source.MapImage import MapImage
 import source.Mask as Mask
 
 
@@ -91,6 +94,9 @@ class Annotation(object):
         # list of all blobs
         self.seg_blobs = []
 
+        # spatial index of the blobs, it must be kept updated through addBlob() and removeBlob()
+        self.blob_index = BlobIndex()
+
         # annotations coming from previous years (for comparison, no editing is possible)
         self.prev_blobs = []
 
@@ -103,6 +109,10 @@ class Annotation(object):
         # progressive id of the blobs
         self.progressive_id = 0
 
+        # blobs changed since the last (auto)save, by id (see takeChanges())
+        self.blob_by_id = {}
+        self.changed_ids = set()
+
     def addGroup(self, blobs):
 
         id = len(self.groups)
@@ -112,10 +122,66 @@ class Annotation(object):
 
     def addBlob(self, blob):
         self.seg_blobs.append(blob)
+        self.blob_index.insert(blob)
+        self.blob_by_id[blob.id] = blob
+        self.changed_ids.add(blob.id)
 
     def removeBlob(self, blob):
         index = self.seg_blobs.index(blob)
         del self.seg_blobs[index]
+        self.blob_index.remove(blob)
+
+        # an edited blob is a copy with the same id, it can be added before the original is removed
+        if self.blob_by_id.get(blob.id) is blob:
+            del self.blob_by_id[blob.id]
+        self.changed_ids.add(blob.id)
+
+    def markChanged(self, blob):
+        """
+        To call when a blob is modified in place (e.g. its class or its note).
+        """
+        self.changed_ids.add(blob.id)
+
+    def takeChanges(self):
+        """
+        It returns the changes since the last call as a list of records: {"op": "put", "id", "version", "blob"}
+        for the blobs added or modified, {"op": "remove", "id"} for the blobs removed.
+        """
+
+        records = []
+        for id in sorted(self.changed_ids):
+            blob = self.blob_by_id.get(id)
+            if blob is None:
+                records.append({"op": "remove", "id": id})
+            else:
+                records.append({"op": "put", "id": id, "version": blob.version, "blob": blob.toDict()})
+
+        self.changed_ids.clear()
+        return records
+
+    def clearChanges(self):
+
+        self.changed_ids.clear()
+
+    def renumberBlobs(self, blobs):
+        """
+        Give a new id to the given blobs (not yet added) whose id is already used, and update the progressive id
+        so the ids of the blobs remain unique. It returns True if some blob has been renumbered.
+        """
+
+        used = set(blob.id for blob in self.seg_blobs)
+        next_id = max([self.progressive_id] + [id + 1 for id in used] + [blob.id + 1 for blob in blobs])
+
+        renumbered = False
+        for blob in blobs:
+            if blob.id in used:
+                blob.id = next_id
+                next_id += 1
+                renumbered = True
+            used.add(blob.id)
+
+        self.progressive_id = next_id
+        return renumbered
 
 
     def blobsFromMask(self, seg_mask, map_pos_x, map_pos_y, area_mask):
@@ -270,8 +336,7 @@ class Annotation(object):
         seeds = seeds.astype(int)
         mask = blob.getMask()
         box = blob.bbox
-        cropimg = utils.cropQImage(map, box)
-        cropimgnp = rgb2gray(utils.qimageToNumpyArray(cropimg))
+        cropimgnp = rgb2gray(utils.cropToRGB(map, box))
 
         edges = sobel(cropimgnp)
 
@@ -443,7 +508,8 @@ class Annotation(object):
 
         blobs_clicked = []
 
-        for blob in self.seg_blobs:
+        # only the blobs whose bounding box contains the point are tested
+        for blob in self.blob_index.blobsAt(x, y):
 
             point = np.array([[x, y]])
             out = measure.points_in_poly(point, blob.contour)
@@ -460,9 +526,39 @@ class Annotation(object):
 
         return selected_blob
 
+    def blobsInsideRect(self, top, left, width, height):
+        """
+        It returns the blobs whose bounding box lies inside the given rectangle.
+        """
+
+        blobs = []
+        for blob in self.blob_index.blobsInRect(top, left, width, height):
+            box = blob.bbox
+            if box[1] >= left and box[0] >= top and box[1] + box[2] <= left + width and box[0] + box[3] <= top + height:
+                blobs.append(blob)
 
+        return blobs
+
+    def blobsInsidePolygon(self, points):
+        """
+        It returns the blobs that lie inside the given polygon (points in x, y).
+        """
 
+        box = Mask.pointsBox(points)
+        box[2] += 1
+        box[3] += 1
 
+        mask = Mask.polygonMask(points, box)
+
+        blobs = []
+        for blob in self.blobsInsideRect(box[0], box[1], box[2], box[3]):
+            contour = blob.contour.round().astype(int)
+            x = np.clip(contour[:, 0] - box[1], 0, box[2] - 1)
+            y = np.clip(contour[:, 1] - box[0], 0, box[3] - 1)
+            if np.all(mask[y, x] == 1):
+                blobs.append(blob)
+
+        return blobs
 
     ###########################################################################
     ### IMPORT / EXPORT
@@ -470,51 +566,94 @@ class Annotation(object):
     def import_label_map(self, filename, reference_map):
         """
         It imports a label map and create the corresponding blobs.
-        The label map is rescaled such that it coincides with the reference map.
+        The label map is rescaled (nearest neighbour, stripe by stripe) such that it coincides with the
+        reference map, so its size is not limited by the maximum size of a QImage.
         """
 
-        qimg_label_map = QImage(filename)
-        qimg_label_map = qimg_label_map.convertToFormat(QImage.Format_RGB32)
+        label_map = MapImage.fromImageFile(filename)
+        if label_map is None:
+            return []
 
-        w = reference_map.width()
-        h = reference_map.height()
-        qimg_label_map = qimg_label_map.scaled(w, h, Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+        # RGB -> label code association (ok, it is a dirty trick but it saves time..);
+        # each color becomes an index, the black pixels are ignored
+        color_map = ColorIndexMap(label_map)
+        colors = color_map.colors
 
-        label_map = utils.qimageToNumpyArray(qimg_label_map)
-        label_map = label_map.astype(np.int32)
+        lut = np.arange(1, len(colors) + 1, dtype=np.int32)
+        lut[colors == 0] = 0
 
-        # RGB -> label code association (ok, it is a dirty trick but it saves time..)
-        label_coded = label_map[:, :, 0] + (label_map[:, :, 1] << 8) + (label_map[:, :, 2] << 16)
-
-        labels = measure.label(label_coded, connectivity=1)
+        # label code -> class name
+        class_names = {}
+        for label_name in self.labels_info.keys():
+            c = self.labels_info[label_name]
+            class_names[int(c[0]) + (int(c[1]) << 8) + (int(c[2]) << 16)] = label_name
 
         too_much_small_area = 1000
-        region_big = None
 
         created_blobs = []
-        for region in measure.regionprops(labels):
-            if region.area > too_much_small_area:
-                id = len(self.seg_blobs)
-                blob = Blob(region, 0, 0, self.progressive_id)
-                self.progressive_id += 1
+        size = (reference_map.height(), reference_map.width())
+        for (code, blob) in BlobExtractor(min_area=too_much_small_area).extract(color_map, lut, size=size):
+
+            # assign class
+            label_name = class_names.get(int(colors[code - 1]))
+            if label_name is not None:
+                blob.class_name = label_name
+                blob.class_color = self.labels_info[label_name]
 
-                # assign class
-                row = region.coords[0, 0]
-                col = region.coords[0, 1]
-                color = label_map[row, col]
+            created_blobs.append(blob)
 
-                for label_name in self.labels_info.keys():
-                    c = self.labels_info[label_name]
-                    if c[0] == color[0] and c[1] == color[1] and c[2] == color[2]:
-                        blob.class_name = label_name
-                        blob.class_color = c
-                        break
+        label_map.close()
 
-                created_blobs.append(blob)
+        self.assignIds(created_blobs)
 
         return created_blobs
 
 
+    def assignIds(self, blobs):
+        """
+        Give a progressive id to blobs created without it.
+        """
+
+        for blob in blobs:
+            blob.setId(self.progressive_id)
+            blob.instance_name = "coral" + str(self.progressive_id)
+            self.progressive_id += 1
+
+    def import_class_map(self, class_map, class_names, box, roi_mask=None):
+        """
+        It creates the blobs of a map of class indices (e.g. the output of the MapClassifier).
+        The map is rescaled (nearest neighbour, stripe by stripe) such that it coincides with the given box
+        (top, left, width, height) of the map. The Background pixels, the indices without a class name and the pixels outside
+        the roi mask (if any, same size of the box) are ignored.
+        The blobs are created without ids (it can run in background), see assignIds().
+        """
+
+        w = int(box[2])
+        h = int(box[3])
+
+        # class index -> class index + 1 (0 is the background)
+        lut = np.zeros(256, dtype=np.uint8)
+        for index, class_name in enumerate(class_names):
+            if class_name != "Background":
+                lut[index] = index + 1
+
+        too_much_small_area = 1000
+
+        created_blobs = []
+        extractor = BlobExtractor(min_area=too_much_small_area)
+        for (code, blob) in extractor.extract(class_map, lut, roi_mask, (int(box[0]), int(box[1])), (h, w)):
+
+            # assign class
+            class_name = class_names[code - 1]
+
+            if class_name in self.labels_info:
+                blob.class_name = class_name
+                blob.class_color = self.labels_info[class_name]
+
+            created_blobs.append(blob)
+
+        return created_blobs
+
     def export_data_table_for_Scripps(self, scale_factor, filename):
 
         # create a list of properties
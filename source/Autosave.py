@@ -0,0 +1,214 @@
+# TagLab
+# A semi-automatic segmentation tool
+#
+# Copyright(C) 2019
+# Visual Computing Lab
+# ISTI - Italian National Research Council
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License (http://www.gnu.org/licenses/gpl.txt)
+# for more details.
+
+import os
+import json
+import queue
+import logging
+import threading
+
+from source import BinaryProject
+
+
+class AutosaveJournal(object):
+    """
+    Incremental autosave of a project. Instead of saving the whole project, the blobs changed since the last
+    autosave are appended to a journal (<project>_autosave.journal, one JSON record per line) by a background
+    thread, so the cost of an autosave depends on the edits made and not on the size of the project.
+    The journal starts with a "base" record, the project file the changes refer to. When the journal becomes
+    long it is compacted: the base and the changes are merged in <project>_autosave.json (a regular JSON
+    project, that can be opened to recover the work) which becomes the new base of an empty journal.
+    """
+
+    # number of changes that triggers the compaction of the journal
+    COMPACTION_RECORDS = 5000
+
+    def __init__(self, project_name):
+
+        self.project_name = project_name
+
+        basename = os.path.splitext(project_name)[0]
+        self.journal_filename = basename + "_autosave.journal"
+        self.snapshot_filename = basename + "_autosave.json"
+
+        self.records_number = 0
+
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def reset(self, base_filename, project, keep_changes=False):
+        """
+        Start a new journal whose changes refer to the given project file (None for an empty project).
+        If keep_changes is True and the current journal contains changes, they are compacted first, so the
+        work of a previous session (e.g. after a crash) remains in the autosave project.
+        """
+
+        if base_filename is not None:
+            base_filename = os.path.abspath(base_filename)
+
+        self.queue.put(("reset", base_filename, project, keep_changes))
+
+    def append(self, records, project):
+        """
+        Append the given changes (see Annotation.takeChanges()) to the journal.
+        """
+
+        self.queue.put(("append", records, project))
+
+    def stop(self):
+        """
+        Write the pending changes and stop the background thread.
+        """
+
+        self.queue.put(None)
+        self.thread.join()
+
+    def run(self):
+
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+
+            try:
+                if item[0] == "reset":
+                    (_, base_filename, project, keep_changes) = item
+                    if keep_changes and self.journalHasChanges():
+                        self.compact()
+                    self.startJournal(base_filename, project)
+
+                elif item[0] == "append":
+                    (_, records, project) = item
+                    self.writeRecords(records, project)
+                    if self.records_number > self.COMPACTION_RECORDS:
+                        self.compact()
+
+            except Exception:
+                # the thread must survive, otherwise the following changes would never be written
+                logging.getLogger(__name__).exception("Autosave failed")
+
+    def startJournal(self, base_filename, project):
+
+        with open(self.journal_filename, "w") as f:
+            f.write(json.dumps({"op": "base", "file": base_filename, "project": project}) + "\n")
+
+        self.records_number = 0
+
+    def writeRecords(self, records, project):
+
+        if not os.path.exists(self.journal_filename):
+            self.startJournal(None, project)
+
+        with open(self.journal_filename, "a") as f:
+            f.write(json.dumps({"op": "project", "project": project}) + "\n")
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+        self.records_number += len(records)
+
+    def journalHasChanges(self):
+
+        if not os.path.exists(self.journal_filename):
+            return False
+
+        with open(self.journal_filename, "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+
+                if record.get("op") in ("put", "remove"):
+                    return True
+
+        return False
+
+    def readJournal(self):
+        """
+        It returns the base file, the project information and the changes of the journal.
+        A truncated last line (e.g. after a crash) is ignored.
+        """
+
+        base_filename = None
+        project = {}
+        records = []
+
+        with open(self.journal_filename, "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+
+                if record["op"] == "base":
+                    base_filename = record["file"]
+                    project = record["project"]
+                elif record["op"] == "project":
+                    project = record["project"]
+                else:
+                    records.append(record)
+
+        return (base_filename, project, records)
+
+    @staticmethod
+    def loadBlobDicts(base_filename):
+
+        if base_filename is None or not os.path.exists(base_filename):
+            return []
+
+        if BinaryProject.isBinaryProject(base_filename):
+            (_, blobs) = BinaryProject.loadBinaryProject(base_filename)
+            return [blob.toDict() for blob in blobs]
+
+        with open(base_filename, "r") as f:
+            return json.load(f)["Segmentation Data"]
+
+    def compact(self):
+        """
+        Merge the base project and the changes of the journal in the autosave project and start a new journal.
+        """
+
+        if not os.path.exists(self.journal_filename):
+            return
+
+        (base_filename, project, records) = self.readJournal()
+
+        blobs = {}
+        for blob_dict in self.loadBlobDicts(base_filename):
+            blobs[blob_dict["id"]] = blob_dict
+
+        for record in records:
+            if record["op"] == "put":
+                blobs[record["id"]] = record["blob"]
+            elif record["op"] == "remove":
+                blobs.pop(record["id"], None)
+
+        dict_to_save = dict(project)
+        dict_to_save["Segmentation Data"] = list(blobs.values())
+
+        # the autosave project is replaced atomically, it is never left half-written
+        tmp_filename = self.snapshot_filename + ".tmp"
+        with open(tmp_filename, "w") as f:
+            f.write(json.dumps(dict_to_save))
+        os.replace(tmp_filename, self.snapshot_filename)
+
+        self.startJournal(os.path.abspath(self.snapshot_filename), project)
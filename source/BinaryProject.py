@@ -0,0 +1,305 @@
+# TagLab
+# A semi-automatic segmentation tool
+#
+# Copyright(C) 2019
+# Visual Computing Lab
+# ISTI - Italian National Research Council
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License (http://www.gnu.org/licenses/gpl.txt)
+# for more details.
+
+""" Binary (columnar) format of the TagLab projects (.tlb), an alternative to the JSON projects that is much
+faster to save and load when the project contains many blobs.
+
+The file contains:
+  - the magic string (8 bytes) and the length of the header (uint64, little-endian)
+  - the header, in JSON: the project information (map file, acquisition date, scale), the string attributes
+    of the blobs (class name, class color, names, notes) and the description of the columns
+  - the columns (raw NumPy arrays aligned to 64 bytes): the numeric attributes of the blobs, one value per blob,
+    and the coordinates of all the contours in flat arrays, with the offsets of the contours of each blob.
+
+The columns are memory mapped when the project is loaded. A project can be converted between the two formats:
+
+    python -m source.BinaryProject project.json project.tlb
+"""
+
+import os
+import sys
+import json
+import numpy as np
+
+from source.Blob import Blob
+
+MAGIC = b"TAGLABP1"
+
+ALIGNMENT = 64
+
+BINARY_EXTENSION = ".tlb"
+
+
+def isBinaryProject(filename):
+
+    return os.path.splitext(filename)[1].lower() == BINARY_EXTENSION
+
+
+def integerFlags(arrays):
+    """
+    For each array, 1 if it contains integers. The arrays of all the blobs are stored in a single column
+    (converted to the most general type), so the flags are needed to restore the type of each array.
+    """
+
+    return np.array([np.asarray(a).dtype.kind in "iu" for a in arrays], dtype=np.uint8)
+
+
+def restoreType(arr, flags, i):
+
+    if flags is not None and flags[i]:
+        return arr.astype(np.int64)
+
+    return arr
+
+
+def flatten(arrays):
+    """
+    Concatenate a list of (k x 2) arrays. It returns the points and the offsets of the arrays
+    (the i-th array is points[offsets[i]:offsets[i+1]]).
+    """
+
+    arrays = [np.asarray(a).reshape(-1, 2) for a in arrays]
+
+    offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+    if len(arrays) > 0:
+        np.cumsum([a.shape[0] for a in arrays], out=offsets[1:])
+        points = np.concatenate(arrays, axis=0)
+    else:
+        points = np.zeros((0, 2))
+
+    return (points, offsets)
+
+
+def blobsToColumns(blobs):
+
+    columns = {}
+
+    columns["id"] = np.array([blob.id for blob in blobs], dtype=np.int64)
+    columns["bbox"] = np.array([blob.bbox for blob in blobs]).reshape(-1, 4)
+    columns["bbox integer"] = integerFlags([blob.bbox for blob in blobs])
+    columns["centroid"] = np.array([blob.centroid for blob in blobs], dtype=np.float64).reshape(-1, 2)
+    columns["area"] = np.array([blob.area for blob in blobs], dtype=np.float64)
+    columns["perimeter"] = np.array([blob.perimeter for blob in blobs], dtype=np.float64)
+
+    (columns["contour points"], columns["contour offsets"]) = flatten([blob.contour for blob in blobs])
+    columns["contour integer"] = integerFlags([blob.contour for blob in blobs])
+
+    # two levels of offsets: blob -> inner contours -> points
+    inner_contours = []
+    inner_counts = []
+    for blob in blobs:
+        inner_contours.extend(blob.inner_contours)
+        inner_counts.append(len(blob.inner_contours))
+
+    (columns["inner contour points"], columns["inner contour offsets"]) = flatten(inner_contours)
+    columns["inner contour integer"] = integerFlags(inner_contours)
+    columns["inner contours of blob"] = np.zeros(len(blobs) + 1, dtype=np.int64)
+    np.cumsum(inner_counts, out=columns["inner contours of blob"][1:])
+
+    (columns["extreme points"], columns["extreme offsets"]) = flatten([blob.deep_extreme_points for blob in blobs])
+    columns["extreme integer"] = integerFlags([blob.deep_extreme_points for blob in blobs])
+
+    attributes = {}
+    attributes["class name"] = [blob.class_name for blob in blobs]
+    attributes["class color"] = [[int(c) for c in blob.class_color] for blob in blobs]
+    attributes["instance name"] = [blob.instance_name for blob in blobs]
+    attributes["blob name"] = [blob.blob_name for blob in blobs]
+    attributes["note"] = [blob.note for blob in blobs]
+
+    return (columns, attributes)
+
+
+def columnsToBlobs(columns, attributes, n):
+
+    contour_points = columns["contour points"]
+    contour_offsets = columns["contour offsets"]
+    inner_points = columns["inner contour points"]
+    inner_offsets = columns["inner contour offsets"]
+    inner_of_blob = columns["inner contours of blob"]
+    extreme_points = columns["extreme points"]
+    extreme_offsets = columns["extreme offsets"]
+
+    # the projects saved before the flags were added have no type information
+    bbox_integer = columns.get("bbox integer")
+    contour_integer = columns.get("contour integer")
+    inner_integer = columns.get("inner contour integer")
+    extreme_integer = columns.get("extreme integer")
+
+    # the (memory mapped) columns are copied in the blobs, so the file is not kept open
+    ids = columns["id"].tolist()
+    bboxes = np.array(columns["bbox"])
+    centroids = np.array(columns["centroid"])
+    areas = columns["area"].tolist()
+    perimeters = columns["perimeter"].tolist()
+
+    blobs = []
+    for i in range(n):
+
+        blob = Blob(None, 0, 0, 0)
+
+        blob.bbox = restoreType(bboxes[i], bbox_integer, i)
+        blob.centroid = centroids[i]
+        blob.area = areas[i]
+        blob.perimeter = perimeters[i]
+
+        blob.contour = restoreType(np.array(contour_points[contour_offsets[i]:contour_offsets[i+1]]), contour_integer, i)
+
+        blob.inner_contours = []
+        for j in range(inner_of_blob[i], inner_of_blob[i+1]):
+            inner_contour = np.array(inner_points[inner_offsets[j]:inner_offsets[j+1]])
+            blob.inner_contours.append(restoreType(inner_contour, inner_integer, j))
+
+        extreme = np.array(extreme_points[extreme_offsets[i]:extreme_offsets[i+1]])
+        blob.deep_extreme_points = restoreType(extreme, extreme_integer, i)
+
+        blob.class_name = attributes["class name"][i]
+        blob.class_color = attributes["class color"][i]
+        blob.instance_name = attributes["instance name"][i]
+        blob.blob_name = attributes["blob name"][i]
+        blob.id = ids[i]
+        blob.note = attributes["note"][i]
+
+        blobs.append(blob)
+
+    return blobs
+
+
+def saveBinaryProject(filename, project, blobs):
+    """
+    Save the project information (a dictionary) and the blobs in the binary format.
+    """
+
+    (columns, attributes) = blobsToColumns(blobs)
+
+    # the offsets of the columns are relative to the beginning of the data section
+    description = {}
+    offset = 0
+    for name, arr in columns.items():
+        description[name] = {"dtype": arr.dtype.str, "shape": list(arr.shape), "offset": offset}
+        offset += arr.nbytes
+        offset += (-offset) % ALIGNMENT
+
+    header = {"version": 1,
+              "project": project,
+              "blobs": len(blobs),
+              "attributes": attributes,
+              "columns": description}
+
+    header_bytes = json.dumps(header).encode("utf-8")
+    data_start = len(MAGIC) + 8 + len(header_bytes)
+    data_start += (-data_start) % ALIGNMENT
+
+    with open(filename, "wb") as f:
+        f.write(MAGIC)
+        f.write(np.uint64(len(header_bytes)).tobytes())
+        f.write(header_bytes)
+        f.write(b"\0" * (data_start - f.tell()))
+
+        for name, arr in columns.items():
+            f.write(b"\0" * (data_start + description[name]["offset"] - f.tell()))
+            np.ascontiguousarray(arr).tofile(f)
+
+
+def loadBinaryProject(filename):
+    """
+    It returns the project information (a dictionary) and the list of the blobs.
+    A ValueError is raised if the file is not a valid binary project.
+    """
+
+    with open(filename, "rb") as f:
+        magic = f.read(len(MAGIC))
+        if magic != MAGIC:
+            raise ValueError("{0} is not a TagLab binary project.".format(filename))
+        header_length = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+        header = json.loads(f.read(header_length).decode("utf-8"))
+
+    data_start = len(MAGIC) + 8 + header_length
+    data_start += (-data_start) % ALIGNMENT
+
+    data = np.memmap(filename, dtype=np.uint8, mode="r")
+
+    columns = {}
+    for name, info in header["columns"].items():
+        dtype = np.dtype(info["dtype"])
+        shape = tuple(info["shape"])
+        start = data_start + info["offset"]
+        size = int(np.prod(shape)) * dtype.itemsize
+        if start + size > data.shape[0]:
+            raise ValueError("The binary project {0} is truncated.".format(filename))
+        columns[name] = data[start:start+size].view(dtype).reshape(shape)
+
+    blobs = columnsToBlobs(columns, header["attributes"], header["blobs"])
+
+    del columns
+    del data
+
+    return (header["project"], blobs)
+
+
+def loadProject(filename):
+    """
+    Load a project, in the JSON or in the binary format. It returns the project information
+    (a dictionary) and the list of the blobs.
+    """
+
+    if isBinaryProject(filename):
+        return loadBinaryProject(filename)
+
+    with open(filename, "r") as f:
+        loaded_dict = json.load(f)
+
+    blobs = []
+    for blob_dict in loaded_dict.pop("Segmentation Data"):
+        blob = Blob(None, 0, 0, 0)
+        blob.fromDict(blob_dict)
+        blobs.append(blob)
+
+    return (loaded_dict, blobs)
+
+
+def saveProject(filename, project, blobs):
+    """
+    Save a project, the format is chosen according to the extension of the file.
+    """
+
+    if isBinaryProject(filename):
+        saveBinaryProject(filename, project, blobs)
+        return
+
+    dict_to_save = dict(project)
+    dict_to_save["Segmentation Data"] = [blob.toDict() for blob in blobs]
+
+    with open(filename, "w") as f:
+        f.write(json.dumps(dict_to_save))
+
+
+def convert(input_filename, output_filename):
+
+    (project, blobs) = loadProject(input_filename)
+    saveProject(output_filename, project, blobs)
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) != 3:
+        print("Usage: python -m source.BinaryProject <input project> <output project>")
+        print("The format (JSON or binary) is chosen according to the extensions (.json, " + BINARY_EXTENSION + ").")
+        sys.exit(1)
+
+    convert(sys.argv[1], sys.argv[2])
@@ -22,7 +22,6 @@ import copy
 import numpy as np
 
 from skimage import measure
-from skimage.util import pad
 from scipy import ndimage as ndi
 from PyQt5.QtGui import QPainterPath, QPolygonF, QImage, QPixmap, qRgba
 from PyQt5.QtCore import QPointF
@@ -191,11 +190,12 @@ class Blob(object):
         return blob
 
     def setId(self, id):
+        self.id = id
+
         # a string with a number to identify the blob plus its centroid
         xc = self.centroid[0]
         yc = self.centroid[1]
         self.blob_name = "c-{:d}-{:.1f}x-{:.1f}y".format(self.id, xc, yc)
-        self.id = id
 
     def getMask(self):
         """
@@ -306,6 +306,13 @@ class Blob(object):
     def createContourFromMask(self, mask, bbox):
         """
         It creates the contour (and the corrisponding polygon) from the blob mask.
+        The outer contour is the longest one; the holes are the contours of the pixels not belonging
+        to the mask inside it. The contours pass through the centers of the border pixels, so the mask
+        is exactly recreated by filling them (see getMask()).
+        NOTE: the previous (marching squares) contours passed 0.4 pixels outside the centers of the border
+        pixels, so the perimeters are now slightly shorter (about 2 pixels for a compact blob). Masks thin
+        as a line (e.g. a single pixel) have no area inside the pixel centers, their contour is still the
+        marching squares one.
         """
 
         # NOTE: The mask is expected to be cropped around its bbox (!!) (see the __init__)
@@ -314,75 +321,56 @@ class Blob(object):
 
         # we need to pad the mask to avoid to break the contour that touches the borders
         PADDED_SIZE = 4
-        img_padded = pad(mask, (PADDED_SIZE, PADDED_SIZE), mode="constant", constant_values=(0, 0))
-
-        contours = measure.find_contours(img_padded, 0.6)
-        inner_contours = measure.find_contours(img_padded, 0.4)
-        number_of_contours = len(contours)
-
-        threshold = 20 #min number of points in a small hole
-
-        if number_of_contours > 1:
-
-            # search the longest contour
-            npoints_max = 0
-            longest = 0
-            for i, contour in enumerate(contours):
-                npoints = contour.shape[0]
-                if npoints > npoints_max:
-                    npoints_max = npoints
-                    longest = i
-
-            npoints_max = 0
-            inner_longest = 0
-            for i, contour in enumerate(inner_contours):
-                npoints = contour.shape[0]
-                if npoints > npoints_max:
-                    npoints_max = npoints
-                    inner_longest = i
-
-            # divide the contours in OUTER contour and INNER contours
-            for i, contour in enumerate(contours):
-                if i == longest:
-                    self.contour = np.array(contour)
-
-            for i, contour in enumerate(inner_contours):
-                if i != inner_longest:
-                    if contour.shape[0] > threshold:
-                        coordinates = np.array(contour)
-                        self.inner_contours.append(coordinates)
-
-            # adjust the coordinates of the outer contour
-            # (NOTE THAT THE COORDINATES OF THE BBOX ARE IN THE GLOBAL MAP COORDINATES SYSTEM)
-            for i in range(self.contour.shape[0]):
-                ycoor = self.contour[i, 0]
-                xcoor = self.contour[i, 1]
-                self.contour[i, 0] = xcoor - PADDED_SIZE + bbox[1]
-                self.contour[i, 1] = ycoor - PADDED_SIZE + bbox[0]
-
-            # adjust coordinates of the INNER contours
-            for j, contour in enumerate(self.inner_contours):
-                for i in range(contour.shape[0]):
-                    ycoor = contour[i, 0]
-                    xcoor = contour[i, 1]
-                    self.inner_contours[j][i, 0] = xcoor - PADDED_SIZE + bbox[1]
-                    self.inner_contours[j][i, 1] = ycoor - PADDED_SIZE + bbox[0]
-        elif number_of_contours == 1:
-
-            coords = measure.approximate_polygon(contours[0], tolerance=0.2)
-            #coords = contours[0]
-            self.contour = np.array(coords)
-
-            # adjust the coordinates of the outer contour
-            # (NOTE THAT THE COORDINATES OF THE BBOX ARE IN THE GLOBAL MAP COORDINATES SYSTEM)
-            for i in range(self.contour.shape[0]):
-                ycoor = self.contour[i, 0]
-                xcoor = self.contour[i, 1]
-                self.contour[i, 0] = xcoor - PADDED_SIZE + bbox[1]
-                self.contour[i, 1] = ycoor - PADDED_SIZE + bbox[0]
-        else:
+        img_padded = np.pad((np.asarray(mask) > 0).astype(np.uint8), PADDED_SIZE, mode="constant")
+
+        # [-2] is a trick to be compatible both with opencv 3 and 4
+        contours = cv2.findContours(img_padded, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
+        if len(contours) == 0:
             raise Exception("Empty contour")
 
+        # search the longest contour
+        lengths = [cv2.arcLength(contour, True) for contour in contours]
+        outer = contours[int(np.argmax(lengths))]
+
+        # the holes are the pixels inside the outer contour not belonging to the mask
+        filled = np.zeros_like(img_padded)
+        cv2.drawContours(filled, [outer], 0, 1, thickness=cv2.FILLED)
+        holes = filled & (1 - img_padded)
+
+        # (x, y) coordinates of the padded mask --> (x, y) coordinates of the map
+        # (NOTE THAT THE COORDINATES OF THE BBOX ARE IN THE GLOBAL MAP COORDINATES SYSTEM)
+        offset = np.array([bbox[1] - PADDED_SIZE, bbox[0] - PADDED_SIZE], dtype=float)
+
+        if cv2.contourArea(outer) == 0:
+            # the mask is thin as a line (e.g. a single pixel): the marching squares contour is used, as before
+            component = measure.find_contours((filled & img_padded).astype(float), 0.6)
+            coords = measure.approximate_polygon(max(component, key=len), tolerance=0.2)
+            self.contour = coords[:, ::-1] + offset
+            self.bbox = Mask.pointsBox(self.contour, 4)
+            return
+
+        self.contour = outer.reshape(-1, 2) + offset
+
+        threshold = 20 #min number of points of the contour of a small hole
+
+        if holes.any():
+
+            for contour in cv2.findContours(holes, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]:
+
+                # as before, the number of points of a hole is the number of the pixel edges crossed by its
+                # marching squares contour, i.e. the edges between the hole and the mask (plus the closing point);
+                # they are at least 2 * (w + h), so they are counted only for the holes with a small bbox
+                (x, y, w, h) = cv2.boundingRect(contour)
+                npoints = 2 * (w + h) + 1
+                if npoints <= threshold:
+                    hole = np.zeros((h + 2, w + 2), dtype=np.uint8)
+                    cv2.drawContours(hole, [contour], 0, 1, thickness=cv2.FILLED, offset=(1 - x, 1 - y))
+                    hole &= holes[y - 1:y + h + 1, x - 1:x + w + 1]
+                    npoints = np.count_nonzero(hole[1:] != hole[:-1]) + np.count_nonzero(hole[:, 1:] != hole[:, :-1]) + 1
+
+                if npoints > threshold:
+                    self.inner_contours.append(contour.reshape(-1, 2) + offset)
+
         self.bbox = Mask.pointsBox(self.contour, 4)
 
     def setupForDrawing(self):
@@ -409,21 +397,14 @@ class Blob(object):
 
     def createQPixmapFromMask(self):
 
-        w = self.bbox[2]
-        h = self.bbox[3]
-        self.qimg_mask = QImage(w, h, QImage.Format_ARGB32)
-        self.qimg_mask.fill(qRgba(0, 0, 0, 0))
-
         if self.class_name == "Empty":
             rgba = qRgba(255, 255, 255, 255)
         else:
             rgba = qRgba(self.class_color[0], self.class_color[1], self.class_color[2], 100)
 
+        # the mask is 0 outside the blob and 1 inside
         blob_mask = self.getMask()
-        for x in range(w):
-            for y in range(h):
-                if blob_mask[y, x] == 1:
-                    self.qimg_mask.setPixel(x, y, rgba)
+        self.qimg_mask = utils.colorizeLabels(blob_mask, [qRgba(0, 0, 0, 0), rgba], QImage.Format_ARGB32)
 
         self.pxmap_mask = QPixmap.fromImage(self.qimg_mask)
 
@@ -0,0 +1,287 @@
+# TagLab
+# A semi-automatic segmentation tool
+#
+# Copyright(C) 2019
+# Visual Computing Lab
+# ISTI - Italian National Research Council
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License (http://www.gnu.org/licenses/gpl.txt)
+# for more details.
+
+""" Extraction of the blobs (connected components) of a map of class indices, with bounded memory.
+"""
+
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+
+from skimage import measure
+from scipy import ndimage as ndi
+
+from source.Blob import Blob
+
+
+def createBlobs(tasks):
+    """
+    Create the blobs of a list of components; each task is (mask of the component cropped to its bbox,
+    row and col of one pixel of the component in the mask, top, left). It runs in the processes of the pool.
+    """
+
+    blobs = []
+    for (mask, seed_row, seed_col, top, left) in tasks:
+
+        # the mask can contain other components of the same class
+        labels = measure.label(mask, background=0, connectivity=1)
+        component = (labels == labels[seed_row, seed_col]).astype(np.uint8)
+
+        region = measure.regionprops(component)[0]
+        blobs.append(Blob(region, left, top, 0))
+
+    return blobs
+
+
+class BlobExtractor(object):
+    """
+    The map of class indices is processed in horizontal stripes: the components of each stripe are labeled
+    and the components that touch across the seam between two stripes are merged (union-find). Only the
+    statistics of the components (area, bounding box, one pixel) are kept, so the memory does not depend
+    on the size of the map. Then, the blobs of the components big enough are created from their bounding
+    boxes, in parallel by a pool of processes.
+    """
+
+    # number of pixels of a stripe
+    STRIPE_PIXELS = 16 * 1024 * 1024
+
+    # the pool is used only if each process creates at least this number of blobs
+    MIN_BLOBS_PER_PROCESS = 16
+
+    def __init__(self, min_area=1000, workers=0):
+
+        self.min_area = min_area
+
+        # number of processes used to create the blobs (0 = number of cores, 1 = no pool)
+        self.workers = workers if workers > 0 else (os.cpu_count() or 1)
+
+        self.parent = np.zeros(1, dtype=np.int64)
+
+    @staticmethod
+    def sourceIndices(start, stop, size, source_size):
+        """
+        Indices of the source map of the pixels start..stop-1 of the map rescaled (nearest neighbour, as cv2.resize)
+        from source_size to size.
+        """
+
+        scale = 1.0 / (size / source_size)
+        return np.minimum(np.floor(np.arange(start, stop) * scale).astype(np.int64), source_size - 1)
+
+    def codedStripe(self, class_map, lut, roi_mask, size, top, bottom, left=0, right=None):
+        """
+        Code of the pixels of a part of the map rescaled to size (height, width): code 0 is ignored,
+        pixels with the same code belong to the same class.
+        """
+
+        (h, w) = size
+        right = w if right is None else right
+
+        if class_map.shape[:2] == (h, w):
+            part = np.asarray(class_map[top:bottom, left:right])
+        else:
+            # only the rows and the columns of the source map used by the part are read
+            rows = self.sourceIndices(top, bottom, h, class_map.shape[0])
+            cols = self.sourceIndices(left, right, w, class_map.shape[1])
+            part = np.asarray(class_map[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1])
+            part = part[np.ix_(rows - rows[0], cols - cols[0])]
+
+        coded = np.take(lut, part)
+        if roi_mask is not None:
+            coded[np.asarray(roi_mask[top:bottom, left:right]) == 0] = 0
+
+        return coded
+
+    def find(self, label):
+
+        root = label
+        while self.parent[root] != root:
+            root = self.parent[root]
+
+        # path compression
+        while self.parent[label] != root:
+            (self.parent[label], label) = (root, self.parent[label])
+
+        return root
+
+    def union(self, a, b):
+
+        ra = self.find(a)
+        rb = self.find(b)
+
+        # the root is the smallest label, i.e. the component that starts first (in raster order)
+        if ra < rb:
+            self.parent[rb] = ra
+        elif rb < ra:
+            self.parent[ra] = rb
+
+    def components(self, class_map, lut, roi_mask=None, size=None):
+        """
+        Label the components stripe by stripe. It returns, for each component, the code, the area,
+        the bounding box (top, left, bottom, right) and its first pixel (row, col) in raster order.
+        """
+
+        (h, w) = class_map.shape[:2] if size is None else size
+        stripe_height = max(1, self.STRIPE_PIXELS // max(w, 1))
+
+        stats = []
+        count = 0
+        last_labels = None
+        last_coded = None
+
+        self.parent = np.zeros(1, dtype=np.int64)
+
+        for top in range(0, h, stripe_height):
+
+            bottom = min(h, top + stripe_height)
+            coded = self.codedStripe(class_map, lut, roi_mask, (h, w), top, bottom)
+
+            (labels, n) = measure.label(coded, background=0, connectivity=1, return_num=True)
+
+            # statistics of the components of the stripe
+            nonzero = np.flatnonzero(labels)
+            stripe_labels = labels.ravel()[nonzero]
+            area = np.bincount(stripe_labels, minlength=n + 1)[1:]
+            (_, first) = np.unique(stripe_labels, return_index=True)
+            first = nonzero[first]
+            codes = coded.ravel()[first]
+            seeds = np.stack([first // w + top, first % w], axis=1)
+            boxes = np.array([(rows.start + top, cols.start, rows.stop + top, cols.stop)
+                              for (rows, cols) in ndi.find_objects(labels)], dtype=np.int64).reshape(-1, 4)
+
+            stats.append((codes, area, boxes, seeds))
+            self.parent = np.concatenate([self.parent, np.arange(count + 1, count + n + 1, dtype=np.int64)])
+
+            # labels of the whole map
+            labels[labels > 0] += count
+
+            # the components of the same class that touch across the seam are merged
+            if last_labels is not None:
+                touching = (last_labels > 0) & (labels[0] > 0) & (last_coded == coded[0])
+                pairs = np.unique(np.stack([last_labels[touching], labels[0][touching]], axis=1), axis=0)
+                for (a, b) in pairs:
+                    self.union(a, b)
+
+            last_labels = labels[-1].copy()
+            last_coded = coded[-1].copy()
+            count += n
+
+        if count == 0:
+            return (np.zeros(0, dtype=lut.dtype), np.zeros(0, dtype=np.int64),
+                    np.zeros((0, 4), dtype=np.int64), np.zeros((0, 2), dtype=np.int64))
+
+        codes = np.concatenate([s[0] for s in stats])
+        area = np.concatenate([s[1] for s in stats])
+        boxes = np.concatenate([s[2] for s in stats])
+        seeds = np.concatenate([s[3] for s in stats])
+
+        # root of each label
+        roots = self.parent.copy()
+        while True:
+            next_roots = roots[roots]
+            if np.array_equal(next_roots, roots):
+                break
+            roots = next_roots
+        roots = roots[1:] - 1
+
+        # statistics of the merged components; the first pixel is the one of the root
+        merged_area = np.bincount(roots, weights=area, minlength=count).astype(np.int64)
+        merged_boxes = boxes.copy()
+        np.minimum.at(merged_boxes[:, 0], roots, boxes[:, 0])
+        np.minimum.at(merged_boxes[:, 1], roots, boxes[:, 1])
+        np.maximum.at(merged_boxes[:, 2], roots, boxes[:, 2])
+        np.maximum.at(merged_boxes[:, 3], roots, boxes[:, 3])
+
+        keep = roots == np.arange(count)
+
+        return (codes[keep], merged_area[keep], merged_boxes[keep], seeds[keep])
+
+    def extract(self, class_map, lut, roi_mask=None, offset=(0, 0), size=None):
+        """
+        Create the blobs of the map of class indices (H x W, also a memmap). If size (height, width) is given,
+        the map is rescaled to it (nearest neighbour), one stripe at a time. lut converts the class indices to
+        the codes of the pixels (code 0 is ignored, e.g. the background). The pixels outside the roi mask
+        (if any, same size of the rescaled map) are ignored. offset is the (top, left) of the map. It returns
+        the list of (code, blob) of the components bigger than min_area, in raster order of their first pixel.
+        """
+
+        lut = np.asarray(lut)
+        size = class_map.shape[:2] if size is None else tuple(size)
+        (codes, area, boxes, seeds) = self.components(class_map, lut, roi_mask, size)
+
+        big = area > self.min_area
+        codes = codes[big]
+        boxes = boxes[big]
+        seeds = seeds[big]
+
+        tasks = []
+        for (code, (top, left, bottom, right), (seed_row, seed_col)) in zip(codes, boxes, seeds):
+            mask = self.codedStripe(class_map, lut, roi_mask, size, top, bottom, left, right) == code
+            tasks.append((mask, seed_row - top, seed_col - left, top + offset[0], left + offset[1]))
+
+        workers = min(self.workers, len(tasks) // self.MIN_BLOBS_PER_PROCESS)
+
+        if workers <= 1:
+            blobs = createBlobs(tasks)
+        else:
+            # the tasks are divided in chunks (a few per process) to balance the load
+            nchunks = 4 * workers
+            chunks = [tasks[i::nchunks] for i in range(nchunks)]
+
+            context = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+                results = list(executor.map(createBlobs, chunks))
+
+            # back to the order of the tasks
+            blobs = [None] * len(tasks)
+            for i, chunk_blobs in enumerate(results):
+                blobs[i::nchunks] = chunk_blobs
+
+        return list(zip(codes.tolist(), blobs))
+
+
+class ColorIndexMap(object):
+    """
+    A map of colors (a MapImage, e.g. a label map) seen as a map of color indices, so it can be given to
+    BlobExtractor.extract() instead of an array: the indices are computed only for the parts of the map read.
+    The colors (codes R + G << 8 + B << 16, in increasing order) are collected stripe by stripe.
+    """
+
+    def __init__(self, color_map):
+
+        self.data = color_map.data
+        self.shape = self.data.shape[:2]
+
+        stripe_height = max(1, BlobExtractor.STRIPE_PIXELS // max(self.shape[1], 1))
+
+        colors = np.zeros(0, dtype=np.int32)
+        for top in range(0, self.shape[0], stripe_height):
+            colors = np.union1d(colors, self.codes(self.data[top:top + stripe_height]))
+
+        self.colors = colors
+
+    @staticmethod
+    def codes(bgra):
+
+        bgra = np.asarray(bgra)
+        return bgra[..., 2].astype(np.int32) + (bgra[..., 1].astype(np.int32) << 8) + (bgra[..., 0].astype(np.int32) << 16)
+
+    def __getitem__(self, key):
+
+        return np.searchsorted(self.colors, self.codes(self.data[key])).astype(np.int32)
@@ -0,0 +1,126 @@
+# TagLab
+# A semi-automatic segmentation tool
+#
+# Copyright(C) 2019
+# Visual Computing Lab
+# ISTI - Italian National Research Council
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License (http://www.gnu.org/licenses/gpl.txt)
+# for more details.
+
+
+class BlobIndex(object):
+    """
+    Spatial index of the blobs: a uniform grid whose cells store the blobs whose bounding box
+    intersects them. It is used to find the few blobs that can contain a point (or intersect a
+    rectangle) without testing the contours of all the blobs.
+    """
+
+    def __init__(self, cell_size=512):
+
+        self.cell_size = cell_size
+
+        # (row, col) -> {id(blob): blob}
+        self.cells = {}
+
+        # id(blob) -> cells of the blob (the bbox of the blob can change after its insertion)
+        self.blob_cells = {}
+
+        # id(blob) -> insertion number, used to return the blobs in insertion order
+        self.blob_order = {}
+        self.counter = 0
+
+    def cellsRange(self, top, left, width, height):
+
+        # the closing edges are included, as in the tests of blobsAt() and blobsInRect()
+        cs = self.cell_size
+        row_first = int(top) // cs
+        row_last = int(top + height) // cs
+        col_first = int(left) // cs
+        col_last = int(left + width) // cs
+
+        return (row_first, row_last, col_first, col_last)
+
+    def insert(self, blob):
+
+        if id(blob) in self.blob_cells:
+            self.remove(blob)
+
+        (top, left, width, height) = blob.bbox[:4]
+        (row_first, row_last, col_first, col_last) = self.cellsRange(top, left, width, height)
+
+        cells = []
+        for row in range(row_first, row_last + 1):
+            for col in range(col_first, col_last + 1):
+                self.cells.setdefault((row, col), {})[id(blob)] = blob
+                cells.append((row, col))
+
+        self.blob_cells[id(blob)] = cells
+        self.blob_order[id(blob)] = self.counter
+        self.counter += 1
+
+    def remove(self, blob):
+
+        cells = self.blob_cells.pop(id(blob), [])
+        self.blob_order.pop(id(blob), None)
+        for cell in cells:
+            blobs = self.cells.get(cell)
+            if blobs is not None:
+                blobs.pop(id(blob), None)
+                if len(blobs) == 0:
+                    del self.cells[cell]
+
+    def clear(self):
+
+        self.cells = {}
+        self.blob_cells = {}
+        self.blob_order = {}
+        self.counter = 0
+
+    def blobsAt(self, x, y):
+        """
+        Returns the blobs whose bounding box contains the given point (in insertion order).
+        """
+
+        cs = self.cell_size
+        blobs = self.cells.get((int(y) // cs, int(x) // cs), {})
+
+        candidates = []
+        for blob in blobs.values():
+            (top, left, width, height) = blob.bbox[:4]
+            if left <= x <= left + width and top <= y <= top + height:
+                candidates.append(blob)
+
+        return candidates
+
+    def blobsInRect(self, top, left, width, height):
+        """
+        Returns the blobs whose bounding box intersects the given rectangle (in insertion order).
+        """
+
+        (row_first, row_last, col_first, col_last) = self.cellsRange(top, left, width, height)
+
+        found = {}
+        for row in range(row_first, row_last + 1):
+            for col in range(col_first, col_last + 1):
+                blobs = self.cells.get((row, col))
+                if blobs is None:
+                    continue
+                for key, blob in blobs.items():
+                    if key in found:
+                        continue
+                    (btop, bleft, bwidth, bheight) = blob.bbox[:4]
+                    if bleft <= left + width and left <= bleft + bwidth and btop <= top + height and top <= btop + bheight:
+                        found[key] = blob
+
+        keys = sorted(found.keys(), key=lambda key: self.blob_order[key])
+        return [found[key] for key in keys]
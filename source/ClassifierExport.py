@@ -0,0 +1,231 @@
+# TagLab
+# A semi-automatic segmentation tool
+#
+# Copyright(C) 2019
+# Visual Computing Lab
+# ISTI - Italian National Research Council
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License (http://www.gnu.org/licenses/gpl.txt)
+# for more details.
+
+""" Export the classifiers listed in config.json as optimized TorchScript graphs.
+
+The network is traced and frozen (the weights become constants and the batch normalizations are folded
+into the convolutions); the graph is saved next to the weights (see MapClassifier.exportedFilename()) and it is
+used by the MapClassifier, optimized for inference on the current CPU, when CUDA is not available.
+
+With --int8 the networks are also quantized (static int8 quantization, calibrated on the training tiles of a
+dataset exported by TagLab); the quantized graph is used by the classifiers with "Precision": "int8".
+With --report the precisions are compared on the validation tiles of the dataset: time per tile, and pixel
+agreement and mean IoU with respect to the float32 labels.
+
+Usage: python -m source.ClassifierExport [config.json] [--int8 dataset_folder] [--report dataset_folder]
+"""
+
+import os
+import json
+import time
+import argparse
+import numpy as np
+from PIL import Image as PILimage
+
+import torch
+
+from source.MapClassifier import MapClassifier
+from source.InferenceProcess import runNetwork
+
+# maximum number of tiles used for the calibration and for the report
+CALIBRATION_TILES = 32
+REPORT_TILES = 16
+
+
+def exportClassifier(classifier_info, models_dir="models", tile_size=768):
+    """
+    Export a classifier; it returns the name of the exported file and the maximum difference between
+    the scores of the exported graph and of the original network (on a random tile), relative to the
+    maximum score.
+    """
+
+    network_name = os.path.join(models_dir, classifier_info['Weights'])
+    net = MapClassifier.buildNetwork(network_name, classifier_info['Num. Classes'])
+
+    example = torch.rand(1, 3, tile_size, tile_size)
+
+    with torch.no_grad():
+        traced = torch.jit.trace(net, example)
+        exported = torch.jit.freeze(traced)
+
+        scores = net(example)
+        difference = (exported(example) - scores).abs().max().item() / max(scores.abs().max().item(), 1e-12)
+
+    filename = MapClassifier.exportedFilename(network_name)
+    exported.save(filename)
+
+    return (filename, difference)
+
+
+def loadTiles(images_dir, average_norm, max_tiles, tile_size=768):
+    """
+    Load (at most max_tiles, evenly sampled) images of an exported dataset; the central part of each image
+    is normalized as in MapClassifier.prepareTile(). It returns a list of 1 x 3 x tile_size x tile_size tensors.
+    """
+
+    names = sorted(os.listdir(images_dir))
+    if len(names) > max_tiles:
+        names = [names[int(i * len(names) / max_tiles)] for i in range(max_tiles)]
+
+    average_norm = np.asarray(average_norm, dtype=np.float32).reshape(3, 1, 1)
+
+    tiles = []
+    for name in names:
+        img = np.array(PILimage.open(os.path.join(images_dir, name)).convert("RGB"), dtype=np.float32)
+
+        # the images smaller than the tile are padded with black
+        tile = np.zeros((tile_size, tile_size, 3), dtype=np.float32)
+        h = min(tile_size, img.shape[0])
+        w = min(tile_size, img.shape[1])
+        oy = (img.shape[0] - h) // 2
+        ox = (img.shape[1] - w) // 2
+        tile[:h, :w] = img[oy:oy+h, ox:ox+w]
+
+        tile = tile.transpose(2, 0, 1) / 255.0 - average_norm
+        tiles.append(torch.from_numpy(np.ascontiguousarray(tile)).unsqueeze(0))
+
+    return tiles
+
+
+def quantizeClassifier(classifier_info, dataset_folder, models_dir="models", tile_size=768):
+    """
+    Static int8 quantization of a classifier (FX graph mode): the ranges of the activations are calibrated
+    on the training tiles of the dataset. The dynamic quantization is not used since it applies only to
+    the linear and recurrent layers, and the DeepLab is fully convolutional. It returns the name of the
+    exported file.
+    """
+
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+    network_name = os.path.join(models_dir, classifier_info['Weights'])
+    net = MapClassifier.buildNetwork(network_name, classifier_info['Num. Classes'])
+
+    tiles = loadTiles(os.path.join(dataset_folder, "training", "images"), classifier_info['Average Norm.'],
+                      CALIBRATION_TILES, tile_size)
+    if len(tiles) == 0:
+        raise RuntimeError("No training tiles in " + dataset_folder + ".")
+
+    backend = "x86" if "x86" in torch.backends.quantized.supported_engines else torch.backends.quantized.engine
+    torch.backends.quantized.engine = backend
+
+    with torch.no_grad():
+        prepared = prepare_fx(net, get_default_qconfig_mapping(backend), (tiles[0],))
+        for tile in tiles:
+            prepared(tile)
+
+        quantized = convert_fx(prepared)
+        exported = torch.jit.freeze(torch.jit.trace(quantized, tiles[0]))
+
+    filename = MapClassifier.exportedFilename(network_name, "int8")
+    exported.save(filename)
+
+    return filename
+
+
+def precisionReport(classifier_info, dataset_folder, models_dir="models", tile_size=768):
+    """
+    Compare the precisions on the validation tiles of the dataset. It returns a list of
+    (precision, seconds per tile, pixel agreement, mean IoU); the labels of the float32 network are the reference.
+    """
+
+    network_name = os.path.join(models_dir, classifier_info['Weights'])
+    nclasses = classifier_info['Num. Classes']
+
+    tiles = loadTiles(os.path.join(dataset_folder, "validation", "images"), classifier_info['Average Norm.'],
+                      REPORT_TILES, tile_size)
+    if len(tiles) == 0:
+        raise RuntimeError("No validation tiles in " + dataset_folder + ".")
+
+    net = MapClassifier.buildNetwork(network_name, nclasses)
+
+    modes = [("float32", net, "float32")]
+    if MapClassifier.isExported(network_name):
+        graph = torch.jit.load(MapClassifier.exportedFilename(network_name), map_location="cpu")
+        modes.append(("float32 (exported)", torch.jit.optimize_for_inference(graph), "float32"))
+    modes.append(("bfloat16", net, "bfloat16"))
+    if MapClassifier.isExported(network_name, "int8"):
+        graph = torch.jit.load(MapClassifier.exportedFilename(network_name, "int8"), map_location="cpu")
+        modes.append(("int8", torch.jit.optimize_for_inference(graph), "float32"))
+
+    report = []
+    reference = None
+
+    for (name, model, precision) in modes:
+
+        with torch.no_grad():
+            # warm up (the first runs of the TorchScript graphs are optimized by the JIT)
+            runNetwork(model, tiles[0], precision)
+            runNetwork(model, tiles[0], precision)
+
+            start = time.time()
+            labels = [torch.argmax(runNetwork(model, tile, precision), dim=1) for tile in tiles]
+            seconds = (time.time() - start) / len(tiles)
+
+        labels = torch.cat(labels)
+        if reference is None:
+            reference = labels
+
+        agreement = (labels == reference).float().mean().item()
+
+        ious = []
+        for c in range(nclasses):
+            union = ((labels == c) | (reference == c)).sum().item()
+            if union > 0:
+                ious.append(((labels == c) & (reference == c)).sum().item() / union)
+
+        report.append((name, seconds, agreement, float(np.mean(ious))))
+
+    return report
+
+
+def exportClassifiers(config_filename, models_dir="models", int8_dataset=None, report_dataset=None):
+
+    with open(config_filename) as f:
+        config_dict = json.load(f)
+
+    for classifier_info in config_dict["Available Classifiers"]:
+
+        network_name = os.path.join(models_dir, classifier_info['Weights'])
+        if not os.path.exists(network_name):
+            print("Skipped " + classifier_info['Classifier Name'] + ": " + network_name + " not found.")
+            continue
+
+        (filename, difference) = exportClassifier(classifier_info, models_dir)
+        print("Exported " + classifier_info['Classifier Name'] + " to " + filename + " (max. relative difference {:.2e}).".format(difference))
+
+        if int8_dataset is not None:
+            filename = quantizeClassifier(classifier_info, int8_dataset, models_dir)
+            print("Exported " + classifier_info['Classifier Name'] + " (int8) to " + filename + ".")
+
+        if report_dataset is not None:
+            print("{:<20} {:>10} {:>10} {:>10}".format(classifier_info['Classifier Name'], "s/tile", "agreement", "mIoU"))
+            for (name, seconds, agreement, miou) in precisionReport(classifier_info, report_dataset, models_dir):
+                print("{:<20} {:>10.3f} {:>10.4f} {:>10.4f}".format(name, seconds, agreement, miou))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(prog="python -m source.ClassifierExport")
+    parser.add_argument("config", nargs="?", default="config.json")
+    parser.add_argument("--int8", metavar="dataset_folder", help="quantize the classifiers, calibrating them on the training tiles of the dataset")
+    parser.add_argument("--report", metavar="dataset_folder", help="compare the precisions on the validation tiles of the dataset")
+    args = parser.parse_args()
+
+    exportClassifiers(args.config, int8_dataset=args.int8, report_dataset=args.report)
@@ -0,0 +1,163 @@
+# TagLab
+# A semi-automatic segmentation tool
+#
+# Copyright(C) 2019
+# Visual Computing Lab
+# ISTI - Italian National Research Council
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License (http://www.gnu.org/licenses/gpl.txt)
+# for more details.
+
+import os
+import math
+import logging
+import numpy as np
+
+from PyQt5.QtCore import Qt, QThread, pyqtSignal
+
+import source.Mask as Mask
+from source.MapImage import MapImage, MapPyramid
+
+
+class ClassifierWorker(QThread):
+    """
+    Run the automatic classification of a map in background: the map is rescaled to the scale of the
+    classifier, classified and the blobs are created from the resulting class map. The blobs are
+    delivered to the main thread (without ids, they are assigned when the blobs are added).
+    If a region of interest (a polygon) is given, only the area around it is rescaled and classified,
+    and the blobs are clipped to it.
+    """
+
+    # message, True if the percentage of the progress must be shown
+    statusChanged = pyqtSignal(str, bool)
+
+    # the list of created blobs, or None if the classification has been stopped
+    classificationDone = pyqtSignal(object)
+
+    def __init__(self, classifier, img_map, scale_factor, annotations, roi=None, map_filename=None, parent=None):
+        super(ClassifierWorker, self).__init__(parent)
+
+        self.classifier = classifier
+        self.img_map = img_map
+        self.scale_factor = scale_factor
+        self.annotations = annotations
+
+        # polygon (N x 2 array of x, y map coordinates) or None for the whole map
+        self.roi = roi
+
+        # file of the map (if any), it identifies the map in the checkpoints of the classification
+        self.map_filename = map_filename
+
+        # message of the error that stopped the classification (if any)
+        self.error = None
+
+    def run(self):
+
+        # exactly one classificationDone is emitted, whatever happens
+        created_blobs = None
+        try:
+            created_blobs = self.classify()
+        except Exception as e:
+            self.error = str(e)
+            logging.getLogger(__name__).exception("Automatic classification failed")
+
+        self.classificationDone.emit(created_blobs)
+
+    def classify(self):
+        """
+        Body of the thread; it returns the created blobs, or None if the classification has been stopped.
+        """
+
+        TILE_SIZE = 768
+
+        W = self.img_map.width()
+        H = self.img_map.height()
+
+        if self.roi is None:
+            # top, left, width, height
+            box = [0, 0, W, H]
+            crop = box
+            roi_mask = None
+            region_map = self.img_map
+        else:
+            points = np.asarray(self.roi, dtype=np.float64)
+            top = max(0, int(math.floor(points[:, 1].min())))
+            left = max(0, int(math.floor(points[:, 0].min())))
+            bottom = min(H, int(math.ceil(points[:, 1].max())) + 1)
+            right = min(W, int(math.ceil(points[:, 0].max())) + 1)
+            box = [top, left, max(0, right - left), max(0, bottom - top)]
+
+            roi_mask = Mask.polygonMask(points, box)
+
+            # the area around the roi is needed by the tiles on its border
+            margin = int(math.ceil(TILE_SIZE / self.scale_factor))
+            crop_top = max(0, top - margin)
+            crop_left = max(0, left - margin)
+            crop_bottom = min(H, bottom + margin)
+            crop_right = min(W, right + margin)
+            crop = [crop_top, crop_left, crop_right - crop_left, crop_bottom - crop_top]
+
+            if isinstance(self.img_map, MapImage):
+                # the crop stays out-of-core (the size of a QImage is limited to 32767 pixels)
+                region_map = MapImage.fromArray(self.img_map.window(crop[0], crop[1], crop[2], crop[3])[:, :, :3])
+            else:
+                region_map = self.img_map.copy(crop[1], crop[0], crop[2], crop[3])
+
+        # rescaling the map to fit the target scale of the network
+        self.statusChanged.emit("Map rescaling..", False)
+
+        w = max(1, int(crop[2] * self.scale_factor))
+        h = max(1, int(crop[3] * self.scale_factor))
+
+        input_img_map = region_map.scaled(w, h, Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+        del region_map
+
+        sx = input_img_map.width() / max(1, crop[2])
+        sy = input_img_map.height() / max(1, crop[3])
+
+        roi = [int(round((box[0] - crop[0]) * sy)), int(round((box[1] - crop[1]) * sx)),
+               int(round(box[2] * sx)), int(round(box[3] * sy))]
+
+        if self.isInterruptionRequested():
+            return None
+
+        self.statusChanged.emit("Classification: ", True)
+
+        # the checkpoints are identified by the file of the map (as the cache of the pyramid), so the pixels
+        # of the map are not hashed
+        map_key = None
+        if self.map_filename is not None and os.path.exists(self.map_filename):
+            map_key = dict(MapPyramid.cacheKey(self.map_filename), crop=crop, scaled=[w, h])
+
+        self.classifier.run(input_img_map, TILE_SIZE, 512, 128, roi=roi, map_key=map_key)
+
+        del input_img_map
+
+        if self.classifier.flagStopProcessing is True or self.isInterruptionRequested():
+            return None
+
+        # import generated label map
+        self.statusChanged.emit("Finalizing classification results..", False)
+
+        return self.annotations.import_class_map(self.classifier.class_map,
+                                                 self.classifier.label_names, box, roi_mask)
+
+    def stop(self, wait=False):
+        """
+        Ask the classification to stop; it stops after the batch of tiles currently processed.
+        """
+
+        self.classifier.stopProcessing()
+        self.requestInterruption()
+
+        if wait:
+            self.wait()
@@ -15,53 +15,157 @@
 # but WITHOUT ANY WARRANTY; without even the implied warranty of            
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the             
 #GNU General Public License (http://www.gnu.org/licenses/gpl.txt)          
-# for more details.                                               
+# for more details.
+
+# ZERO-COPY CONVERSION BETWEEN QIMAGE AND NUMPY ARRAYS.
+#
+# A 32-bit QImage (Format_RGB32, Format_ARGB32) stores each pixel as 0xAARRGGBB, that is B, G, R, A in memory
+# (little-endian). The functions below return NumPy views on the pixels of the QImage, without copies; the
+# channel order is changed by a (negative) stride, so the views are not contiguous. A copy is made only if
+# explicitly requested (copy=True), e.g. when the array is passed to a library that needs contiguous data.
+
 import numpy as np
 
 from PyQt5.QtGui import QImage
 
 
-def qimage2ndarray(image):
-    w = image.width()
-    h = image.height()
-    fmt = image.format()
+class QImageBuffer(object):
+    """
+    Exposes the pixels of a QImage through the NumPy array interface. The arrays created on it keep
+    a reference to the buffer, hence to the QImage, so the pixels remain valid as long as they are used.
+    """
+
+    def __init__(self, qimg):
+
+        self.qimg = qimg
+
+        # bits() detaches the image if its data are shared, so the views never modify other QImages
+        ptr = qimg.bits()
+
+        self.__array_interface__ = {"version": 3,
+                                    "shape": (qimg.height(), qimg.bytesPerLine()),
+                                    "typestr": "|u1",
+                                    "data": (int(ptr), False)}
+
+
+def qimageToBGRA(qimg, copy=False):
+    """
+    Returns the pixels of the QImage as a (h x w x 4) array (B, G, R, A). The array is a view on the
+    QImage, unless copy is True. Images which are not 32-bit are converted first.
+    """
+
+    if qimg.format() not in (QImage.Format_RGB32, QImage.Format_ARGB32, QImage.Format_ARGB32_Premultiplied):
+        qimg = qimg.convertToFormat(QImage.Format_RGB32)
 
-    arr = np.zeros((h, w, 3), dtype=np.uint8)
+    w = qimg.width()
+    h = qimg.height()
 
-    if fmt == QImage.Format_RGB32:
-        bits = image.bits()
-        bits.setsize(h*w*4)
-        arrtemp = np.frombuffer(bits, np.uint8).copy()
-        arrtemp = np.reshape(arrtemp, [h, w, 4])
-        arr[:, :, 0] = arrtemp[:, :, 2]
-        arr[:, :, 1] = arrtemp[:, :, 1]
-        arr[:, :, 2] = arrtemp[:, :, 0]
+    if qimg.isNull():
+        return np.zeros((h, w, 4), dtype=np.uint8)
 
-    elif fmt == QImage.Format_ARGB32:
-        pass
+    # the rows can be padded, so the view is built on the whole scanlines
+    rows = np.asarray(QImageBuffer(qimg))
+    arr = rows[:, :w*4].reshape((h, w, 4))
+
+    if copy:
+        return arr.copy()
 
     return arr
 
 
-def ndarray2qimage(image):
-    h = image.shape[0]
-    w = image.shape[1]
-    ch = image.shape[2]
+def qimageToRGB(qimg, copy=False):
+    """
+    Returns the pixels of the QImage as a (h x w x 3) array (R, G, B). The array is a view on the QImage,
+    unless copy is True (in that case the array is contiguous).
+    """
+
+    arr = qimageToBGRA(qimg)[:, :, 2::-1]
+
+    if copy:
+        return np.ascontiguousarray(arr)
+
+    return arr
 
-    imgdata = np.zeros([h, w, 4], dtype=np.uint8)
+
+def cropToRGB(image, bbox, copy=False):
+    """
+    Returns the given window (bbox = [top, left, width, height]) of a QImage or of a MapImage as a
+    (h x w x 3) array (R, G, B). The pixels outside the image are set to zero. When possible the array
+    is a read-only view (for a MapImage, a view of the memory mapped map), unless copy is True.
+    """
+
+    top = int(bbox[0])
+    left = int(bbox[1])
+    w = int(bbox[2])
+    h = int(bbox[3])
+
+    if isinstance(image, QImage):
+        arr = qimageToRGB(image.copy(left, top, w, h))
+    else:
+        arr = image.window(top, left, w, h)[:, :, 2::-1]
+
+    if copy:
+        return np.ascontiguousarray(arr)
+
+    arr.flags.writeable = False
+    return arr
+
+
+def rgbToQImage(arr):
+    """
+    Creates a QImage from a (h x w x 3) R, G, B array (Format_RGB32) or from a (h x w x 4) A, R, G, B
+    array (Format_ARGB32). The pixels are written directly in the QImage (one copy, no temporary arrays).
+    """
+
+    h = arr.shape[0]
+    w = arr.shape[1]
+    ch = arr.shape[2]
 
     if ch == 3:
-        imgdata[:, :, 2] = image[:, :, 0]
-        imgdata[:, :, 1] = image[:, :, 1]
-        imgdata[:, :, 0] = image[:, :, 2]
-        imgdata[:, :, 3] = 255
-        qimg = QImage(imgdata.data, w, h, QImage.Format_RGB32)
-
-    elif ch == 4:
-        imgdata[:, :, 3] = image[:, :, 0]
-        imgdata[:, :, 2] = image[:, :, 1]
-        imgdata[:, :, 1] = image[:, :, 2]
-        imgdata[:, :, 0] = image[:, :, 3]
-        qimg = QImage(imgdata.data, w, h, QImage.Format_ARGB32)
-
-    return qimg.copy()
\ No newline at end of file
+        qimg = QImage(w, h, QImage.Format_RGB32)
+        dest = qimageToBGRA(qimg)
+        dest[:, :, :3] = arr[:, :, ::-1]
+        dest[:, :, 3] = 255
+    else:
+        qimg = QImage(w, h, QImage.Format_ARGB32)
+        dest = qimageToBGRA(qimg)
+        dest[:] = arr[:, :, ::-1]
+
+    return qimg
+
+
+def qimage2ndarray(image):
+
+    return qimageToRGB(image, copy=True)
+
+
+def ndarray2qimage(image):
+
+    return rgbToQImage(image)
+
+
+def colorizeLabels(labels, lut, fmt=QImage.Format_ARGB32):
+    """
+    Creates a QImage from a (h x w) map of non-negative integer labels: each pixel takes the color of its
+    label in the lookup table (a list or array of qRgb/qRgba values). The lookup is done with a single
+    NumPy operation that writes directly in the pixels of the QImage.
+    """
+
+    labels = np.asarray(labels)
+    if labels.dtype == bool:
+        labels = labels.view(np.uint8)
+
+    h = labels.shape[0]
+    w = labels.shape[1]
+
+    qimg = QImage(w, h, fmt)
+    if w == 0 or h == 0:
+        return qimg
+
+    lut = np.asarray(lut, dtype=np.uint32)
+
+    # a 32-bit pixel 0xAARRGGBB, as in the lookup table
+    pixels = qimageToBGRA(qimg).view(np.uint32)[:, :, 0]
+    np.take(lut, labels, out=pixels, mode="clip")
+
+    return qimg
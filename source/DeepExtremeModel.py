@@ -0,0 +1,258 @@
+# TagLab
+# A semi-automatic segmentation tool
+#
+# Copyright(C) 2019
+# Visual Computing Lab
+# ISTI - Italian National Research Council
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License (http://www.gnu.org/licenses/gpl.txt)
+# for more details.
+
+import os
+import threading
+import numpy as np
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import torch
+from torch.nn.functional import interpolate
+
+from PyQt5.QtCore import QThread, pyqtSignal
+
+import models.deeplab_resnet as resnet
+from models.dataloaders import helpers as helpers
+
+from source import utils
+
+
+class DeepExtremeModel(QThread):
+    """
+    The network of the DeepExtreme (4-click) tool. It is loaded once, in background, and it stays in memory
+    until the application ends. Without CUDA the network is traced and frozen (the graph is saved next to the
+    weights, so it is traced only once) and it runs with a fixed number of threads (restored afterwards, since the
+    number of threads of torch is a setting of the whole process).
+    The network is warmed up when it is loaded, so the time of a segmentation does not depend on how many
+    segmentations have been done before.
+    """
+
+    # True if the network has been loaded, False otherwise (see error)
+    modelLoaded = pyqtSignal(bool)
+
+    MODEL_NAME = "dextr_corals"
+
+    # size of the input (4 channels: RGB and heatmap of the extreme points)
+    INPUT_SIZE = 512
+
+    # padding of the crop of the map around the extreme points, and of the input of the network around them
+    PAD_MAP = 100
+    PAD = 50
+
+    # threshold on the probability of the segmentation
+    THRESHOLD = 0.8
+
+    def __init__(self, models_dir="models", num_threads=0, parent=None):
+        super(DeepExtremeModel, self).__init__(parent)
+
+        self.weights_filename = os.path.join(models_dir, self.MODEL_NAME + ".pth")
+        self.exported_filename = os.path.join(models_dir, self.MODEL_NAME + ".torchscript.pt")
+
+        # number of threads used on the CPU (0 = number of cores)
+        self.num_threads = num_threads if num_threads > 0 else (os.cpu_count() or 1)
+
+        self.device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+
+        self.net = None
+
+        # message of the error that prevented the loading (if any)
+        self.error = None
+
+        # the network can be used by the GUI and by the DeepExtremeWorker
+        self.lock = threading.Lock()
+
+    def isLoaded(self):
+
+        return self.net is not None
+
+    def load(self):
+        """
+        Start the loading of the network in background (if it is not loaded or loading).
+        """
+
+        if self.net is None and not self.isRunning():
+            self.error = None
+            self.start()
+
+    def run(self):
+
+        try:
+            net = self.loadNetwork()
+        except Exception as e:
+            self.error = str(e)
+            self.modelLoaded.emit(False)
+            return
+
+        self.net = net
+        self.modelLoaded.emit(True)
+
+    def buildNetwork(self):
+
+        #  Create the network and load the weights
+        net = resnet.resnet101(1, nInputChannels=4, classifier='psp')
+
+        # dictionary layers' names - weights
+        state_dict_checkpoint = torch.load(self.weights_filename, map_location=lambda storage, loc: storage)
+
+        # Remove the prefix .module from the model when it is trained using DataParallel
+        if 'module.' in list(state_dict_checkpoint.keys())[0]:
+            new_state_dict = OrderedDict()
+            for k, v in state_dict_checkpoint.items():
+                name = k[7:]  # remove `module.` from multi-gpu training
+                new_state_dict[name] = v
+        else:
+            new_state_dict = state_dict_checkpoint
+
+        net.load_state_dict(new_state_dict)
+        net.eval()
+
+        return net
+
+    @contextmanager
+    def cpuThreads(self):
+        """
+        Use num_threads threads on the CPU, then restore the previous number of threads.
+        """
+
+        if self.device.type != "cpu":
+            yield
+            return
+
+        previous_threads = torch.get_num_threads()
+        torch.set_num_threads(self.num_threads)
+        try:
+            yield
+        finally:
+            torch.set_num_threads(previous_threads)
+
+    def loadNetwork(self):
+
+        with self.cpuThreads():
+            return self.createNetwork()
+
+    def createNetwork(self):
+
+        example = torch.zeros(1, 4, self.INPUT_SIZE, self.INPUT_SIZE)
+
+        if torch.cuda.is_available():
+            net = self.buildNetwork()
+            net.to(self.device)
+        else:
+            exported = os.path.exists(self.exported_filename)
+            if exported and os.path.exists(self.weights_filename):
+                exported = os.path.getmtime(self.exported_filename) >= os.path.getmtime(self.weights_filename)
+
+            # NOTE: the graph is not converted to MKLDNN (torch.jit.optimize_for_inference), since the
+            # adaptive pooling of the PSP module does not support it for these sizes
+            if exported:
+                net = torch.jit.load(self.exported_filename, map_location="cpu")
+            else:
+                with torch.no_grad():
+                    net = torch.jit.freeze(torch.jit.trace(self.buildNetwork(), example))
+
+                try:
+                    net.save(self.exported_filename)
+                except (OSError, RuntimeError):
+                    pass
+
+        # the first runs are slower (memory allocation, optimization of the graph)
+        with torch.no_grad():
+            for i in range(2):
+                net(example.to(self.device))
+
+        return net
+
+    def predict(self, inputs):
+        """
+        Run the network on a batch of inputs (N x 4 x INPUT_SIZE x INPUT_SIZE); the outputs are on the CPU.
+        If the network is still loading it waits for it; if the loading has not been started the network is loaded now.
+        """
+
+        if self.net is None:
+            if self.isRunning():
+                self.wait()
+
+        with self.lock:
+
+            if self.net is None:
+                self.error = None
+                self.net = self.loadNetwork()
+
+            with torch.no_grad(), self.cpuThreads():
+                outputs = self.net(inputs.to(self.device))
+
+        return outputs.to(torch.device("cpu"))
+
+    def prepareInput(self, img_map, extreme_points):
+        """
+        Crop the map (QImage or MapImage) around the extreme points (4 x 2 array of x, y map coordinates) and
+        create the input of the network (1 x 4 x INPUT_SIZE x INPUT_SIZE): the resized crop and the heatmap of
+        the points. It returns the input and the data needed by segmentationMask().
+        """
+
+        left_map_pos = extreme_points[:, 0].min() - self.PAD_MAP
+        top_map_pos = extreme_points[:, 1].min() - self.PAD_MAP
+
+        width_extreme_points = extreme_points[:, 0].max() - extreme_points[:, 0].min()
+        height_extreme_points = extreme_points[:, 1].max() - extreme_points[:, 1].min()
+        area_extreme_points = width_extreme_points * height_extreme_points
+
+        (img, extreme_points_new) = utils.prepareForDeepExtreme(img_map, extreme_points, self.PAD_MAP)
+
+        extreme_points_ori = extreme_points_new.astype(int)
+
+        #  Crop image to the bounding box from the extreme points and resize
+        bbox = helpers.get_bbox(img, points=extreme_points_ori, pad=self.PAD, zero_pad=True)
+        crop_image = helpers.crop_from_bbox(img, bbox, zero_pad=True)
+        resize_image = helpers.fixed_resize(crop_image, (self.INPUT_SIZE, self.INPUT_SIZE)).astype(np.float32)
+
+        #  Generate extreme point heat map normalized to image values
+        points = extreme_points_ori - [np.min(extreme_points_ori[:, 0]),
+                                       np.min(extreme_points_ori[:, 1])] + [self.PAD, self.PAD]
+
+        # remap the input points inside the INPUT_SIZE x INPUT_SIZE cropped box
+        points = (self.INPUT_SIZE * points * [1 / crop_image.shape[1], 1 / crop_image.shape[0]]).astype(int)
+
+        # create the heatmap (float32, on the input of the network only)
+        extreme_heatmap = helpers.make_heatmap(resize_image.shape[:2], points, sigma=10)
+        extreme_heatmap = helpers.cstm_normalize(extreme_heatmap, 255)
+
+        #  Concatenate inputs and convert to tensor
+        input_dextr = np.concatenate((resize_image, extreme_heatmap[:, :, np.newaxis]), axis=2)
+        inputs = torch.from_numpy(input_dextr.transpose((2, 0, 1))[np.newaxis, ...])
+
+        return (inputs, (bbox, img.shape[:2], left_map_pos, top_map_pos, area_extreme_points))
+
+    def segmentationMask(self, output, context):
+        """
+        The segmentation mask of an output of the network (1 x h x w), given the data returned by prepareInput().
+        The mask covers only the bounding box of the extreme points (plus the padding); it returns the mask,
+        its left and top in the map and the area of the bounding box of the extreme points.
+        """
+
+        (bbox, im_size, left_map_pos, top_map_pos, area_extreme_points) = context
+
+        output = interpolate(output.unsqueeze(0), size=(self.INPUT_SIZE, self.INPUT_SIZE), mode='bilinear', align_corners=True)
+
+        pred = output.data.numpy()[0, 0]
+        pred = 1 / (1 + np.exp(-pred))
+        (pred, (x, y)) = helpers.crop2localmask(pred, bbox, im_size, relax=self.PAD)
+
+        return ((pred > np.float64(self.THRESHOLD)).astype(np.uint8), left_map_pos + x, top_map_pos + y, area_extreme_points)
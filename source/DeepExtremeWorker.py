@@ -0,0 +1,100 @@
+# TagLab
+# A semi-automatic segmentation tool
+#
+# Copyright(C) 2019
+# Visual Computing Lab
+# ISTI - Italian National Research Council
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License (http://www.gnu.org/licenses/gpl.txt)
+# for more details.
+
+import queue
+
+import torch
+
+from PyQt5.QtCore import QThread, pyqtSignal
+
+
+class DeepExtremeWorker(QThread):
+    """
+    Queue of the DeepExtreme segmentations: the extreme points picked by the user are queued and the worker
+    segments them in background, in batches of the pending segmentations, so the user can continue to pick
+    the points of the next colonies. The segmentation masks are delivered to the main thread as soon as
+    they are ready, in the order the points have been picked.
+    """
+
+    # (extreme points, segmentation mask, left, top, area of the bounding box of the points)
+    segmentationDone = pyqtSignal(object)
+
+    # message of the error, number of segmentations discarded
+    segmentationFailed = pyqtSignal(str, int)
+
+    MAX_BATCH_SIZE = 4
+
+    def __init__(self, model, img_map, parent=None):
+        super(DeepExtremeWorker, self).__init__(parent)
+
+        self.model = model
+        self.img_map = img_map
+
+        self.tasks = queue.Queue()
+
+    def addPoints(self, extreme_points):
+
+        self.tasks.put(extreme_points)
+
+        if not self.isRunning():
+            self.start()
+
+    def run(self):
+
+        while not self.isInterruptionRequested():
+
+            # wait for the next segmentation, then take all the pending ones (up to the batch size)
+            try:
+                batch = [self.tasks.get(timeout=0.5)]
+            except queue.Empty:
+                continue
+
+            while len(batch) < self.MAX_BATCH_SIZE:
+                try:
+                    batch.append(self.tasks.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                prepared = [self.model.prepareInput(self.img_map, points) for points in batch]
+                outputs = self.model.predict(torch.cat([inputs for (inputs, context) in prepared]))
+            except Exception as e:
+                self.segmentationFailed.emit(str(e), len(batch))
+                continue
+
+            for i, points in enumerate(batch):
+
+                if self.isInterruptionRequested():
+                    return
+
+                try:
+                    (mask, left, top, area) = self.model.segmentationMask(outputs[i], prepared[i][1])
+                except Exception as e:
+                    self.segmentationFailed.emit(str(e), 1)
+                    continue
+
+                self.segmentationDone.emit((points, mask, left, top, area))
+
+    def stop(self):
+        """
+        Discard the pending segmentations and wait for the worker to finish.
+        """
+
+        self.requestInterruption()
+        self.wait()
@@ -0,0 +1,70 @@
+# TagLab
+# A semi-automatic segmentation tool
+#
+# Copyright(C) 2019
+# Visual Computing Lab
+# ISTI - Italian National Research Council
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License (http://www.gnu.org/licenses/gpl.txt)
+# for more details.
+
+""" Inference of the classifiers in the processes of the CPU inference pool (see MapClassifier.poolOutputs()).
+The module imports only torch. NOTE: the processes are started with the spawn method, so each of them also
+re-imports the main script (TagLab.py, with PyQt and the modules of the GUI); importing it has no side effects,
+but it makes the start of the pool slower.
+"""
+
+import torch
+
+
+def runNetwork(net, input, precision):
+    """
+    Forward pass of the network. With "bfloat16" precision the operations run in reduced precision
+    (autocast); the outputs are always float32.
+    """
+
+    if precision == "bfloat16":
+        with torch.autocast(input.device.type, dtype=torch.bfloat16):
+            return net(input).float()
+
+    return net(input)
+
+
+def inferenceProcess(net, precision, num_threads, tasks, results):
+    """
+    Body of the processes of the CPU inference pool: it classifies the batches of tiles received from the
+    tasks queue (until None is received) and puts the outputs in the results queue. The weights of the
+    network are in shared memory.
+    """
+
+    torch.set_num_threads(num_threads)
+
+    # an exported (TorchScript) network is loaded from its file
+    if isinstance(net, str):
+        net = torch.jit.optimize_for_inference(torch.jit.load(net, map_location="cpu"))
+
+    net.eval()
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+
+        (b, input) = task
+        try:
+            with torch.no_grad():
+                outputs = runNetwork(net, input, precision)
+        except Exception as e:
+            results.put((b, RuntimeError(str(e))))
+            break
+
+        results.put((b, outputs))
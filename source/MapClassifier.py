@@ -19,7 +19,13 @@
 
 import os
 import math
+import time
+import json
+import shutil
+import hashlib
+import queue
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 
 # PYTORCH
 import torch
@@ -31,10 +37,12 @@ from models.dataloaders import helpers as helpers
 # DEEPLAB V3+
 from models.deeplab import DeepLab
 
-from PyQt5.QtCore import QCoreApplication, Qt, QObject, pyqtSlot, pyqtSignal
-from PyQt5.QtGui import QPainter, QImage, QColor, QPixmap, qRgb, qRed, qGreen, qBlue
+from PyQt5.QtCore import QObject, pyqtSignal
+from PyQt5.QtGui import QImage, qRgb
 
 from source import utils
+from source.InferenceProcess import runNetwork, inferenceProcess
+
 
 class MapClassifier(QObject):
     """
@@ -47,6 +55,35 @@ class MapClassifier(QObject):
     # custom signal
     updateProgress = pyqtSignal(float)
 
+    # rough estimation of the memory (in bytes) needed to classify a pixel of a tile (activations included)
+    MEMORY_PER_PIXEL = 400
+
+    MAX_BATCH_SIZE = 36
+
+    # maps with more pixels than this are classified into a memory-mapped array (temp/classmap.raw)
+    MEMMAP_PIXELS = 200 * 1024 * 1024
+
+    # value of the pixels of the class map that are not classified
+    NOT_CLASSIFIED = 255
+
+    # minimum interval (in seconds) between two progress updates
+    PROGRESS_INTERVAL = 0.25
+
+    # the classified tiles are saved here, so an interrupted classification can be resumed
+    CHECKPOINTS_DIR = os.path.join("temp", "checkpoints")
+
+    # number of (most recent) classifications whose checkpoints are kept
+    MAX_CHECKPOINTS = 4
+
+    # network already loaded (on CPU), shared by all the classifiers: filename -> (modification time, network);
+    # only the most recently used network is kept
+    loaded_networks = {}
+
+    # (filename, modification time) -> hash of the file
+    file_hashes = {}
+
+    PRECISIONS = ["float32", "bfloat16", "int8"]
+
     def __init__(self, classifier_info, labels_info, parent=None):
         super(QObject, self).__init__(parent)
 
@@ -66,34 +103,470 @@ class MapClassifier(QObject):
             self.label_colors.append(color)
 
         self.average_norm = classifier_info['Average Norm.']
+
+        # "float32", "bfloat16" (reduced precision, CPU with AVX512-BF16/AMX or GPU) or "int8" (quantized network,
+        # CPU only, exported by ClassifierExport); without the quantized network, float32 is used
+        self.precision = classifier_info.get('Precision', 'float32')
+        if self.precision not in self.PRECISIONS:
+            self.precision = 'float32'
+
         self.net = self._load_classifier(classifier_info['Weights'])
+        self.weights_hash = self.fileHash(os.path.join("models", classifier_info['Weights']))
+
+        # number of tiles classified at once (0 means that it is chosen according to the available memory)
+        self.batch_size = classifier_info.get('Batch Size', 0)
+
+        # without CUDA, the tiles can be classified by a pool of 'Workers' processes (0 = no pool),
+        # each one using 'Threads Per Worker' threads (0 = the cores are divided among the workers)
+        self.workers = classifier_info.get('Workers', 0)
+        self.threads_per_worker = classifier_info.get('Threads Per Worker', 0)
+
+        # throughput of the last classification
+        self.tiles_per_second = 0.0
+
+        # "Shift": each output tile is classified 9 times, shifting the input tile by AGGREGATION_STEP
+        # "Grid": the network runs once on a regular grid of overlapping tiles (stride 'Grid Stride', 0 = TILE_SIZE / 3)
+        self.aggregation = classifier_info.get('Aggregation', 'Shift')
+        self.grid_stride = classifier_info.get('Grid Stride', 0)
+
+        # "Average": average of the probabilities (softmax) of the tiles
+        # "Bayesian": Bayesian fusion of the scores of the tiles, weighted by the 'Prior' probabilities of the classes
+        self.fusion = classifier_info.get('Fusion', 'Average')
+        self.prior = classifier_info.get('Prior', None)
+
+        # class index of each pixel of the classified map (uint8, H x W)
+        self.class_map = None
+
+        # folder of the checkpoints of the current classification
+        self.checkpoint_dir = None
 
         self.flagStopProcessing = False
         self.processing_step = 0
         self.total_processing_steps = 0
+        self.last_progress_time = 0.0
+
+
+    @staticmethod
+    def exportedFilename(network_name, precision="float32"):
+        """
+        Name of the TorchScript graph exported from the given weights (see ClassifierExport).
+        """
+
+        if precision == "int8":
+            return os.path.splitext(network_name)[0] + ".int8.torchscript.pt"
+
+        return os.path.splitext(network_name)[0] + ".torchscript.pt"
+
+    @staticmethod
+    def isExported(network_name, precision="float32"):
+        """
+        True if the exported graph exists and it is not older than the weights.
+        """
 
+        exported_name = MapClassifier.exportedFilename(network_name, precision)
+        if not os.path.exists(exported_name):
+            return False
+
+        if os.path.exists(network_name):
+            return os.path.getmtime(exported_name) >= os.path.getmtime(network_name)
+
+        return True
+
+    @staticmethod
+    def buildNetwork(network_name, nclasses):
+
+        classifier_pocillopora = DeepLab(backbone='resnet', output_stride=16, num_classes=nclasses)
+        classifier_pocillopora.load_state_dict(torch.load(network_name, map_location="cpu"))
+
+        classifier_pocillopora.eval()
+
+        return classifier_pocillopora
 
     def _load_classifier(self, modelName):
+        """
+        Load the network (or reuse the one loaded last, if it is the same). Without CUDA the exported TorchScript
+        graph is used, if it exists and it is not older than the weights. The autocast of the bfloat16 precision
+        does not apply to the TorchScript graphs, so in this case the original network is used.
+        """
 
         models_dir = "models/"
 
         network_name = os.path.join(models_dir, modelName)
 
-        classifier_pocillopora = DeepLab(backbone='resnet', output_stride=16, num_classes=self.nclasses)
-        classifier_pocillopora.load_state_dict(torch.load(network_name))
+        # the quantized network runs only on the CPU
+        if self.precision == "int8" and (torch.cuda.is_available() or not self.isExported(network_name, "int8")):
+            self.precision = "float32"
 
-        classifier_pocillopora.eval()
+        exported_name = self.exportedFilename(network_name, self.precision)
 
-        return classifier_pocillopora
+        use_exported = not torch.cuda.is_available() and self.precision != "bfloat16" and self.isExported(network_name, self.precision)
+
+        self.net_filename = exported_name if use_exported else network_name
+
+        mtime = os.path.getmtime(self.net_filename)
+        loaded = MapClassifier.loaded_networks.get(self.net_filename)
+        if loaded is not None and loaded[0] == mtime:
+            return loaded[1]
+
+        if use_exported:
+            net = torch.jit.optimize_for_inference(torch.jit.load(exported_name, map_location="cpu"))
+        else:
+            net = self.buildNetwork(network_name, self.nclasses)
 
+        MapClassifier.releaseNetworks()
+        MapClassifier.loaded_networks[self.net_filename] = (mtime, net)
 
-    def run(self, img_map, TILE_SIZE, AGGREGATION_WINDOW_SIZE, AGGREGATION_STEP):
+        return net
+
+    @staticmethod
+    def releaseNetworks():
+        """
+        Free the memory of the networks loaded so far.
+        """
+
+        MapClassifier.loaded_networks.clear()
+
+
+    @staticmethod
+    def availableMemory():
+        """
+        Available memory (in bytes) of the device used for the classification.
         """
 
+        if torch.cuda.is_available() and hasattr(torch.cuda, "mem_get_info"):
+            (free, total) = torch.cuda.mem_get_info()
+            return free
+
+        try:
+            import psutil
+            return psutil.virtual_memory().available
+        except ImportError:
+            pass
+
+        try:
+            return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+        except (AttributeError, ValueError, OSError):
+            return 2 * 1024 * 1024 * 1024
+
+    def batchSize(self, tile_size):
+
+        if self.batch_size > 0:
+            return self.batch_size
+
+        # only half of the available memory is used
+        tile_memory = tile_size * tile_size * self.MEMORY_PER_PIXEL
+        batch_size = int(self.availableMemory() * 0.5 / tile_memory)
+
+        return max(1, min(batch_size, self.MAX_BATCH_SIZE))
+
+    def prepareTile(self, img_map, top, left, tile_size, average_norm, out):
+        """
+        Crop a tile from the map and normalize it as the network expects (C x H x W, float).
+        """
+
+        # H x W x C (view on the map) --> C x H x W
+        out[:] = utils.cropToRGB(img_map, [top, left, tile_size, tile_size]).transpose(2, 0, 1)
+        out /= 255.0
+
+        # Normalization (average subtraction)
+        out -= average_norm
+
+    def createClassMap(self, W, H, temp_dir):
+
+        if W * H > self.MEMMAP_PIXELS:
+            filename = os.path.join(temp_dir, "classmap.raw")
+            class_map = np.memmap(filename, dtype=np.uint8, mode="w+", shape=(H, W))
+        else:
+            class_map = np.empty((H, W), dtype=np.uint8)
+
+        class_map.fill(self.NOT_CLASSIFIED)
+        return class_map
+
+    def classifyBatches(self, img_map, inputs, TILE_SIZE):
+        """
+        Classify the tiles of the map in batches. inputs is a list of tuples whose last two elements are
+        the top and the left of the tile; it yields the batches of inputs with the corresponding outputs
+        of the network (a tensor on the device of the network). The outputs are yielded in the order of the inputs.
+        """
+
+        use_pool = self.workers > 0 and not torch.cuda.is_available()
+
+        average_norm = np.asarray(self.average_norm, dtype=np.float32).reshape(3, 1, 1)
+
+        batch_size = self.batchSize(TILE_SIZE)
+        if use_pool and self.batch_size <= 0:
+            # the memory is divided among the workers
+            batch_size = max(1, batch_size // self.workers)
+
+        batches = [inputs[i:i+batch_size] for i in range(0, len(inputs), batch_size)]
+
+        # the next batches are prepared by the thread pool while the network processes the current one
+        executor = ThreadPoolExecutor(max_workers=max(2, min(8, os.cpu_count() or 1)))
+
+        def prepareBatch(b):
+            batch = batches[b]
+            batch_np = np.empty((len(batch), 3, TILE_SIZE, TILE_SIZE), dtype=np.float32)
+            futures = [executor.submit(self.prepareTile, img_map, tile[-2], tile[-1], TILE_SIZE, average_norm, batch_np[n])
+                       for n, tile in enumerate(batch)]
+            return (batch_np, futures)
+
+        if use_pool:
+            outputs_iterator = self.poolOutputs(batches, prepareBatch)
+        else:
+            outputs_iterator = self.localOutputs(batches, prepareBatch)
+
+        start_time = time.time()
+        classified_tiles = 0
+
+        try:
+            for (b, outputs) in outputs_iterator:
+
+                classified_tiles += len(batches[b])
+                yield (batches[b], outputs)
+
+        finally:
+            outputs_iterator.close()
+            executor.shutdown(wait=True)
+
+            elapsed = time.time() - start_time
+            self.tiles_per_second = classified_tiles / elapsed if elapsed > 0.0 else 0.0
+
+    def localOutputs(self, batches, prepareBatch):
+        """
+        Classify the batches in this process (on the GPU if available).
+        """
+
+        if torch.cuda.is_available():
+            device = torch.device("cuda")
+            self.net.to(device)
+            torch.cuda.synchronize()
+
+        self.net.eval()
+
+        next_batch = prepareBatch(0) if len(batches) > 0 else None
+
+        for b in range(len(batches)):
+
+            if self.flagStopProcessing is True:
+                break
+
+            (batch_np, futures) = next_batch
+            for future in futures:
+                future.result()
+
+            if b + 1 < len(batches):
+                next_batch = prepareBatch(b+1)
+
+            with torch.no_grad():
+
+                input = torch.from_numpy(batch_np)
+
+                if torch.cuda.is_available():
+                    input = input.to(device)
+
+                outputs = runNetwork(self.net, input, self.precision)
+
+            yield (b, outputs)
+
+    def poolOutputs(self, batches, prepareBatch):
+        """
+        Classify the batches with a pool of processes (CPU only). The weights are moved in shared memory,
+        so each process receives them only once; the batches are distributed to the free processes and
+        the outputs are yielded in order.
+        """
+
+        threads = self.threads_per_worker
+        if threads <= 0:
+            threads = max(1, (os.cpu_count() or 1) // self.workers)
+
+        self.net.eval()
+
+        # a TorchScript graph cannot be sent to the processes, they load it from its file
+        if isinstance(self.net, torch.jit.ScriptModule):
+            net = self.net_filename
+        else:
+            self.net.share_memory()
+            net = self.net
+
+        context = torch.multiprocessing.get_context("spawn")
+        tasks = context.Queue()
+        results = context.Queue()
+
+        processes = [context.Process(target=inferenceProcess, args=(net, self.precision, threads, tasks, results), daemon=True)
+                     for _ in range(self.workers)]
+        for process in processes:
+            process.start()
+
+        # a couple of batches per process are queued, so the processes never wait for the inputs
+        max_queued = 2 * self.workers
+
+        try:
+            submitted = 0
+            received = {}
+
+            for b in range(len(batches)):
+
+                if self.flagStopProcessing is True:
+                    break
+
+                while submitted < len(batches) and submitted - b < max_queued:
+                    (batch_np, futures) = prepareBatch(submitted)
+                    for future in futures:
+                        future.result()
+                    tasks.put((submitted, torch.from_numpy(batch_np)))
+                    submitted += 1
+
+                while b not in received:
+                    try:
+                        (b_received, outputs) = results.get(timeout=1.0)
+                    except queue.Empty:
+                        if not all(process.is_alive() for process in processes):
+                            raise RuntimeError("A classification process terminated unexpectedly.")
+                        continue
+
+                    if isinstance(outputs, Exception):
+                        raise outputs
+
+                    received[b_received] = outputs
+
+                yield (b, received.pop(b))
+
+        finally:
+            for process in processes:
+                tasks.put(None)
+
+            for process in processes:
+                process.join(timeout=5.0)
+                if process.is_alive():
+                    process.terminate()
+
+    @staticmethod
+    def fileHash(filename):
+
+        try:
+            key = (filename, os.path.getmtime(filename))
+        except OSError:
+            return ""
+
+        if key in MapClassifier.file_hashes:
+            return MapClassifier.file_hashes[key]
+
+        digest = hashlib.blake2b(digest_size=16)
+        try:
+            with open(filename, "rb") as f:
+                for chunk in iter(lambda: f.read(16 * 1024 * 1024), b""):
+                    digest.update(chunk)
+        except OSError:
+            return ""
+
+        MapClassifier.file_hashes[key] = digest.hexdigest()
+        return MapClassifier.file_hashes[key]
+
+    @staticmethod
+    def mapHash(img_map, box, margin):
+        """
+        Hash of the pixels of the map (QImage or MapImage) used to classify the box (top, left, width, height),
+        i.e. the box plus the given margin, computed by horizontal stripes.
+        """
+
+        W = img_map.width()
+        H = img_map.height()
+
+        top = max(0, box[0] - margin)
+        left = max(0, box[1] - margin)
+        bottom = min(H, box[0] + box[3] + margin)
+        right = min(W, box[1] + box[2] + margin)
+
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update("{:d}x{:d}".format(W, H).encode())
+
+        STRIPE = 256
+        for y in range(top, bottom, STRIPE):
+            stripe = utils.cropToRGB(img_map, [y, left, right - left, min(STRIPE, bottom - y)])
+            digest.update(np.ascontiguousarray(stripe).data)
+
+        return digest.hexdigest()
+
+    def openCheckpoint(self, img_map, box, TILE_SIZE, AGGREGATION_WINDOW_SIZE, AGGREGATION_STEP, map_key=None):
+        """
+        Prepare the folder of the checkpoints of this classification. The folder is identified by the map,
+        the weights and the parameters of the classification, so the tiles saved by a previous
+        (interrupted) run are reused only if nothing has changed. The map is identified by map_key (e.g. the
+        file of the map and how it has been rescaled); without it, by the pixels used by the classification.
+        """
+
+        params = {
+            "map": map_key if map_key is not None else self.mapHash(img_map, box, TILE_SIZE),
+            "weights": getattr(self, "weights_hash", ""),
+            "classes": self.nclasses,
+            "average norm": list(self.average_norm),
+            "box": [int(v) for v in box],
+            "tile size": TILE_SIZE,
+            "aggregation window size": AGGREGATION_WINDOW_SIZE,
+            "aggregation step": AGGREGATION_STEP,
+            "aggregation": self.aggregation,
+            "grid stride": self.grid_stride,
+            "fusion": self.fusion,
+            "prior": self.prior,
+            "precision": getattr(self, "precision", "float32")
+        }
+
+        key = hashlib.blake2b(json.dumps(params, sort_keys=True).encode(), digest_size=16).hexdigest()
+
+        self.checkpoint_dir = os.path.join(self.CHECKPOINTS_DIR, key)
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+
+        manifest = os.path.join(self.checkpoint_dir, "manifest.json")
+        with open(manifest, "w") as f:
+            json.dump(params, f, indent=1)
+        os.utime(self.checkpoint_dir)
+
+        # only the checkpoints of the most recent classifications are kept
+        folders = [os.path.join(self.CHECKPOINTS_DIR, name) for name in os.listdir(self.CHECKPOINTS_DIR)]
+        folders = sorted([folder for folder in folders if os.path.isdir(folder)], key=os.path.getmtime, reverse=True)
+        for folder in folders[self.MAX_CHECKPOINTS:]:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    def saveCheckpoint(self, name, array):
+
+        if self.checkpoint_dir is None:
+            return
+
+        filename = os.path.join(self.checkpoint_dir, name + ".npy")
+        temp_filename = filename + ".tmp"
+        with open(temp_filename, "wb") as f:
+            np.save(f, array)
+        os.replace(temp_filename, filename)
+
+    def loadCheckpoint(self, name):
+
+        if self.checkpoint_dir is None:
+            return None
+
+        filename = os.path.join(self.checkpoint_dir, name + ".npy")
+        if not os.path.exists(filename):
+            return None
+
+        try:
+            return np.load(filename)
+        except (OSError, ValueError):
+            return None
+
+    def run(self, img_map, TILE_SIZE, AGGREGATION_WINDOW_SIZE, AGGREGATION_STEP, debug=False, roi=None, map_key=None):
+        """
+        The predicted class indices are stored in self.class_map, a uint8 array of the size of the region
+        of interest (self.class_map_box).
+
         :param TILE_SIZE: Base tile. This corresponds to the INPUT SIZE of the network.
         :param AGGREGATION_WINDOW_SIZE: Size of the sub-windows to consider for the aggregation.
         :param AGGREGATION_STEP: Step, in pixels, to calculate the different scores.
+        :param debug: if True, the classified tiles and the label map are saved (as colors) in the temp folder.
+        :param roi: region of interest [top, left, width, height]; only the tiles that intersect it are classified.
+        :param map_key: JSON-serializable identifier of the map for the checkpoints (see openCheckpoint()).
         :return:
+
+        The classified tiles are saved in CHECKPOINTS_DIR; if the same classification has been interrupted
+        the tiles already classified are not classified again.
         """
 
         # create a temporary folder to store the processing
@@ -101,6 +574,45 @@ class MapClassifier(QObject):
         if not os.path.exists(temp_dir):
             os.mkdir(temp_dir)
 
+        W = img_map.width()
+        H = img_map.height()
+
+        if roi is None:
+            roi = [0, 0, W, H]
+
+        # top, left, width, height (clipped to the map)
+        top = max(0, int(roi[0]))
+        left = max(0, int(roi[1]))
+        box = [top, left, max(0, min(int(roi[2]), W - left)), max(0, min(int(roi[3]), H - top))]
+
+        self.class_map = None
+        self.class_map_box = None
+        class_map = self.createClassMap(box[2], box[3], temp_dir)
+
+        self.last_progress_time = 0.0
+
+        self.openCheckpoint(img_map, box, TILE_SIZE, AGGREGATION_WINDOW_SIZE, AGGREGATION_STEP, map_key)
+
+        if self.aggregation == "Grid":
+            self.runGrid(img_map, class_map, box, TILE_SIZE)
+        else:
+            self.runShift(img_map, class_map, box, TILE_SIZE, AGGREGATION_WINDOW_SIZE, AGGREGATION_STEP, temp_dir, debug)
+
+        if self.flagStopProcessing is False:
+            self.class_map = class_map
+            self.class_map_box = box
+
+            if debug:
+                labelfile = os.path.join(temp_dir, "labelmap.png")
+                self.colorize(class_map).save(labelfile)
+
+        # the network is kept (on CPU) for the next classifications
+        if torch.cuda.is_available():
+            self.net.to(torch.device("cpu"))
+            torch.cuda.empty_cache()
+
+    def runShift(self, img_map, class_map, box, TILE_SIZE, AGGREGATION_WINDOW_SIZE, AGGREGATION_STEP, temp_dir, debug):
+
         # prepare for running..
         STEP_SIZE = AGGREGATION_WINDOW_SIZE
 
@@ -108,7 +620,7 @@ class MapClassifier(QObject):
         H = img_map.height()
 
         # top, left, width, height
-        working_area = [0, 0, W, H]
+        working_area = box
 
         wa_top = working_area[0]
         wa_left = working_area[1]
@@ -130,193 +642,230 @@ class MapClassifier(QObject):
         tile_cols = int(wa_width / AGGREGATION_WINDOW_SIZE) + 1
         tile_rows = int(wa_height / AGGREGATION_WINDOW_SIZE) + 1
 
-        if torch.cuda.is_available():
-            device = torch.device("cuda")
-            self.net.to(device)
-            torch.cuda.synchronize()
-
-        self.net.eval()
+        # the tiles are clipped to the working area
+        wa_right = wa_left + wa_width - 1
+        wa_bottom = wa_top + wa_height - 1
 
         # classification (per-tiles)
         tiles_number = tile_rows * tile_cols
 
         self.processing_step = 0
-        self.total_processing_steps = 19 * tiles_number
+        self.total_processing_steps = 10 * tiles_number
 
+        # each tile is classified 9 times, shifting it by AGGREGATION_STEP, and the scores are aggregated;
+        # the shifted tiles of all the tiles are processed in batches
+        inputs = []
         for row in range(tile_rows):
-
-            if self.flagStopProcessing is True:
-                break
-
             for col in range(tile_cols):
 
-                if self.flagStopProcessing is True:
-                    break
-
-                scores = np.zeros((9, self.nclasses, TILE_SIZE, TILE_SIZE))
+                # tile classified by a previous (interrupted) run
+                preds = self.loadCheckpoint("tile_{:d}_{:d}".format(row, col))
+                if preds is not None:
+                    self.placeTile(class_map, box, preds, row, col, wa_left, wa_top, wa_right, wa_bottom, AGGREGATION_WINDOW_SIZE)
+                    self.processing_step += 10
+                    continue
 
                 k = 0
                 for i in range(-1,2):
                     for j in range(-1,2):
-
                         top = wa_top - AGGREGATION_STEP + row * STEP_SIZE + i * AGGREGATION_STEP
                         left = wa_left - AGGREGATION_STEP + col * STEP_SIZE + j * AGGREGATION_STEP
-                        cropimg = utils.cropQImage(img_map, [top, left, TILE_SIZE, TILE_SIZE])
-                        img_np = utils.qimageToNumpyArray(cropimg)
+                        inputs.append((row, col, k, top, left))
+                        k = k + 1
 
-                        img_np = img_np.astype(np.float32)
-                        img_np = img_np / 255.0
+        tiles_scores = {}
 
-                        # H x W x C --> C x H x W
-                        img_np = img_np.transpose(2, 0, 1)
+        for (batch, outputs) in self.classifyBatches(img_map, inputs, TILE_SIZE):
 
-                        # Normalization (average subtraction)
-                        img_np[0] = img_np[0] - self.average_norm[0]
-                        img_np[1] = img_np[1] - self.average_norm[1]
-                        img_np[2] = img_np[2] - self.average_norm[2]
+            for n, (row, col, k, top, left) in enumerate(batch):
 
-                        with torch.no_grad():
+                scores = tiles_scores.get((row, col))
+                if scores is None:
+                    scores = torch.empty((9, self.nclasses, TILE_SIZE, TILE_SIZE), dtype=torch.float32, device=outputs.device)
+                    tiles_scores[(row, col)] = scores
 
-                            img_tensor = torch.from_numpy(img_np)
-                            input = img_tensor.unsqueeze(0)
+                scores[k] = outputs[n]
 
-                            if torch.cuda.is_available():
-                                input = input.to(device)
+                # all the scores of the tile are available
+                if k == 8:
+                    del tiles_scores[(row, col)]
+                    preds = self.classifyTile(scores, TILE_SIZE, AGGREGATION_WINDOW_SIZE, AGGREGATION_STEP)
+                    self.saveCheckpoint("tile_{:d}_{:d}".format(row, col), preds)
 
-                            outputs = self.net(input)
+                    self.placeTile(class_map, box, preds, row, col, wa_left, wa_top, wa_right, wa_bottom, AGGREGATION_WINDOW_SIZE)
 
-                            scores[k] = outputs[0].cpu().numpy()
-                            k = k + 1
+                    if debug:
+                        self.saveTile(preds, row, col, temp_dir)
 
-                            self.processing_step += 1
-                            self.updateProgress.emit( (100.0 * self.processing_step) / self.total_processing_steps )
-                            QCoreApplication.processEvents()
+            self.processing_step += len(batch)
+            self.reportProgress()
 
+    def placeTile(self, class_map, box, preds, row, col, wa_left, wa_top, wa_right, wa_bottom, AGGREGATION_WINDOW_SIZE):
 
-                if self.flagStopProcessing is True:
-                    break
+        xoffset = wa_left + col * AGGREGATION_WINDOW_SIZE
+        yoffset = wa_top + row * AGGREGATION_WINDOW_SIZE
+        tile_w = max(0, min(AGGREGATION_WINDOW_SIZE, wa_right - xoffset))
+        tile_h = max(0, min(AGGREGATION_WINDOW_SIZE, wa_bottom - yoffset))
 
-                # preds_avg, preds_bayesian = self.aggregateScores(scores, tile_sz=TILE_SIZE,
-                #                                     center_window_size=AGGREGATION_WINDOW_SIZE, step=AGGREGATION_STEP)
+        class_map[yoffset-box[0]:yoffset-box[0]+tile_h, xoffset-box[1]:xoffset-box[1]+tile_w] = preds[:tile_h, :tile_w]
 
-                preds_avg = self.aggregateScores(scores, tile_sz=TILE_SIZE,
-                                                     center_window_size=AGGREGATION_WINDOW_SIZE, step=AGGREGATION_STEP)
+    @staticmethod
+    def gridPositions(size, TILE_SIZE, stride):
+        """
+        Positions of the tiles of a regular grid covering [0, size); the last tile is aligned to the border.
+        """
 
-                values_t, predictions_t = torch.max(torch.from_numpy(preds_avg), 0)
-                preds = predictions_t.cpu().numpy()
+        positions = list(range(0, max(size - TILE_SIZE, 0) + 1, stride))
+        if positions[-1] + TILE_SIZE < size:
+            positions.append(size - TILE_SIZE)
 
-                resimg = np.zeros((preds.shape[0], preds.shape[1], 3), dtype='uint8')
+        return positions
 
-                for label_index in range(self.nclasses):
-                    resimg[preds == label_index, :] = self.label_colors[label_index]
+    def runGrid(self, img_map, class_map, box, TILE_SIZE):
+        """
+        The network runs once on each tile of a regular grid of overlapping tiles. The scores of the tiles
+        (see tileScores()) are summed into a band of rows of the map; the rows above the next row of tiles are
+        complete, so they are fused, converted to class indices and removed from the band.
+        The completed rows are saved as checkpoints; a resumed classification starts from the first row
+        of tiles that reaches the rows not yet completed.
+        """
 
-                tilename = str(row) + "_" + str(col) + ".png"
-                filename = os.path.join(temp_dir, tilename)
-                utils.rgbToQImage(resimg).save(filename)
+        (box_top, box_left, W, H) = box
 
-                self.processing_step += 1
-                self.updateProgress.emit( (100.0 * self.processing_step) / self.total_processing_steps )
-                QCoreApplication.processEvents()
+        stride = self.grid_stride if self.grid_stride > 0 else TILE_SIZE // 3
+        stride = max(1, min(stride, TILE_SIZE))
 
-        # put tiles together
-        qimglabel = QImage(W, H, QImage.Format_RGB32)
+        # positions inside the box
+        tops = self.gridPositions(H, TILE_SIZE, stride)
+        lefts = self.gridPositions(W, TILE_SIZE, stride)
 
-        xoffset = 0
-        yoffset = 0
+        # rows completed by a previous (interrupted) run
+        band_top = 0
+        while band_top < H:
+            rows = self.loadCheckpoint("rows_{:d}".format(band_top))
+            if rows is None or rows.shape[0] == 0 or rows.shape[1] != W:
+                break
+            class_map[band_top:band_top+rows.shape[0]] = rows
+            band_top += rows.shape[0]
 
-        painter = QPainter(qimglabel)
+        inputs = [(row, top, left, box_top + top, box_left + left) for row, top in enumerate(tops) for left in lefts
+                  if top + TILE_SIZE > band_top and band_top < H]
 
-        for r in range(tile_rows):
-            for c in range(tile_cols):
-                tilename = str(r) + "_" + str(c) + ".png"
-                filename = os.path.join(temp_dir, tilename)
-                qimg = QImage(filename)
+        self.processing_step = len(tops) * len(lefts) - len(inputs)
+        self.total_processing_steps = len(tops) * len(lefts)
 
-                xoffset = wa_left + c * AGGREGATION_WINDOW_SIZE
-                yoffset = wa_top + r * AGGREGATION_WINDOW_SIZE
+        # scores and number of tiles of the rows [band_top, band_top + TILE_SIZE) of the box
+        band_scores = np.zeros((self.nclasses, TILE_SIZE, W), dtype=np.float32)
+        band_weights = np.zeros((TILE_SIZE, W), dtype=np.float32)
 
-                cut = False
-                W_prime = wa_width
-                H_prime = wa_height
+        def completeRows(nrows):
+            nrows = min(nrows, H - band_top)
+            summed = torch.from_numpy(band_scores[:, :nrows])
+            count = torch.from_numpy(np.maximum(band_weights[:nrows], 1.0))
+            class_map[band_top:band_top+nrows] = torch.argmax(self.fuseScores(summed, count), dim=0).numpy()
+            self.saveCheckpoint("rows_{:d}".format(band_top), class_map[band_top:band_top+nrows])
 
-                if xoffset + AGGREGATION_WINDOW_SIZE > wa_left + wa_width - 1:
-                    W_prime = wa_width + wa_left - xoffset - 1
-                    cut = True
+            band_scores[:, :TILE_SIZE-nrows] = band_scores[:, nrows:]
+            band_scores[:, TILE_SIZE-nrows:] = 0.0
+            band_weights[:TILE_SIZE-nrows] = band_weights[nrows:]
+            band_weights[TILE_SIZE-nrows:] = 0.0
 
-                if yoffset + AGGREGATION_WINDOW_SIZE > wa_top + wa_height - 1:
-                    H_prime = wa_height + wa_top - yoffset - 1
-                    cut = True
+            return band_top + nrows
 
-                if cut is True:
-                    qimg2 = qimg.copy(0, 0, W_prime, H_prime)
-                    painter.drawImage(xoffset, yoffset, qimg2)
-                else:
-                    painter.drawImage(xoffset, yoffset, qimg)
+        for (batch, outputs) in self.classifyBatches(img_map, inputs, TILE_SIZE):
 
-        # detach the qimglabel otherwise the Qt EXPLODES when memory is free
-        painter.end()
+            scores = self.tileScores(outputs).cpu().numpy()
 
-        labelfile = os.path.join(temp_dir, "labelmap.png")
-        qimglabel.save(labelfile)
+            for n, (row, top, left, map_top, map_left) in enumerate(batch):
 
-        torch.cuda.empty_cache()
-        del self.net
-        self.net = None
+                if top > band_top:
+                    band_top = completeRows(top - band_top)
 
-    def stopProcessing(self):
+                # the rows above band_top are already completed (resumed classification)
+                skip = band_top - top
 
-        self.flagStopProcessing = True
+                tile_w = min(TILE_SIZE, W - left)
+                tile_h = min(TILE_SIZE, H - top) - skip
 
-    def aggregateScores(self, scores, tile_sz, center_window_size, step):
+                band_scores[:, :tile_h, left:left+tile_w] += scores[n, :, skip:skip+tile_h, :tile_w]
+                band_weights[:tile_h, left:left+tile_w] += 1.0
+
+            self.processing_step += len(batch)
+            self.reportProgress()
+
+        if self.flagStopProcessing is False:
+            while band_top < H:
+                band_top = completeRows(TILE_SIZE)
+
+    def classifyTile(self, scores, TILE_SIZE, AGGREGATION_WINDOW_SIZE, AGGREGATION_STEP):
+        """
+        Aggregate the scores of a tile and return the class index of its pixels.
         """
-        Calcute the classification scores using a Bayesian fusion aggregation.
-        """""
 
-        nscores = scores.shape[0]
-        nclasses = scores.shape[1]
+        preds_avg = self.aggregateScores(scores, tile_sz=TILE_SIZE,
+                                         center_window_size=AGGREGATION_WINDOW_SIZE, step=AGGREGATION_STEP)
 
-        classification_scores = np.zeros((nscores, nclasses, center_window_size, center_window_size))
+        values_t, predictions_t = torch.max(preds_avg, 0)
+        preds = predictions_t.cpu().numpy().astype(np.uint8)
 
-        # aggregation limits
-        top = int((tile_sz - center_window_size) / 2)
-        left = int((tile_sz - center_window_size) / 2)
+        self.processing_step += 1
+        self.reportProgress()
 
-        k = 0
-        for i in range(-1,2):
-            for j in range(-1,2):
+        return preds
 
-                x1src = left - j * step
-                y1src = top - i * step
+    def colorize(self, class_map):
+        """
+        Convert a map of class indices into a QImage with the colors of the classes.
+        """
 
-                x2src = x1src + center_window_size
-                y2src = y1src + center_window_size
+        lut = [qRgb(0, 0, 0)] * 256
+        for label_index, color in enumerate(self.label_colors):
+            lut[label_index] = qRgb(color[0], color[1], color[2])
 
-                x1dest = 0
-                x2dest = center_window_size
-                y1dest = 0
-                y2dest = center_window_size
+        return utils.colorizeLabels(class_map, lut, QImage.Format_RGB32)
 
-                classification_scores[k, :, y1dest:y2dest, x1dest:x2dest] = scores[k, :, y1src:y2src, x1src:x2src]
+    def saveTile(self, preds, row, col, temp_dir):
 
-                k = k + 1
+        tilename = str(row) + "_" + str(col) + ".png"
+        filename = os.path.join(temp_dir, tilename)
+        self.colorize(preds).save(filename)
 
-                self.processing_step += 1
-                self.updateProgress.emit( (100.0 * self.processing_step) / self.total_processing_steps )
-                QCoreApplication.processEvents()
+    def reportProgress(self):
+        """
+        Emit the current progress, at most once every PROGRESS_INTERVAL seconds (and at the end).
+        """
+
+        now = time.time()
+        if now - self.last_progress_time >= self.PROGRESS_INTERVAL or self.processing_step >= self.total_processing_steps:
+            self.last_progress_time = now
+            self.updateProgress.emit( (100.0 * self.processing_step) / self.total_processing_steps )
+
+    def stopProcessing(self):
+
+        self.flagStopProcessing = True
+
+    def tileScores(self, outputs):
+        """
+        The scores of the classified tiles (N x C x H x W) that are summed by the fusion.
+        """
+
+        if self.fusion == "Bayesian":
+            return outputs
+
+        return torch.softmax(outputs, dim=1)
+
+    def fuseScores(self, summed, count):
+        """
+        Fuse the sum of the scores (C x H x W) of count tiles into the probabilities of the classes.
+        """
 
         #####   AGGREGATE SCORES BY AVERAGING THEM   ##################################################
 
         # NOTE: SOME APPROACHES AVERAGE THE SCORES DIRECTLY, OTHER ONES AVERAGE THE OUTPUT OF THE SOFTMAX
         #       HERE, WE AVERAGE THE OUTPUT OF THE SOFTMAX
 
-        softmax = torch.nn.Softmax(dim=0)
-
-        classification_scores_avg = np.zeros((nclasses, center_window_size, center_window_size))
-        for i in range(nscores):
-            prob = softmax(torch.from_numpy(classification_scores[i]))
-            classification_scores_avg = classification_scores_avg + prob.numpy()
-
-        classification_scores_avg = classification_scores_avg / nscores
+        if self.fusion != "Bayesian":
+            return summed / count
 
         #####   AGGREGATE SCORES USING BAYESIAN FUSION   #############################################
 
@@ -334,21 +883,38 @@ class MapClassifier(QObject):
         #
         # THIS AVOID NUMERICAL PROBLEMS FOR PRODUCTS WITH MANY TERMS.
 
-        # # bayesian aggregation
-        # classification_scores_bayes = np.zeros((nclasses, center_window_size, center_window_size))
-        #
-        # for i in range(nscores):
-        #     classification_scores_bayes = classification_scores_bayes + classification_scores[i]
-        #
-        # classification_scores_bayesian = np.zeros((nclasses, center_window_size, center_window_size))
-        #
-        # res = softmax(torch.from_numpy(classification_scores_bayes))
-        #
-        # # PRIOR probabilities
-        # prior = [0.7, 0.1, 0.1, 0.1]
-        #
-        # for i in range(nclasses):
-        #     classification_scores_bayesian[i] = prior[i] * res[i].numpy()
+        probs = torch.softmax(summed, dim=0)
+
+        # PRIOR probabilities (uniform if not given)
+        if self.prior is not None:
+            prior = torch.tensor(self.prior, dtype=probs.dtype, device=probs.device)
+            probs = probs * prior.view(-1, 1, 1)
+
+        return probs
+
+    def aggregateScores(self, scores, tile_sz, center_window_size, step):
+        """
+        Fuse the classification scores (9 x C x tile_sz x tile_sz tensor) of the shifted tiles, on the
+        device of the tensor. It returns the probabilities of the central window (C x window x window).
+        """
+
+        # aggregation limits
+        top = int((tile_sz - center_window_size) / 2)
+        left = int((tile_sz - center_window_size) / 2)
+
+        crops = []
+        k = 0
+        for i in range(-1,2):
+            for j in range(-1,2):
+
+                x1src = left - j * step
+                y1src = top - i * step
+
+                crops.append(scores[k, :, y1src:y1src+center_window_size, x1src:x1src+center_window_size])
+                k = k + 1
+
+        classification_scores = torch.stack(crops)
 
-        return classification_scores_avg
+        summed = self.tileScores(classification_scores).sum(dim=0)
 
+        return self.fuseScores(summed, classification_scores.shape[0])
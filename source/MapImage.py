@@ -0,0 +1,409 @@
+# TagLab
+# A semi-automatic segmentation tool
+#
+# Copyright(C) 2019
+# Visual Computing Lab
+# ISTI - Italian National Research Council
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License (http://www.gnu.org/licenses/gpl.txt)
+# for more details.
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+
+# the default limit of OpenCV (2^30 pixels) is smaller than many ortho-mosaics
+os.environ.setdefault("OPENCV_IO_MAX_IMAGE_PIXELS", str(2**40))
+import cv2
+
+from PyQt5.QtCore import Qt
+from PyQt5.QtGui import QImage
+
+from source.ConversionUtils import qimageToBGRA
+
+
+class MapImage(object):
+    """
+    A map stored out-of-core. The pixels are kept on disk in a raw file with the same layout
+    of a QImage in Format_RGB32 (B, G, R, 255 for each pixel) and accessed through a memory map,
+    so the size of the map is not limited by the maximum size of a QImage and only the windows
+    actually read are loaded in memory.
+    The class implements the subset of the QImage interface used by TagLab (width, height, isNull,
+    copy and scaled), so it can be used wherever a map was given as a QImage.
+    """
+
+    # number of rows processed at once when the map is converted or rescaled
+    STRIPE_HEIGHT = 512
+
+    def __init__(self, raw_filename, width, height, mode="r", temporary=False):
+
+        self.raw_filename = raw_filename
+        self.w = width
+        self.h = height
+
+        # the raw file of a temporary map is removed when the map is destroyed
+        self.temporary = temporary
+
+        self.data = np.memmap(raw_filename, dtype=np.uint8, mode=mode, shape=(height, width, 4))
+
+    def __del__(self):
+
+        self.close()
+
+    def close(self):
+
+        if self.data is not None:
+            del self.data
+            self.data = None
+
+            if self.temporary and os.path.exists(self.raw_filename):
+                try:
+                    os.remove(self.raw_filename)
+                except OSError:
+                    pass
+
+    @staticmethod
+    def temporaryFilename():
+
+        (fd, filename) = tempfile.mkstemp(prefix="taglab_map_", suffix=".raw")
+        os.close(fd)
+        return filename
+
+    @classmethod
+    def create(cls, width, height, raw_filename=None):
+        """
+        Create a new (writable) map of the given size. If no filename is given a temporary file is used.
+        """
+
+        temporary = raw_filename is None
+        if temporary:
+            raw_filename = cls.temporaryFilename()
+
+        return cls(raw_filename, width, height, mode="w+", temporary=temporary)
+
+    @classmethod
+    def fromImageFile(cls, image_filename, raw_filename=None):
+        """
+        Decode an image file (PNG, JPG, TIFF, ..) and store it as a memory mapped map.
+        It returns None if the image cannot be decoded.
+        NOTE: OpenCV decodes the whole image at once, so the loading needs (temporarily) the memory of the
+        decoded image (3 bytes per pixel); it is freed as soon as it has been copied in the memory map.
+        """
+
+        img = cv2.imread(image_filename, cv2.IMREAD_COLOR)
+        if img is None:
+            return None
+
+        return cls.fromArray(img, raw_filename)
+
+    @classmethod
+    def fromArray(cls, img, raw_filename=None):
+        """
+        Store a (h x w x 3) BGR image (as returned by cv2.imread) as a memory mapped map.
+        """
+
+        (h, w) = img.shape[:2]
+        mapimg = cls.create(w, h, raw_filename)
+
+        for y0 in range(0, h, cls.STRIPE_HEIGHT):
+            y1 = min(h, y0 + cls.STRIPE_HEIGHT)
+            mapimg.data[y0:y1, :, :3] = img[y0:y1]
+            mapimg.data[y0:y1, :, 3] = 255
+
+        mapimg.data.flush()
+
+        return mapimg
+
+    def width(self):
+
+        return self.w
+
+    def height(self):
+
+        return self.h
+
+    def isNull(self):
+
+        return self.data is None or self.w == 0 or self.h == 0
+
+    def window(self, top, left, w, h):
+        """
+        Returns the BGRA pixels of the given window as a (h x w x 4) array. If the window lies inside
+        the map the array is a view of the memory map, otherwise it is a copy and the pixels outside
+        the map are set to zero (as QImage.copy() does).
+        """
+
+        top = int(top)
+        left = int(left)
+        w = int(w)
+        h = int(h)
+
+        if top >= 0 and left >= 0 and top + h <= self.h and left + w <= self.w:
+            return self.data[top:top+h, left:left+w]
+
+        arr = np.zeros((h, w, 4), dtype=np.uint8)
+
+        y0 = max(top, 0)
+        x0 = max(left, 0)
+        y1 = min(top + h, self.h)
+        x1 = min(left + w, self.w)
+
+        if y1 > y0 and x1 > x0:
+            arr[y0-top:y1-top, x0-left:x1-left] = self.data[y0:y1, x0:x1]
+
+        return arr
+
+    def copy(self, x, y, w, h):
+        """
+        Returns the given window as a QImage in Format_RGB32 (same semantic of QImage.copy()).
+        """
+
+        w = int(w)
+        h = int(h)
+
+        qimg = QImage(w, h, QImage.Format_RGB32)
+        if w <= 0 or h <= 0:
+            return qimg
+
+        qimageToBGRA(qimg)[:] = self.window(y, x, w, h)
+
+        return qimg
+
+    def scaled(self, w, h, aspectRatioMode=Qt.IgnoreAspectRatio, transformMode=Qt.SmoothTransformation, raw_filename=None):
+        """
+        Returns a rescaled copy of the map (stored in a temporary file if no filename is given).
+        The map is processed by horizontal stripes, so the memory used does not depend on the map size.
+        """
+
+        w = int(w)
+        h = int(h)
+
+        if aspectRatioMode == Qt.KeepAspectRatio:
+            s = min(w / self.w, h / self.h)
+            w = max(1, int(round(self.w * s)))
+            h = max(1, int(round(self.h * s)))
+
+        if transformMode == Qt.SmoothTransformation:
+            interpolation = cv2.INTER_AREA if w <= self.w and h <= self.h else cv2.INTER_LINEAR
+        else:
+            interpolation = cv2.INTER_NEAREST
+
+        scaled_map = MapImage.create(w, h, raw_filename)
+
+        for y0 in range(0, h, self.STRIPE_HEIGHT):
+            y1 = min(h, y0 + self.STRIPE_HEIGHT)
+            sy0 = (y0 * self.h) // h
+            sy1 = max(sy0 + 1, min(self.h, (y1 * self.h + h - 1) // h))
+            stripe = np.ascontiguousarray(self.data[sy0:sy1])
+            scaled_map.data[y0:y1] = cv2.resize(stripe, (w, y1 - y0), interpolation=interpolation)
+
+        scaled_map.data.flush()
+
+        return scaled_map
+
+    def toQImage(self):
+        """
+        Returns the whole map as a QImage (use it only for small maps, e.g. the thumbnails).
+        """
+
+        return self.copy(0, 0, self.w, self.h)
+
+
+class MapPyramid(object):
+    """
+    Multi-resolution version of a map file, cached on disk in a sidecar folder next to the map
+    (<map file>.cache). The folder contains the levels of the pyramid as raw memory mapped files
+    (level 0 is the full resolution map, level k is downscaled by 2^k) plus the overview thumbnail.
+    The cache is keyed by the path, the size and the modification time of the map file: it is built
+    the first time the map is loaded and simply memory mapped the following times.
+    """
+
+    CACHE_VERSION = 1
+
+    # the coarsest level fits in a single tile of the viewer
+    TILE_SIZE = 512
+
+    def __init__(self, map_filename, cache_dir, levels, thumbnail):
+
+        self.map_filename = map_filename
+        self.cache_dir = cache_dir
+        self.levels = levels
+        self.thumbnail = thumbnail
+
+    @staticmethod
+    def numberOfLevels(width, height, tile_size):
+
+        nlevels = 1
+        longest_side = max(width, height)
+        while longest_side > tile_size:
+            longest_side = longest_side // 2
+            nlevels += 1
+
+        return nlevels
+
+    @staticmethod
+    def cacheKey(map_filename):
+
+        info = os.stat(map_filename)
+        key = {"version": MapPyramid.CACHE_VERSION,
+               "path": os.path.abspath(map_filename),
+               "size": info.st_size,
+               "mtime": info.st_mtime}
+        return key
+
+    @staticmethod
+    def cacheDir(map_filename):
+        """
+        The sidecar folder of the map. If the folder of the map is not writable the cache is stored
+        in the temporary folder of the system.
+        """
+
+        cache_dir = map_filename + ".cache"
+        if os.path.isdir(cache_dir) or os.access(os.path.dirname(os.path.abspath(map_filename)), os.W_OK):
+            return cache_dir
+
+        name = hashlib.sha1(os.path.abspath(map_filename).encode("utf-8")).hexdigest()
+        return os.path.join(tempfile.gettempdir(), "taglab_cache", name)
+
+    @classmethod
+    def load(cls, map_filename, thumb_size, level_ready=None, thumbnail_ready=None):
+        """
+        Returns the pyramid of the given map. The cache is created if it does not exist or if it is not
+        valid anymore. None is returned if the map cannot be read (or the building has been aborted).
+        The callbacks are used only when the pyramid is built, see build().
+        """
+
+        if not os.path.exists(map_filename):
+            return None
+
+        pyramid = cls.fromCache(map_filename, thumb_size)
+        if pyramid is None:
+            pyramid = cls.build(map_filename, thumb_size, level_ready, thumbnail_ready)
+
+        return pyramid
+
+    @classmethod
+    def fromCache(cls, map_filename, thumb_size):
+
+        cache_dir = cls.cacheDir(map_filename)
+        header_filename = os.path.join(cache_dir, "header.json")
+
+        try:
+            with open(header_filename, "r") as f:
+                header = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if header.get("key") != cls.cacheKey(map_filename) or header.get("thumb size") != thumb_size:
+            return None
+
+        try:
+            levels = []
+            for (k, (w, h)) in enumerate(header["levels"]):
+                raw_filename = os.path.join(cache_dir, "level{:d}.raw".format(k))
+                levels.append(MapImage(raw_filename, w, h, mode="r"))
+        except (OSError, ValueError):
+            return None
+
+        thumbnail = QImage(os.path.join(cache_dir, "thumb.png"))
+        if thumbnail.isNull():
+            return None
+
+        return cls(map_filename, cache_dir, levels, thumbnail)
+
+    @classmethod
+    def build(cls, map_filename, thumb_size, level_ready=None, thumbnail_ready=None):
+        """
+        Decode the map and build the pyramid. The levels are made available as soon as possible to allow
+        a progressive display: first the thumbnail and the coarsest level (computed directly from the
+        decoded image), then the full resolution level and the intermediate ones.
+        NOTE: the map is decoded at once (see MapImage.fromImageFile()), so the first loading of a map needs the
+        memory of the decoded image. The decoded image is freed as soon as the full resolution level is written,
+        the intermediate levels are computed from the memory map of the previous level, stripe by stripe.
+        level_ready(k, level) is called every time the k-th level is ready; if it returns False the
+        building is aborted and None is returned. thumbnail_ready(qimage) is called with the thumbnail.
+        """
+
+        cache_dir = cls.cacheDir(map_filename)
+        key = cls.cacheKey(map_filename)
+
+        try:
+            if os.path.isdir(cache_dir):
+                shutil.rmtree(cache_dir, ignore_errors=True)
+            os.makedirs(cache_dir, exist_ok=True)
+        except OSError:
+            cache_dir = None
+
+        def levelFilename(k):
+            if cache_dir is None:
+                return None
+            return os.path.join(cache_dir, "level{:d}.raw".format(k))
+
+        def notify(k, level):
+            if level_ready is None:
+                return True
+            return level_ready(k, level) is not False
+
+        img = cv2.imread(map_filename, cv2.IMREAD_COLOR)
+        if img is None:
+            return None
+
+        (H, W) = img.shape[:2]
+        nlevels = cls.numberOfLevels(W, H, cls.TILE_SIZE)
+        levels = [None] * nlevels
+
+        s = min(thumb_size / W, thumb_size / H)
+        thumb = cv2.resize(img, (max(1, int(round(W * s))), max(1, int(round(H * s)))), interpolation=cv2.INTER_AREA)
+        thumbnail = MapImage.fromArray(thumb).toQImage()
+        if thumbnail_ready is not None:
+            thumbnail_ready(thumbnail)
+
+        coarsest = nlevels - 1
+        if coarsest > 0:
+            small = cv2.resize(img, (max(1, W >> coarsest), max(1, H >> coarsest)), interpolation=cv2.INTER_AREA)
+            levels[coarsest] = MapImage.fromArray(small, levelFilename(coarsest))
+            if not notify(coarsest, levels[coarsest]):
+                return None
+
+        levels[0] = MapImage.fromArray(img, levelFilename(0))
+        del img
+        if not notify(0, levels[0]):
+            return None
+
+        for k in range(1, coarsest):
+            w = max(1, W >> k)
+            h = max(1, H >> k)
+            levels[k] = levels[k-1].scaled(w, h, Qt.IgnoreAspectRatio, Qt.SmoothTransformation, levelFilename(k))
+            if not notify(k, levels[k]):
+                return None
+
+        if cache_dir is not None:
+            thumbnail.save(os.path.join(cache_dir, "thumb.png"))
+
+            # the header is written last, an interrupted build is never considered valid
+            header = {"key": key,
+                      "thumb size": thumb_size,
+                      "levels": [[level.width(), level.height()] for level in levels]}
+
+            header_filename = os.path.join(cache_dir, "header.json")
+            with open(header_filename + ".tmp", "w") as f:
+                json.dump(header, f)
+            os.replace(header_filename + ".tmp", header_filename)
+
+        return cls(map_filename, cache_dir, levels, thumbnail)
+
+    def level(self, k):
+
+        return self.levels[k]
@@ -0,0 +1,74 @@
+# TagLab
+# A semi-automatic segmentation tool
+#
+# Copyright(C) 2019
+# Visual Computing Lab
+# ISTI - Italian National Research Council
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License (http://www.gnu.org/licenses/gpl.txt)
+# for more details.
+
+from PyQt5.QtCore import QThread, pyqtSignal
+from PyQt5.QtGui import QImage
+
+from source.MapImage import MapPyramid
+
+
+class MapLoader(QThread):
+    """
+    Load (or build) the pyramid of a map in background, so the GUI stays responsive while a large
+    map is decoded. When the pyramid is built the levels are emitted as soon as they are ready,
+    coarsest first, to allow a progressive display of the map.
+    """
+
+    # (level index, MapImage)
+    levelLoaded = pyqtSignal(int, object)
+
+    thumbnailLoaded = pyqtSignal(QImage)
+
+    # the MapPyramid, or None if the map cannot be read
+    mapLoaded = pyqtSignal(object)
+
+    def __init__(self, map_filename, thumb_size, parent=None):
+        super(MapLoader, self).__init__(parent)
+
+        self.map_filename = map_filename
+        self.thumb_size = thumb_size
+
+    def run(self):
+
+        pyramid = MapPyramid.load(self.map_filename, self.thumb_size,
+                                  level_ready=self.levelReady, thumbnail_ready=self.thumbnailReady)
+
+        if not self.isInterruptionRequested():
+            self.mapLoaded.emit(pyramid)
+
+    def levelReady(self, k, level):
+
+        if self.isInterruptionRequested():
+            return False
+
+        self.levelLoaded.emit(k, level)
+        return True
+
+    def thumbnailReady(self, thumbnail):
+
+        if not self.isInterruptionRequested():
+            self.thumbnailLoaded.emit(thumbnail)
+
+    def stop(self):
+        """
+        Abort the loading and wait for the thread to finish (the decoding of the map cannot be interrupted).
+        """
+
+        self.requestInterruption()
+        self.wait()
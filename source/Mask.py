@@ -1,5 +1,6 @@
 import numpy as np
 from skimage import measure
+from cv2 import fillPoly
 
 """
 Convert points to indices and swaps x, and y.
@@ -111,3 +112,12 @@ def subtract(maskA, boxA, maskB, boxB):
 
     regions = measure.regionprops(measure.label(mask))
     return (mask, box)
+
+"""
+Returns the mask (uint8, 1 inside) of the polygon (points in x, y) inside the given box
+"""
+def polygonMask(points, box):
+    mask = np.zeros((box[3], box[2]), dtype=np.uint8)
+    pts = np.round(points - [box[1], box[0]]).astype(np.int32)
+    fillPoly(mask, [pts], 1)
+    return mask
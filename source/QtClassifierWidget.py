@@ -104,6 +104,21 @@ class QtClassifierWidget(QWidget):
         layoutH1.addLayout(layoutH1a)
         layoutH1.addLayout(layoutH1b)
 
+        self.lblArea = QLabel("Area to classify: ")
+
+        self.comboArea = QComboBox()
+        self.comboArea.setMinimumWidth(300)
+        self.comboArea.addItem("Whole map")
+        self.comboArea.addItem("Visible area")
+        self.comboArea.addItem("Selected region")
+
+        layoutH3 = QHBoxLayout()
+        layoutH3.setAlignment(Qt.AlignLeft)
+        layoutH3.addStretch()
+        layoutH3.addWidget(self.lblArea)
+        layoutH3.addWidget(self.comboArea)
+        layoutH3.addStretch()
+
         self.btnCancel = QPushButton("Cancel")
         self.btnCancel.clicked.connect(self.close)
         self.btnApply = QPushButton("Apply")
@@ -117,6 +132,7 @@ class QtClassifierWidget(QWidget):
         layoutV = QVBoxLayout()
         layoutV.addLayout(layoutH0)
         layoutV.addLayout(layoutH1)
+        layoutV.addLayout(layoutH3)
         layoutV.addLayout(layoutH2)
         layoutV.setSpacing(3)
         self.setLayout(layoutV)
@@ -138,6 +154,13 @@ class QtClassifierWidget(QWidget):
 
         return self.classifiers[self.comboClassifier.currentIndex()]
 
+    def area(self):
+        """
+        The area to classify: "Whole map", "Visible area" or "Selected region".
+        """
+
+        return self.comboArea.currentText()
+
     def classes2str(self, classes_list):
 
         txt = str(classes_list)
@@ -104,7 +104,7 @@ class QtComparePanel(QWidget):
     def setProject(self, project_name):
 
         project_name = os.path.basename(project_name)
-        project_name = project_name.replace('.json', '')
+        project_name = os.path.splitext(project_name)[0]
 
         txt = "<b>" + project_name + "</b>"
         self.labels_projects[0].setText(txt)
@@ -120,7 +120,7 @@ class QtComparePanel(QWidget):
     def addProject(self, project_name):
 
         project_name = os.path.basename(project_name)
-        project_name = project_name.replace('.json', '')
+        project_name = os.path.splitext(project_name)[0]
 
         idx = self.annotations_loaded
         self.labels_projects[idx].setText(project_name)
@@ -34,7 +34,7 @@ class QtCrackWidget(QWidget):
         self.setStyleSheet("background-color: rgb(60,60,65); color: white")
 
         self.qimg_cropped = utils.cropQImage(map, blob.bbox)
-        arr = utils.qimageToNumpyArray(self.qimg_cropped)
+        arr = utils.qimageToRGB(self.qimg_cropped)
         self.input_arr = rgb2gray(arr) * 255
         self.tolerance = 20
         self.annotations = annotations
@@ -26,12 +26,16 @@ from PyQt5.QtCore import Qt, QPointF, QRectF, pyqtSignal, QT_VERSION_STR
 from PyQt5.QtGui import QImage, QPixmap, QPainter, QPainterPath, QPen
 from PyQt5.QtWidgets import QGraphicsView, QGraphicsScene, QFileDialog
 
+from source.QtTiledImageItem import QtTiledImageItem
+from source.MapImage import MapImage
+
 
 class QtImageViewerPlus(QGraphicsView):
     """
     PyQt image viewer widget with annotation capabilities.
     QGraphicsView handles a scene composed by an image plus shapes (rectangles, polygons, blobs).
-    The input image (it must be a QImage) is internally converted into a QPixmap.
+    The input image (it must be a QImage) is displayed as a pyramid of tiles (see QtTiledImageItem),
+    only the visible tiles are converted into QPixmap.
     """
 
     # Mouse button signals emit image scene (x, y) coordinates.
@@ -51,12 +55,13 @@ class QtImageViewerPlus(QGraphicsView):
 
         self.setStyleSheet("background-color: rgb(40,40,40)")
 
-        # Image is displayed as a QPixmap in a QGraphicsScene attached to this QGraphicsView.
+        # Image is displayed as a tiled item in a QGraphicsScene attached to this QGraphicsView.
         self.scene = QGraphicsScene()
         self.setScene(self.scene)
 
-        # Store a local handle to the scene's current image pixmap.
-        self._pxmapitem = None
+        # Store a local handle to the scene's current image item (and to the overlay, if any).
+        self._imageitem = None
+        self._overlayitem = None
 
         # current image size
         self.imgwidth = 0
@@ -92,7 +97,6 @@ class QtImageViewerPlus(QGraphicsView):
         self.opacity = 1.0
 
         MIN_SIZE = 250
-        self.pixmap = QPixmap(MIN_SIZE, MIN_SIZE)
         self.overlay_image = QImage(1, 1, QImage.Format_ARGB32)
 
         self.viewport().setMinimumWidth(MIN_SIZE)
@@ -111,15 +115,15 @@ class QtImageViewerPlus(QGraphicsView):
         self.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
 
     def hasImage(self):
-        """ Returns whether or not the scene contains an image pixmap.
+        """ Returns whether or not the scene contains an image.
         """
-        return self._pxmapitem is not None
+        return self._imageitem is not None
 
     def image(self):
-        """ Returns the scene's current image as a QImage.
+        """ Returns the scene's current image (QImage or MapImage).
         """
         if self.hasImage():
-            return self._pxmapitem.pixmap().toImage()
+            return self._imageitem.image()
         return None
 
     def enablePan(self):
@@ -134,26 +138,53 @@ class QtImageViewerPlus(QGraphicsView):
     def disableZoom(self):
         self.zoomEnabled = False
 
-    def setImage(self, image, zoomf=0.0):
+    def setImage(self, image, zoomf=0.0, levels=None):
         """
-        Set the scene's current image (input image must be a QImage)
+        Set the scene's current image (input image must be a QImage or a MapImage)
         For calculating the zoom factor automatically set it to 0.0.
+        The coarser levels of the image pyramid can be given, if available.
+        """
+        if not isinstance(image, (QImage, MapImage)):
+            raise RuntimeError("Argument must be a QImage or a MapImage.")
+
+        self.createImageItem()
+        self._imageitem.setImage(image, levels)
+        self.setSceneSize(image.width(), image.height())
+
+    def setImageSize(self, width, height):
+        """
+        Prepare the viewer for an image of the given size which is loaded in background. The levels of
+        the image pyramid are given with setImageLevel() as soon as they are ready, meanwhile the
+        annotations can be already displayed.
+        """
+
+        self.createImageItem()
+        self._imageitem.setImageSize(width, height)
+        self.setSceneSize(width, height)
+
+    def setImageLevel(self, k, image):
+        """
+        Set the k-th level of an image which is being loaded (see setImageSize()).
         """
-        if type(image) is QImage:
-            imageARGB32 = image.convertToFormat(QImage.Format_ARGB32)
-            self.pixmap = QPixmap.fromImage(imageARGB32)
-            self.imgwidth = image.width()
-            self.imgheight = image.height()
-        else:
-            raise RuntimeError("Argument must be a QImage.")
 
         if self.hasImage():
-            self._pxmapitem.setPixmap(self.pixmap)
-        else:
-            self._pxmapitem = self.scene.addPixmap(self.pixmap)
+            self._imageitem.setLevel(k, image)
+
+    def createImageItem(self):
+
+        if not self.hasImage():
+            self._imageitem = QtTiledImageItem()
+            # the image stays below the annotations, also when it is set after them
+            self._imageitem.setZValue(-2)
+            self.scene.addItem(self._imageitem)
+
+    def setSceneSize(self, width, height):
+
+        self.imgwidth = width
+        self.imgheight = height
 
         # Set scene size to image size (!)
-        self.setSceneRect(QRectF(self.pixmap.rect()))
+        self.setSceneRect(QRectF(0.0, 0.0, self.imgwidth, self.imgheight))
 
         # calculate zoom factor
         pixels_of_border = 10
@@ -165,17 +196,18 @@ class QtImageViewerPlus(QGraphicsView):
 
         self.updateViewer()
 
-    def updateImage(self, image):
+    def updateImage(self, image, levels=None):
+        """
+        Replace the current image keeping the current zoom and position.
+        """
 
-        if type(image) is QImage:
-            imageARGB32 = image.convertToFormat(QImage.Format_ARGB32)
-            self.pixmap = QPixmap.fromImage(imageARGB32)
-            self.imgwidth = image.width()
-            self.imgheight = image.height()
-        else:
-            raise RuntimeError("Argument must be a QImage.")
+        if not isinstance(image, (QImage, MapImage)):
+            raise RuntimeError("Argument must be a QImage or a MapImage.")
 
-        self._pxmapitem.setPixmap(self.pixmap)
+        self.createImageItem()
+        self._imageitem.setImage(image, levels)
+        self.imgwidth = image.width()
+        self.imgheight = image.height()
 
         # if an overlay exists it must be drawn
         if self.overlay_image.width() > 1:
@@ -199,14 +231,15 @@ class QtImageViewerPlus(QGraphicsView):
     def drawOverlayImage(self):
 
         if self.overlay_image.width() > 1:
-            pxmap = self.pixmap.copy()
-            p = QPainter()
-            p.begin(pxmap)
-            p.setOpacity(self.opacity)
-            p.drawImage(0, 0, self.overlay_image)
-            p.end()
-
-            self._pxmapitem.setPixmap(pxmap)
+            pxmap = QPixmap.fromImage(self.overlay_image)
+
+            if self._overlayitem is None:
+                self._overlayitem = self.scene.addPixmap(pxmap)
+                self._overlayitem.setZValue(-1)
+            else:
+                self._overlayitem.setPixmap(pxmap)
+
+            self._overlayitem.setOpacity(self.opacity)
 
     #used for crossair cursor
     def drawForeground(self, painter, rect):
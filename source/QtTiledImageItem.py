@@ -0,0 +1,248 @@
+# TagLab
+# A semi-automatic segmentation tool
+#
+# Copyright(C) 2019
+# Visual Computing Lab
+# ISTI - Italian National Research Council
+# All rights reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License (http://www.gnu.org/licenses/gpl.txt)
+# for more details.
+
+""" QGraphicsItem that displays a (large) image as a multi-resolution pyramid of tiles.
+"""
+
+import math
+from collections import OrderedDict
+
+from PyQt5.QtCore import Qt, QRectF
+from PyQt5.QtGui import QImage, QPixmap, QPainter
+from PyQt5.QtWidgets import QGraphicsItem, QStyleOptionGraphicsItem
+
+from source.MapImage import MapImage, MapPyramid
+
+
+class QtTiledImageItem(QGraphicsItem):
+    """
+    The image is stored as a pyramid of levels: level 0 is the full resolution image,
+    level k is the image downscaled by a factor 2^k. Only the tiles that intersect the exposed
+    area of the view are converted to QPixmap, at the level that matches the current zoom.
+    The QPixmaps are kept in a LRU cache with a fixed memory budget, so the cost of panning
+    and zooming does not depend on the size of the image.
+    """
+
+    def __init__(self, tile_size=512, cache_budget=256*1024*1024, parent=None):
+        super(QtTiledImageItem, self).__init__(parent)
+
+        self.TILE_SIZE = tile_size
+
+        # maximum amount of memory (in bytes) used by the cached tiles
+        self.CACHE_BUDGET = cache_budget
+
+        # level 0 is the full resolution image
+        self.levels = []
+
+        self.imgwidth = 0
+        self.imgheight = 0
+
+        # while the levels are being loaded (see setImageSize()) the missing levels are not created
+        self.loading = False
+
+        # (level, row, col) -> QPixmap
+        self.tiles = OrderedDict()
+        self.cache_size = 0
+
+        # the exposed rectangle is needed to draw only the visible tiles
+        self.setFlag(QGraphicsItem.ItemUsesExtendedStyleOption)
+
+    def numberOfLevels(self, width, height):
+        """
+        Number of levels needed to reduce the image to a single tile (the same of the cached pyramids).
+        """
+
+        return MapPyramid.numberOfLevels(width, height, self.TILE_SIZE)
+
+    def setImage(self, image, levels=None):
+        """
+        Set the image to display (it must be a QImage or a MapImage). The coarser levels of the pyramid
+        can be given (e.g. when they are cached on disk), otherwise they are created when they are
+        needed for the first time.
+        """
+
+        if not isinstance(image, (QImage, MapImage)):
+            raise RuntimeError("Argument must be a QImage or a MapImage.")
+
+        self.prepareGeometryChange()
+
+        self.imgwidth = image.width()
+        self.imgheight = image.height()
+
+        nlevels = self.numberOfLevels(self.imgwidth, self.imgheight)
+        self.levels = [image] + [None] * (nlevels - 1)
+
+        if levels is not None:
+            for k in range(1, min(nlevels, len(levels))):
+                self.levels[k] = levels[k]
+
+        self.loading = False
+        self.clearCache()
+        self.update()
+
+    def setImageSize(self, width, height):
+        """
+        Prepare an empty pyramid for an image of the given size whose levels are loaded in background.
+        The levels are given with setLevel() as soon as they are available; until then, the closest
+        available level is displayed.
+        """
+
+        self.prepareGeometryChange()
+
+        self.imgwidth = width
+        self.imgheight = height
+        self.levels = [None] * self.numberOfLevels(width, height)
+
+        self.loading = True
+        self.clearCache()
+        self.update()
+
+    def setLevel(self, k, image):
+
+        if k < 0 or k >= len(self.levels):
+            return
+
+        self.levels[k] = image
+        self.update()
+
+    def image(self):
+        """
+        Returns the full resolution image.
+        """
+
+        if len(self.levels) > 0:
+            return self.levels[0]
+        return None
+
+    def level(self, k):
+        """
+        Returns the k-th level of the pyramid, creating it from the closest finer level if needed.
+        """
+
+        if self.levels[k] is None and self.loading:
+            return None
+
+        if self.levels[k] is None:
+            finer = k - 1
+            while self.levels[finer] is None:
+                finer -= 1
+
+            w = max(1, self.imgwidth >> k)
+            h = max(1, self.imgheight >> k)
+            self.levels[k] = self.levels[finer].scaled(w, h, Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+
+        return self.levels[k]
+
+    def availableLevel(self, k):
+        """
+        The index of the level to display in place of the k-th one while the pyramid is being loaded:
+        the closest coarser level (cheaper to draw), otherwise the closest finer one.
+        """
+
+        if self.levels[k] is not None or not self.loading:
+            return k
+
+        for coarser in range(k + 1, len(self.levels)):
+            if self.levels[coarser] is not None:
+                return coarser
+
+        for finer in range(k - 1, -1, -1):
+            if self.levels[finer] is not None:
+                return finer
+
+        return None
+
+    def levelForScale(self, scale):
+        """
+        The level whose pixels are the closest ones to the screen pixels (but not smaller).
+        """
+
+        if scale <= 0.0 or len(self.levels) == 0:
+            return 0
+
+        k = int(math.floor(math.log2(1.0 / scale)))
+        return max(0, min(k, len(self.levels) - 1))
+
+    def clearCache(self):
+
+        self.tiles.clear()
+        self.cache_size = 0
+
+    def tile(self, k, row, col, level_img):
+
+        key = (k, row, col)
+
+        pxmap = self.tiles.get(key)
+        if pxmap is not None:
+            self.tiles.move_to_end(key)
+            return pxmap
+
+        x = col * self.TILE_SIZE
+        y = row * self.TILE_SIZE
+        w = min(self.TILE_SIZE, level_img.width() - x)
+        h = min(self.TILE_SIZE, level_img.height() - y)
+
+        pxmap = QPixmap.fromImage(level_img.copy(x, y, w, h))
+        self.tiles[key] = pxmap
+        self.cache_size += w * h * 4
+
+        # evict the least recently used tiles
+        while self.cache_size > self.CACHE_BUDGET and len(self.tiles) > 1:
+            (_, old) = self.tiles.popitem(last=False)
+            self.cache_size -= old.width() * old.height() * 4
+
+        return pxmap
+
+    def boundingRect(self):
+
+        return QRectF(0.0, 0.0, self.imgwidth, self.imgheight)
+
+    def paint(self, painter, option, widget=None):
+
+        if len(self.levels) == 0:
+            return
+
+        scale = QStyleOptionGraphicsItem.levelOfDetailFromTransform(painter.worldTransform())
+        k = self.availableLevel(self.levelForScale(scale))
+        if k is None:
+            return
+
+        level_img = self.level(k)
+
+        # level coordinates -> image coordinates
+        sx = self.imgwidth / level_img.width()
+        sy = self.imgheight / level_img.height()
+
+        exposed = option.exposedRect.intersected(self.boundingRect())
+        if exposed.isEmpty():
+            return
+
+        col_first = max(0, int(exposed.left() / sx) // self.TILE_SIZE)
+        col_last = min(int(math.ceil(exposed.right() / sx)) // self.TILE_SIZE, (level_img.width() - 1) // self.TILE_SIZE)
+        row_first = max(0, int(exposed.top() / sy) // self.TILE_SIZE)
+        row_last = min(int(math.ceil(exposed.bottom() / sy)) // self.TILE_SIZE, (level_img.height() - 1) // self.TILE_SIZE)
+
+        painter.setRenderHint(QPainter.SmoothPixmapTransform, True)
+
+        for row in range(row_first, row_last + 1):
+            for col in range(col_first, col_last + 1):
+                pxmap = self.tile(k, row, col, level_img)
+                target = QRectF(col * self.TILE_SIZE * sx, row * self.TILE_SIZE * sy,
+                                pxmap.width() * sx, pxmap.height() * sy)
+                painter.drawPixmap(target, pxmap, QRectF(pxmap.rect()))
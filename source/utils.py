@@ -24,6 +24,8 @@ from PyQt5.QtGui import QImage, qRgb, qRgba
 import numpy as np
 import math
 from skimage.draw import line
+from source.ConversionUtils import qimageToBGRA, qimageToRGB, cropToRGB, colorizeLabels
+from source import ConversionUtils
 
 def clampCoords(x, y, W, H):
 
@@ -74,75 +76,33 @@ def showMaskAndCurve(mask, bbox, curve, fig_number):
 
 def maskToQImage(mask):
 
-    h = mask.shape[0]
-    w = mask.shape[1]
-    qimg = QImage(w, h, QImage.Format_RGB32)
-    qimg.fill(qRgb(0, 0, 0))
-
-    for y in range(h):
-        for x in range(w):
-
-            if mask[y, x] == 1:
-                qimg.setPixel(x, y, qRgb(255, 255, 255))
-
-    return qimg
+    return ConversionUtils.colorizeLabels(mask == 1, [qRgb(0, 0, 0), qRgb(255, 255, 255)], QImage.Format_RGB32)
 
 def labelsToQImage(mask):
 
-    h = mask.shape[0]
-    w = mask.shape[1]
-    qimg = QImage(w, h, QImage.Format_RGB32)
-    qimg.fill(qRgb(0, 0, 0))
+    c = np.arange(int(mask.max()) + 1 if mask.size > 0 else 1, dtype=np.int64)
+    lut = 0xff000000 | (((c * 17) & 255) << 16) | (((c * 163) & 255) << 8) | ((c * 211) & 255)
 
-    for y in range(h):
-        for x in range(w):
-            c = mask[y, x]
-            qimg.setPixel(x, y, qRgb(c*17, c*163, c*211))
-
-    return qimg
+    return ConversionUtils.colorizeLabels(mask, lut, QImage.Format_RGB32)
 
 def floatmapToQImage(floatmap):
 
     h = floatmap.shape[0]
     w = floatmap.shape[1]
-    qimg = QImage(w, h, QImage.Format_RGB32)
 
-    qimg.fill(qRgb(0,0,0))
+    # NOTE: the map is indexed as floatmap[x, y]
+    gray = np.trunc(floatmap[:w, :h].T).astype(np.int64) & 255
+    lut = 0xff000000 | (np.arange(256, dtype=np.int64) * 0x010101)
 
-    for y in range(h):
-        for x in range(w):
-            gray = int(floatmap[x,y])
-            qimg.setPixel(x,y,qRgb(gray,gray,gray))
-
-    return qimg
+    return ConversionUtils.colorizeLabels(gray, lut, QImage.Format_RGB32)
 
 def rgbToQImage(image):
 
-    h = image.shape[0]
-    w = image.shape[1]
-    ch = image.shape[2]
-
-    imgdata = np.zeros([h, w, 4], dtype=np.uint8)
-
-    if ch == 3:
-        imgdata[:, :, 2] = image[:, :, 0]
-        imgdata[:, :, 1] = image[:, :, 1]
-        imgdata[:, :, 0] = image[:, :, 2]
-        imgdata[:, :, 3] = 255
-        qimg = QImage(imgdata.data, w, h, QImage.Format_RGB32)
-
-    elif ch == 4:
-        imgdata[:, :, 3] = image[:, :, 0]
-        imgdata[:, :, 2] = image[:, :, 1]
-        imgdata[:, :, 1] = image[:, :, 2]
-        imgdata[:, :, 0] = image[:, :, 3]
-        qimg = QImage(imgdata.data, w, h, QImage.Format_ARGB32)
-
-    return qimg.copy()
+    return ConversionUtils.rgbToQImage(image)
 
 def prepareForDeepExtreme(qimage_map, four_points, pad_max):
     """
-    Crop the image map (QImage) and return a NUMPY array containing it.
+    Crop the image map (QImage or MapImage) and return a (read-only) NUMPY view on it.
     It returns also the coordinates of the bounding box on the cropped image.
     """
 
@@ -156,23 +116,10 @@ def prepareForDeepExtreme(qimage_map, four_points, pad_max):
 
     w = xmax - xmin
     h = ymax - ymin
-    qimage_cropped = qimage_map.copy(xmin, ymin, w, h)
-
-    fmt = qimage_cropped.format()
-    assert(fmt == QImage.Format_RGB32)
-
-    arr = np.zeros((h, w, 3), dtype=np.uint8)
-
-    bits = qimage_cropped.bits()
-    bits.setsize(int(h*w*4))
-    arrtemp = np.frombuffer(bits, np.uint8).copy()
-    arrtemp = np.reshape(arrtemp, [h, w, 4])
-    arr[:, :, 0] = arrtemp[:, :, 2]
-    arr[:, :, 1] = arrtemp[:, :, 1]
-    arr[:, :, 2] = arrtemp[:, :, 0]
+    arr = cropToRGB(qimage_map, [ymin, xmin, w, h])
 
     # update four point
-    four_points_updated = np.zeros((4,2), dtype=np.int)
+    four_points_updated = np.zeros((4,2), dtype=int)
     four_points_updated[:, 0] = four_points[:, 0] - xmin
     four_points_updated[:, 1] = four_points[:, 1] - ymin
 
@@ -192,24 +139,11 @@ def cropQImage(qimage_map, bbox):
 
 
 def qimageToNumpyArray(qimg):
+    """
+    Returns a (contiguous) copy of the RGB pixels of the QImage. Use qimageToRGB() to avoid the copy.
+    """
 
-    w = qimg.width()
-    h = qimg.height()
-
-    fmt = qimg.format()
-    assert (fmt == QImage.Format_RGB32)
-
-    arr = np.zeros((h, w, 3), dtype=np.uint8)
-
-    bits = qimg.bits()
-    bits.setsize(int(h * w * 4))
-    arrtemp = np.frombuffer(bits, np.uint8).copy()
-    arrtemp = np.reshape(arrtemp, [h, w, 4])
-    arr[:, :, 0] = arrtemp[:, :, 2]
-    arr[:, :, 1] = arrtemp[:, :, 1]
-    arr[:, :, 2] = arrtemp[:, :, 0]
-
-    return arr
+    return qimageToRGB(qimg, copy=True)
 
 def prepareLabelForDeepExtreme(qimage_map, four_points, pad_max):
     """
@@ -245,7 +179,7 @@ def prepareLabelForDeepExtreme(qimage_map, four_points, pad_max):
                 arr[y, x] = 1
 
     # update four point
-    four_points_updated = np.zeros((4,2), dtype=np.int)
+    four_points_updated = np.zeros((4,2), dtype=int)
     four_points_updated[:, 0] = four_points[:, 0] - xmin
     four_points_updated[:, 1] = four_points[:, 1] - ymin
 
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the tests import the modules of TagLab as the application does (e.g. "from source import utils")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
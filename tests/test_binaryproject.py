@@ -0,0 +1,109 @@
+import numpy as np
+import pytest
+
+from source.Blob import Blob
+from source import BinaryProject
+
+
+def makeBlobs():
+
+    blobs = []
+
+    # float contours (e.g. created from a mask), with a hole
+    blob = Blob(None, 0, 0, 0)
+    blob.id = 1
+    blob.bbox = np.array([10, 20, 30, 40])
+    blob.centroid = np.array([35.5, 25.25])
+    blob.area = 1000.0
+    blob.perimeter = 140.5
+    blob.contour = np.array([[20.0, 10.0], [60.5, 10.0], [60.5, 40.0], [20.0, 40.0]])
+    blob.inner_contours = [np.array([[30.0, 20.0], [40.0, 20.0], [40.0, 30.0]])]
+    blob.class_name = "Porite"
+    blob.class_color = [255, 0, 0]
+    blob.instance_name = "coral1"
+    blob.blob_name = "c-1-35.5x-25.3y"
+    blob.note = "note with unicode: àè"
+    blobs.append(blob)
+
+    # integer contours (e.g. drawn by hand) and the extreme points of the DeepExtreme tool
+    blob = Blob(None, 0, 0, 0)
+    blob.id = 7
+    blob.bbox = np.array([0, 0, 5, 5])
+    blob.centroid = np.array([2.0, 2.0])
+    blob.area = 25.0
+    blob.perimeter = 16.0
+    blob.contour = np.array([[0, 0], [4, 0], [4, 4], [0, 4]])
+    blob.inner_contours = []
+    blob.deep_extreme_points = np.array([[0, 2], [2, 0], [4, 2], [2, 4]])
+    blob.class_name = "Empty"
+    blob.class_color = [255, 255, 255]
+    blob.instance_name = "coral7"
+    blob.blob_name = "c-7-2.0x-2.0y"
+    blob.note = ""
+    blobs.append(blob)
+
+    return blobs
+
+
+def assertSameBlobs(loaded, blobs):
+
+    assert len(loaded) == len(blobs)
+
+    for (a, b) in zip(loaded, blobs):
+
+        for name in ["id", "area", "perimeter", "class_name", "class_color", "instance_name", "blob_name", "note"]:
+            assert getattr(a, name) == getattr(b, name)
+
+        for name in ["bbox", "centroid", "contour", "deep_extreme_points"]:
+            assert np.array_equal(getattr(a, name), getattr(b, name))
+            assert getattr(a, name).dtype.kind == np.asarray(getattr(b, name)).dtype.kind
+
+        assert len(a.inner_contours) == len(b.inner_contours)
+        for (ca, cb) in zip(a.inner_contours, b.inner_contours):
+            assert np.array_equal(ca, cb)
+            assert ca.dtype.kind == cb.dtype.kind
+
+
+def test_round_trip(tmp_path):
+
+    project = {"Map File": "map.png", "Acquisition Date": "2020-01-01", "px-to-mm": 0.5}
+    blobs = makeBlobs()
+
+    filename = str(tmp_path / "project.tlb")
+    BinaryProject.saveProject(filename, project, blobs)
+    (loaded_project, loaded) = BinaryProject.loadProject(filename)
+
+    assert loaded_project == project
+    assertSameBlobs(loaded, blobs)
+
+
+def test_same_as_json(tmp_path):
+
+    project = {"Map File": "map.png"}
+    blobs = makeBlobs()
+
+    BinaryProject.saveProject(str(tmp_path / "project.json"), project, blobs)
+    BinaryProject.saveProject(str(tmp_path / "project.tlb"), project, blobs)
+
+    (json_project, json_blobs) = BinaryProject.loadProject(str(tmp_path / "project.json"))
+    (binary_project, binary_blobs) = BinaryProject.loadProject(str(tmp_path / "project.tlb"))
+
+    assert json_project == binary_project
+    assertSameBlobs(binary_blobs, json_blobs)
+
+
+def test_empty_project(tmp_path):
+
+    filename = str(tmp_path / "empty.tlb")
+    BinaryProject.saveProject(filename, {}, [])
+
+    assert BinaryProject.loadProject(filename) == ({}, [])
+
+
+def test_not_a_project(tmp_path):
+
+    filename = tmp_path / "wrong.tlb"
+    filename.write_bytes(b"not a project")
+
+    with pytest.raises(ValueError):
+        BinaryProject.loadProject(str(filename))
@@ -0,0 +1,146 @@
+import numpy as np
+from skimage import measure
+
+from source.Blob import Blob
+
+
+def previousContours(mask, bbox):
+    """
+    The marching squares implementation of Blob.createContourFromMask() replaced by the OpenCV one.
+    """
+
+    PADDED_SIZE = 4
+    img_padded = np.pad(mask, PADDED_SIZE, mode="constant")
+
+    contours = measure.find_contours(img_padded, 0.6)
+    inner_contours = measure.find_contours(img_padded, 0.4)
+
+    if len(contours) == 1:
+        contour = measure.approximate_polygon(contours[0], tolerance=0.2)
+        holes = []
+    else:
+        longest = max(range(len(contours)), key=lambda i: contours[i].shape[0])
+        inner_longest = max(range(len(inner_contours)), key=lambda i: inner_contours[i].shape[0])
+        contour = contours[longest]
+        holes = [c for i, c in enumerate(inner_contours) if i != inner_longest and c.shape[0] > 20]
+
+    offset = np.array([bbox[1] - PADDED_SIZE, bbox[0] - PADDED_SIZE])
+    return (contour[:, ::-1] + offset, [c[:, ::-1] + offset for c in holes])
+
+
+def distanceToContour(points, contour):
+    """
+    Distance of each point from the closed polyline of the contour.
+    """
+
+    a = contour
+    b = np.roll(contour, -1, axis=0)
+    ab = b - a
+    length2 = np.maximum((ab ** 2).sum(axis=1), 1e-12)
+    ap = points[:, np.newaxis, :] - a[np.newaxis, :, :]
+    t = np.clip((ap * ab).sum(axis=2) / length2, 0.0, 1.0)
+    closest = a + t[:, :, np.newaxis] * ab
+    return np.sqrt(((points[:, np.newaxis, :] - closest) ** 2).sum(axis=2)).min(axis=1)
+
+
+def perimeter(contour):
+
+    return np.sqrt((np.diff(np.vstack([contour, contour[:1]]), axis=0) ** 2).sum(axis=1)).sum()
+
+
+def blobFromMask(mask, top=30, left=50):
+
+    blob = Blob(None, 0, 0, 0)
+    bbox = [top, left, mask.shape[1], mask.shape[0]]
+    blob.createContourFromMask(mask, bbox)
+    blob.bbox = np.array(bbox)
+    blob.calculatePerimeter()
+    return (blob, bbox)
+
+
+def assertClose(contour, previous):
+
+    # the contours pass through the centers of the border pixels, the previous ones 0.4 pixels outside
+    assert distanceToContour(contour, previous).max() <= 0.5
+    assert distanceToContour(previous, contour).max() <= 0.5
+
+
+def test_single_pixel():
+
+    mask = np.ones((1, 1), dtype=int)
+    (blob, bbox) = blobFromMask(mask)
+    (previous, previous_holes) = previousContours(mask, bbox)
+
+    assert blob.contour.shape[0] >= 3
+    assert np.allclose(blob.contour, previous)
+    assert blob.inner_contours == []
+    assert np.isclose(blob.perimeter, perimeter(previous))
+
+
+def test_line():
+
+    mask = np.ones((1, 7), dtype=int)
+    (blob, bbox) = blobFromMask(mask)
+    (previous, previous_holes) = previousContours(mask, bbox)
+
+    assert np.allclose(blob.contour, previous)
+    assert np.isclose(blob.perimeter, perimeter(previous))
+
+
+def test_hole():
+
+    mask = np.ones((40, 50), dtype=int)
+    mask[10:25, 15:30] = 0      # big hole
+    mask[30, 40] = 0            # small hole, ignored
+    mask[0:5, 0:5] = 0          # notch of the border
+
+    (blob, bbox) = blobFromMask(mask)
+    (previous, previous_holes) = previousContours(mask, bbox)
+
+    assert len(blob.inner_contours) == len(previous_holes) == 1
+    assertClose(blob.contour, previous)
+    assertClose(blob.inner_contours[0], previous_holes[0])
+
+    # the previous contours are about 0.4 pixels outside (inside the holes), so the perimeter is longer
+    previous_perimeter = perimeter(previous) + perimeter(previous_holes[0])
+    assert previous_perimeter - 8 < blob.perimeter < previous_perimeter
+
+    # the mask is recreated from the contours, except the small hole
+    expected = mask.copy()
+    expected[30, 40] = 1
+    assert np.array_equal(blob.getMask(), expected)
+
+
+def test_hole_threshold():
+
+    # the previous contour of a 4 x 5 hole has 19 points (dropped), the one of a 5 x 5 hole 21 (kept)
+    for (w, kept) in [(4, False), (5, True)]:
+
+        mask = np.ones((20, 20), dtype=int)
+        mask[5:10, 5:5 + w] = 0
+
+        (blob, bbox) = blobFromMask(mask)
+        (previous, previous_holes) = previousContours(mask, bbox)
+
+        assert len(previous_holes) == int(kept)
+        assert len(blob.inner_contours) == int(kept)
+
+
+def test_multiple_components():
+
+    mask = np.zeros((40, 60), dtype=int)
+    mask[5:35, 5:35] = 1
+    mask[15:20, 40:43] = 1
+    mask[30:32, 50:52] = 1
+
+    (blob, bbox) = blobFromMask(mask)
+    (previous, previous_holes) = previousContours(mask, bbox)
+
+    # the outer contour is the one of the biggest component
+    assertClose(blob.contour, previous)
+    assert blob.inner_contours == previous_holes == []
+    assert abs(blob.perimeter - perimeter(previous)) < 3
+
+    expected = np.zeros_like(mask)
+    expected[5:35, 5:35] = 1
+    assert np.array_equal(blob.getMask(), expected)
@@ -0,0 +1,114 @@
+import numpy as np
+import cv2
+from scipy import ndimage as ndi
+from skimage import measure
+
+from source.MapImage import MapImage
+from source.BlobExtractor import BlobExtractor, ColorIndexMap
+
+
+def randomClassMap(h, w, seed=0):
+
+    # blocky classes, so the components cross the seams between the stripes in many ways
+    rng = np.random.default_rng(seed)
+    small = rng.integers(0, 4, (h // 4 + 1, w // 4 + 1))
+    return ndi.zoom(small, 4, order=0)[:h, :w].astype(np.uint8)
+
+
+def referenceComponents(class_map, lut, roi_mask, min_area):
+    """
+    (code, area, centroid) of the components, labeled on the whole map at once.
+    """
+
+    coded = np.take(lut, class_map)
+    if roi_mask is not None:
+        coded[roi_mask == 0] = 0
+
+    components = []
+    for code in np.unique(coded):
+        if code == 0:
+            continue
+        labels = measure.label(coded == code, connectivity=1)
+        for region in measure.regionprops(labels):
+            if region.area > min_area:
+                (cy, cx) = region.centroid
+                components.append((int(code), int(region.area), (round(cx, 6), round(cy, 6))))
+
+    return sorted(components)
+
+
+def extracted(blobs):
+
+    components = []
+    for (code, blob) in blobs:
+        (cx, cy) = blob.centroid
+        components.append((int(code), int(blob.area), (round(cx, 6), round(cy, 6))))
+
+    return sorted(components)
+
+
+def test_same_as_full_map(monkeypatch):
+
+    # small stripes, so the map is processed in many of them
+    monkeypatch.setattr(BlobExtractor, "STRIPE_PIXELS", 3000)
+
+    class_map = randomClassMap(230, 170)
+    lut = np.array([0, 1, 2, 3] + [0] * 252, dtype=np.uint8)
+
+    roi_mask = np.ones(class_map.shape, dtype=np.uint8)
+    roi_mask[:, :30] = 0
+
+    for mask in [None, roi_mask]:
+        blobs = BlobExtractor(min_area=10, workers=1).extract(class_map, lut, mask)
+        assert extracted(blobs) == referenceComponents(class_map, lut, mask, 10)
+
+
+def test_offset_and_pool(monkeypatch):
+
+    monkeypatch.setattr(BlobExtractor, "STRIPE_PIXELS", 5000)
+    monkeypatch.setattr(BlobExtractor, "MIN_BLOBS_PER_PROCESS", 1)
+
+    class_map = randomClassMap(120, 100, seed=1)
+    lut = np.array([0, 1, 2, 3] + [0] * 252, dtype=np.uint8)
+
+    serial = BlobExtractor(min_area=4, workers=1).extract(class_map, lut, offset=(7, 11))
+    pooled = BlobExtractor(min_area=4, workers=2).extract(class_map, lut, offset=(7, 11))
+
+    assert [code for (code, blob) in serial] == [code for (code, blob) in pooled]
+    for ((code, a), (code, b)) in zip(serial, pooled):
+        assert np.array_equal(a.bbox, b.bbox)
+        assert np.array_equal(a.contour, b.contour)
+
+    reference = [(code, area, (round(cx + 11, 6), round(cy + 7, 6)))
+                 for (code, area, (cx, cy)) in referenceComponents(class_map, lut, None, 4)]
+    assert extracted(serial) == sorted(reference)
+
+
+def test_rescaled(monkeypatch):
+
+    monkeypatch.setattr(BlobExtractor, "STRIPE_PIXELS", 4000)
+
+    class_map = randomClassMap(90, 70, seed=2)
+    lut = np.array([0, 1, 2, 3] + [0] * 252, dtype=np.uint8)
+
+    for (h, w) in [(200, 150), (45, 33)]:
+        resized = cv2.resize(class_map, (w, h), interpolation=cv2.INTER_NEAREST)
+        blobs = BlobExtractor(min_area=5, workers=1).extract(class_map, lut, size=(h, w))
+        assert extracted(blobs) == referenceComponents(resized, lut, None, 5)
+
+
+def test_color_index_map():
+
+    palette = np.array([[0, 0, 0], [255, 0, 0], [0, 255, 0], [10, 20, 200]], dtype=np.uint8)
+    indices = randomClassMap(60, 80, seed=3)
+    rgb = palette[indices]
+
+    color_map = ColorIndexMap(MapImage.fromArray(np.ascontiguousarray(rgb[:, :, ::-1])))
+
+    codes = palette[:, 0].astype(np.int32) + (palette[:, 1].astype(np.int32) << 8) + (palette[:, 2].astype(np.int32) << 16)
+    assert np.array_equal(color_map.colors, np.sort(codes))
+
+    # index of the color of each pixel
+    expected = np.searchsorted(np.sort(codes), codes[indices])
+    assert np.array_equal(color_map[0:60, 0:80], expected)
+    assert np.array_equal(color_map[10:20, 30:35], expected[10:20, 30:35])
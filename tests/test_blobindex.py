@@ -0,0 +1,113 @@
+import numpy as np
+import pytest
+
+from source.BlobIndex import BlobIndex
+
+
+class FakeBlob(object):
+
+    def __init__(self, id, bbox):
+
+        self.id = id
+        self.bbox = np.array(bbox)
+
+
+def randomBlobs(rng, n, size=200):
+
+    blobs = []
+    for i in range(n):
+        top = int(rng.integers(0, size))
+        left = int(rng.integers(0, size))
+        blobs.append(FakeBlob(i, [top, left, int(rng.integers(0, 40)), int(rng.integers(0, 40))]))
+    return blobs
+
+
+def bruteForceAt(blobs, x, y):
+
+    return [blob for blob in blobs
+            if blob.bbox[1] <= x <= blob.bbox[1] + blob.bbox[2] and blob.bbox[0] <= y <= blob.bbox[0] + blob.bbox[3]]
+
+
+def bruteForceInRect(blobs, top, left, width, height):
+
+    return [blob for blob in blobs
+            if blob.bbox[1] <= left + width and left <= blob.bbox[1] + blob.bbox[2] and
+            blob.bbox[0] <= top + height and top <= blob.bbox[0] + blob.bbox[3]]
+
+
+@pytest.fixture
+def indexed():
+
+    rng = np.random.default_rng(0)
+    blobs = randomBlobs(rng, 300)
+
+    # small cells, so many bounding boxes cross or touch the borders of the cells
+    index = BlobIndex(cell_size=16)
+    for blob in blobs:
+        index.insert(blob)
+
+    return (rng, index, blobs)
+
+
+def ids(blobs):
+
+    return [blob.id for blob in blobs]
+
+
+def test_blobs_at(indexed):
+
+    (rng, index, blobs) = indexed
+
+    points = [(x, y) for x in range(0, 240, 4) for y in range(0, 240, 4)]
+    points += [tuple(p) for p in rng.random((500, 2)) * 240]
+
+    for (x, y) in points:
+        assert sorted(ids(index.blobsAt(x, y))) == ids(bruteForceAt(blobs, x, y))
+
+
+def test_blobs_in_rect(indexed):
+
+    (rng, index, blobs) = indexed
+
+    for i in range(500):
+        (top, left) = rng.integers(0, 240, 2)
+        (width, height) = rng.integers(0, 80, 2)
+        assert ids(index.blobsInRect(top, left, width, height)) == ids(bruteForceInRect(blobs, top, left, width, height))
+
+
+def test_update_and_remove(indexed):
+
+    (rng, index, blobs) = indexed
+
+    # the bbox of an edited blob changes, the blob is inserted again
+    for blob in blobs[:50]:
+        blob.bbox = np.array([int(rng.integers(0, 200)), int(rng.integers(0, 200)), 10, 10])
+        index.insert(blob)
+
+    for blob in blobs[50:100]:
+        index.remove(blob)
+
+    remaining = blobs[100:] + blobs[:50]
+
+    for i in range(300):
+        (top, left) = rng.integers(0, 240, 2)
+        (width, height) = rng.integers(0, 80, 2)
+        assert ids(index.blobsInRect(top, left, width, height)) == ids(bruteForceInRect(remaining, top, left, width, height))
+
+
+def test_blobs_inside_rect(indexed):
+
+    annotation = pytest.importorskip("source.Annotation", exc_type=ImportError)
+
+    (rng, index, blobs) = indexed
+
+    annotations = annotation.Annotation({})
+    for blob in blobs:
+        annotations.addBlob(blob)
+
+    for i in range(300):
+        (top, left) = rng.integers(0, 240, 2)
+        (width, height) = rng.integers(0, 120, 2)
+        expected = [blob for blob in blobs if blob.bbox[1] >= left and blob.bbox[0] >= top and
+                    blob.bbox[1] + blob.bbox[2] <= left + width and blob.bbox[0] + blob.bbox[3] <= top + height]
+        assert ids(annotations.blobsInsideRect(top, left, width, height)) == ids(expected)
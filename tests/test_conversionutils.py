@@ -0,0 +1,100 @@
+import numpy as np
+
+from PyQt5.QtGui import QImage, qRgb, qRgba
+
+from source.ConversionUtils import qimageToBGRA, qimageToRGB, cropToRGB, rgbToQImage, colorizeLabels
+from source.MapImage import MapImage
+
+
+def randomRGB(h, w, channels=3, seed=0):
+
+    return np.random.default_rng(seed).integers(0, 256, (h, w, channels), dtype=np.uint8)
+
+
+def pixelsRGB(qimg):
+    """
+    The pixels of the QImage read one by one with QImage.pixel().
+    """
+
+    arr = np.zeros((qimg.height(), qimg.width(), 3), dtype=np.uint8)
+    for y in range(qimg.height()):
+        for x in range(qimg.width()):
+            p = qimg.pixel(x, y)
+            arr[y, x] = [(p >> 16) & 255, (p >> 8) & 255, p & 255]
+    return arr
+
+
+def test_rgb_round_trip():
+
+    for (h, w) in [(1, 1), (7, 13), (20, 31)]:
+        rgb = randomRGB(h, w)
+        qimg = rgbToQImage(rgb)
+
+        assert qimg.format() == QImage.Format_RGB32
+        assert np.array_equal(pixelsRGB(qimg), rgb)
+        assert np.array_equal(qimageToRGB(qimg), rgb)
+        assert np.array_equal(qimageToRGB(qimg, copy=True), rgb)
+        assert np.all(qimageToBGRA(qimg)[:, :, 3] == 255)
+
+
+def test_argb_round_trip():
+
+    argb = randomRGB(9, 11, channels=4)
+    qimg = rgbToQImage(argb)
+
+    assert qimg.format() == QImage.Format_ARGB32
+    assert np.array_equal(qimageToBGRA(qimg)[:, :, ::-1], argb)
+
+
+def test_padded_formats():
+
+    # the rows of a 24-bit image are padded to 32 bits
+    rgb = randomRGB(5, 7)
+    qimg = QImage(np.ascontiguousarray(rgb).tobytes(), 7, 5, 7 * 3, QImage.Format_RGB888).copy()
+
+    assert np.array_equal(qimageToRGB(qimg), rgb)
+    assert np.array_equal(qimageToRGB(QImage()), np.zeros((0, 0, 3), dtype=np.uint8))
+
+
+def test_view():
+
+    qimg = rgbToQImage(randomRGB(4, 6))
+    copy = qimageToBGRA(qimg, copy=True)
+
+    # the view writes in the QImage, the copy does not
+    qimageToBGRA(qimg)[1, 2, :3] = [1, 2, 3]
+    assert qimg.pixel(2, 1) & 0xFFFFFF == qRgb(3, 2, 1) & 0xFFFFFF
+    assert not np.array_equal(copy[1, 2, :3], [1, 2, 3])
+
+
+def test_crop():
+
+    rgb = randomRGB(30, 40)
+    qimg = rgbToQImage(rgb)
+    mapimg = MapImage.fromArray(np.ascontiguousarray(rgb[:, :, ::-1]))
+
+    padded = np.zeros((50, 60, 3), dtype=np.uint8)
+    padded[10:40, 10:50] = rgb
+
+    # [top, left, width, height], also partially outside the image (the pixels outside are zero)
+    for bbox in [[0, 0, 40, 30], [5, 7, 10, 12], [-5, -3, 20, 15], [25, 35, 10, 10]]:
+        (top, left, w, h) = bbox
+        expected = padded[top + 10:top + 10 + h, left + 10:left + 10 + w]
+        assert np.array_equal(cropToRGB(qimg, bbox), expected)
+        assert np.array_equal(cropToRGB(mapimg, bbox), expected)
+        assert cropToRGB(mapimg, bbox, copy=True).flags.c_contiguous
+
+
+def test_colorize_labels():
+
+    labels = np.random.default_rng(1).integers(0, 4, (6, 9))
+    lut = [qRgba(0, 0, 0, 0), qRgb(255, 0, 0), qRgb(0, 255, 0), qRgba(10, 20, 30, 128)]
+
+    qimg = colorizeLabels(labels, lut)
+
+    for y in range(6):
+        for x in range(9):
+            assert qimg.pixel(x, y) == lut[labels[y, x]]
+
+    mask = colorizeLabels(labels > 1, [qRgba(0, 0, 0, 0), qRgb(255, 255, 255)])
+    assert mask.pixel(0, 0) == (qRgb(255, 255, 255) if labels[0, 0] > 1 else 0)
@@ -0,0 +1,37 @@
+import numpy as np
+import torch
+
+from PyQt5.QtGui import QImage
+
+from source.DeepExtremeModel import DeepExtremeModel
+from source.MapImage import MapImage
+
+
+def makeMap(w, h):
+
+    rgb = np.random.default_rng(0).integers(0, 256, (h, w, 3), dtype=np.uint8)
+    return MapImage.fromArray(np.ascontiguousarray(rgb[:, :, ::-1]))
+
+
+def test_prepare_input():
+
+    model = DeepExtremeModel(models_dir="missing")
+    extreme_points = np.array([[60, 80], [120, 40], [180, 90], [110, 150]])
+
+    for img_map in [makeMap(300, 200), makeMap(300, 200).toQImage()]:
+
+        (inputs, context) = model.prepareInput(img_map, extreme_points)
+
+        assert inputs.shape == (1, 4, model.INPUT_SIZE, model.INPUT_SIZE)
+        assert inputs.dtype == torch.float32
+        assert torch.isfinite(inputs).all()
+
+        # the heatmap of the points is normalized to [0, 255]
+        assert float(inputs[0, 3].max()) == 255.0
+
+        output = torch.zeros(1, model.INPUT_SIZE // 8, model.INPUT_SIZE // 8)
+        (mask, left, top, area) = model.segmentationMask(output, context)
+
+        assert mask.dtype == np.uint8
+        assert left <= extreme_points[:, 0].min() and top <= extreme_points[:, 1].min()
+        assert area == 120 * 110
@@ -0,0 +1,45 @@
+import numpy as np
+
+from models.dataloaders import helpers
+
+
+def test_crop2localmask():
+
+    rng = np.random.default_rng(0)
+    crop_mask = rng.random((64, 64)).astype(np.float32)
+
+    im_size = (300, 400)
+
+    # (x_min, y_min, x_max, y_max), also partially or completely outside the image; as in DeepExtreme the
+    # bbox reduced by relax never starts before the image (crop2fullmask would wrap around the negative indices)
+    for bbox in [(50, 60, 250, 200), (-30, -20, 100, 90), (350, 250, 450, 330), (0, 0, 399, 299), (500, 400, 600, 500)]:
+        for relax in [30, 40] if min(bbox) < 0 else [0, 10]:
+
+            bbox = np.array(bbox)
+            full = helpers.crop2fullmask(crop_mask, bbox, im_size=im_size, zero_pad=True, relax=relax)
+            (local, (x, y)) = helpers.crop2localmask(crop_mask, bbox, im_size, relax=relax)
+
+            placed = np.zeros(im_size)
+            placed[y:y + local.shape[0], x:x + local.shape[1]] = local
+
+            assert np.allclose(placed, full, atol=1e-6)
+
+            # the local mask covers all the (non zero) pixels of the full one
+            assert np.count_nonzero(full) == np.count_nonzero(local)
+
+
+def test_make_heatmap():
+
+    points = np.array([[10, 20], [300, 40], [250, 500], [0, 511]])
+
+    for (size, sigma) in [((512, 512), 10), ((100, 300), 5)]:
+
+        heatmap = helpers.make_heatmap(size, points, sigma=sigma)
+        gt = helpers.make_gt(np.zeros(size, dtype=np.float64), points, sigma=sigma)
+
+        assert heatmap.dtype == np.float32
+        assert heatmap.shape == gt.shape
+        assert np.abs(heatmap - gt).max() < 1e-6
+
+        # the normalized heatmaps (the input of the network) are the same
+        assert np.abs(helpers.cstm_normalize(heatmap, 255) - helpers.cstm_normalize(gt, 255)).max() < 1e-4